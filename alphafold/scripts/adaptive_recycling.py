@@ -0,0 +1,294 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Recycling of model inference that stops once the structure converges.
+
+AlphaFold runs all recycling iterations of a model inside one compiled
+function. Here every iteration is a separate call of a compiled function
+with the same parameters, so recycling can stop after any iteration. The
+iterations follow the recycling loops of modules.AlphaFold and
+modules_multimer.AlphaFold, so a run without an early stop gives the
+outputs of a full model run.
+"""
+
+import logging
+import time
+import weakref
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+from alphafold.common import confidence
+from alphafold.common import residue_constants
+from alphafold.model import model
+from alphafold.model import modules
+from alphafold.model import modules_multimer
+from alphafold.model import prng
+
+import haiku as hk
+import jax
+import jax.numpy as jnp
+import ml_collections
+import numpy as np
+
+# Compiled iteration functions of every model runner by input shapes.
+_EXECUTABLES = weakref.WeakKeyDictionary()
+
+
+class _MonomerIteration(hk.Module):
+    """A recycling iteration of modules.AlphaFold."""
+
+    def __init__(self, config, name='alphafold'):
+        super().__init__(name=name)
+        self.config = config
+        self.global_config = config.global_config
+
+    def __call__(self, batch, prev, recycle_idx):
+        impl = modules.AlphaFoldIteration(self.config, self.global_config)
+        if self.config.resample_msa_in_recycling:
+            num_ensemble = batch['aatype'].shape[0] // (self.config.num_recycle + 1)
+            batch = jax.tree_map(
+                lambda x: jax.lax.dynamic_slice_in_dim(
+                    x, recycle_idx * num_ensemble, num_ensemble, axis=0),
+                batch)
+        return impl(
+            ensembled_batch=batch,
+            non_ensembled_batch=prev,
+            is_training=False,
+            compute_loss=False,
+            ensemble_representations=True)
+
+
+class _MultimerIteration(hk.Module):
+    """A recycling iteration of modules_multimer.AlphaFold."""
+
+    def __init__(self, config, name='alphafold'):
+        super().__init__(name=name)
+        self.config = config
+        self.global_config = config.global_config
+
+    def __call__(self, batch, prev, key):
+        impl = modules_multimer.AlphaFoldIteration(
+            self.config, self.global_config)
+        return impl(
+            batch={**batch, **prev},
+            is_training=False,
+            safe_key=prng.SafeKey(key))
+
+
+def _initial_prev(
+    model_config: ml_collections.ConfigDict,
+    num_res: int,
+    multimer_mode: bool
+) -> Dict[str, jnp.ndarray]:
+    """Returns the zero inputs of the first recycling iteration."""
+    emb_config = model_config.embeddings_and_evoformer
+    prev = {}
+    if not multimer_mode or emb_config.recycle_pos:
+        prev['prev_pos'] = jnp.zeros(
+            [num_res, residue_constants.atom_type_num, 3])
+    if not multimer_mode or emb_config.recycle_features:
+        prev['prev_msa_first_row'] = jnp.zeros(
+            [num_res, emb_config.msa_channel])
+        prev['prev_pair'] = jnp.zeros(
+            [num_res, num_res, emb_config.pair_channel])
+    return prev
+
+
+def _next_prev(
+    result: Mapping[str, Any],
+    prev: Mapping[str, Any]
+) -> Dict[str, Any]:
+    """Returns the inputs of the next iteration from the outputs of one."""
+    outputs = {
+        'prev_pos': result['structure_module']['final_atom_positions'],
+        'prev_msa_first_row': result['representations']['msa_first_row'],
+        'prev_pair': result['representations']['pair'],
+    }
+    return {name: outputs[name] for name in prev}
+
+
+def _multimer_keys(
+    rng: jnp.ndarray,
+    num_recycle: int,
+    resample_msa_in_recycling: bool
+) -> List[jnp.ndarray]:
+    """Returns the keys of the iterations of modules_multimer.AlphaFold."""
+    # The first key the full model takes from its RNG sequence.
+    safe_key = prng.SafeKey(hk.transform(hk.next_rng_key).apply({}, rng))
+    keys = []
+    for _ in range(num_recycle):
+        if resample_msa_in_recycling:
+            safe_key, iteration_key = safe_key.split()
+        else:
+            safe_key, iteration_key = safe_key.duplicate()
+        keys.append(iteration_key.get())
+    # The extra iteration after the recycling loop.
+    keys.append(safe_key.get())
+    return keys
+
+
+def _ca_distances(result: Mapping[str, Any], num_res: int) -> np.ndarray:
+    positions = np.asarray(
+        result['structure_module']['final_atom_positions'])[:num_res]
+    ca_positions = positions[:, residue_constants.atom_order['CA']]
+    return np.sqrt(np.sum(
+        (ca_positions[:, None] - ca_positions[None, :]) ** 2, axis=-1))
+
+
+def _plddt(result: Mapping[str, Any], num_res: int) -> np.ndarray:
+    return confidence.compute_plddt(
+        np.asarray(result['predicted_lddt']['logits'])[:num_res])
+
+
+class AdaptiveRecycling:
+    """Stops recycling once the predicted structure stops changing.
+
+    After every recycling iteration, the change of the structure is the
+    root mean square change of the distances between C-alpha atoms, in
+    Angstroms, and the change of confidence is the mean absolute change of
+    pLDDT. Recycling stops when the structure changes by less than the
+    tolerance or, if a pLDDT tolerance is given, pLDDT changes by less than
+    that. At most max_recycles iterations are run after the first one. If
+    not set, the number of recycles of the model config is the maximum.
+    """
+
+    def __init__(self,
+                 tolerance: float = 0.5,
+                 plddt_tolerance: Optional[float] = None,
+                 max_recycles: Optional[int] = None):
+        self.tolerance = tolerance
+        self.plddt_tolerance = plddt_tolerance
+        self.max_recycles = max_recycles
+
+    def params(self) -> Dict[str, Any]:
+        return {
+            'tolerance': self.tolerance,
+            'plddt_tolerance': self.plddt_tolerance,
+            'max_recycles': self.max_recycles,
+        }
+
+    def configure(self, model_config: ml_collections.ConfigDict):
+        """Sets the number of recycles of a model config to the maximum.
+
+        Monomer features hold inputs for every recycling iteration, so the
+        config must be set before the features are processed.
+        """
+        if self.max_recycles is None:
+            return
+        model_config.model.num_recycle = self.max_recycles
+        if not model_config.model.global_config.multimer_mode:
+            model_config.data.common.num_recycle = self.max_recycles
+
+    def _converged(
+        self,
+        result: Mapping[str, Any],
+        previous: Optional[Tuple[np.ndarray, np.ndarray]],
+        num_res: int,
+        changes: Dict[str, List[float]]
+    ) -> Tuple[bool, Tuple[np.ndarray, np.ndarray]]:
+        current = (_ca_distances(result, num_res), _plddt(result, num_res))
+        if previous is None:
+            return False, current
+        ca_change = float(np.sqrt(np.mean((current[0] - previous[0]) ** 2)))
+        plddt_change = float(np.mean(np.abs(current[1] - previous[1])))
+        changes['ca_distance'].append(ca_change)
+        changes['plddt'].append(plddt_change)
+        converged = ca_change < self.tolerance or (
+            self.plddt_tolerance is not None
+            and plddt_change < self.plddt_tolerance)
+        return converged, current
+
+    def run(
+        self,
+        model_runner: model.RunModel,
+        processed_features: Mapping[str, Any],
+        random_seed: int,
+        num_res: int,
+        timings: Optional[Dict[str, float]] = None,
+        stats: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """Runs recycling iterations of a model until they converge.
+
+        Returns the outputs of the last iteration. num_res is the number of
+        residues without padding. If a stats dict is given, the number of
+        recycles and the changes after every recycle are added to it.
+        """
+        model_config = model_runner.config.model
+        multimer_mode = model_runner.multimer_mode
+        num_recycle = model_config.num_recycle
+        if self.max_recycles is not None:
+            num_recycle = min(num_recycle, self.max_recycles)
+        model_runner.init_params(processed_features)
+        iteration_cls = _MultimerIteration if multimer_mode else _MonomerIteration
+
+        def iteration_fn(batch, prev, arg):
+            return iteration_cls(model_config)(batch, prev, arg)
+
+        apply = jax.jit(hk.transform(iteration_fn).apply)
+        padded_num_res = int(np.shape(processed_features['aatype'])[-1])
+        prev = _initial_prev(model_config, padded_num_res, multimer_mode)
+        rng = jax.random.PRNGKey(random_seed)
+        # Monomer iterations take the recycle index and multimer iterations
+        # the key of the iteration.
+        if multimer_mode:
+            iteration_args = _multimer_keys(
+                rng, num_recycle, model_config.resample_msa_in_recycling)
+        else:
+            iteration_args = [jnp.asarray(recycle_idx, dtype=jnp.int32)
+                              for recycle_idx in range(num_recycle + 1)]
+
+        shape_key = tuple(sorted(
+            (name, np.shape(value), str(np.asarray(value).dtype))
+            for name, value in processed_features.items()))
+        executables = _EXECUTABLES.setdefault(model_runner, {})
+        t_0 = time.time()
+        executable = executables.get(shape_key)
+        if executable is None:
+            executable = apply.lower(
+                model_runner.params, rng, processed_features, prev,
+                iteration_args[0]).compile()
+            executables[shape_key] = executable
+        compile_time = time.time() - t_0
+
+        t_0 = time.time()
+        changes = {'ca_distance': [], 'plddt': []}
+        previous = None
+        for recycle_idx in range(num_recycle + 1):
+            result = executable(
+                model_runner.params, rng, processed_features, prev,
+                iteration_args[recycle_idx])
+            converged, previous = self._converged(
+                result, previous, num_res, changes)
+            if converged or recycle_idx == num_recycle:
+                break
+            prev = _next_prev(result, prev)
+        del prev
+        # Like the full model, do not return the representations, which are
+        # only needed as inputs of the next iteration.
+        result = dict(result)
+        result.pop('representations', None)
+        jax.tree_map(lambda x: x.block_until_ready(), result)
+        execute_time = time.time() - t_0
+        logging.info('Stopped after %d of %d recycles, compile time %.1fs, '
+                     'execution time %.1fs', recycle_idx, num_recycle,
+                     compile_time, execute_time)
+
+        if timings is not None:
+            timings['compile'] = compile_time
+            timings['execute'] = execute_time
+        if stats is not None:
+            stats.update(self.params())
+            stats['num_recycles'] = recycle_idx
+            stats['max_recycles'] = num_recycle
+            stats['changes'] = changes
+        return result
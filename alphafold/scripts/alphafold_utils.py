@@ -14,13 +14,18 @@
 
 """Utility functions that encapsulate AlphaFold inference components."""
 
-import glob
+import collections
+import json
 import logging
+import multiprocessing
 import os
 import pickle
+import re
 import shutil
+import threading
 import time
-from typing import Dict, List, Mapping, Sequence, Tuple
+from concurrent import futures
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
 
 from alphafold.common import protein
 from alphafold.common import residue_constants
@@ -28,7 +33,6 @@ from alphafold.data import parsers
 from alphafold.data import pipeline
 from alphafold.data import pipeline_multimer
 from alphafold.data import templates
-from alphafold.data.pipeline import make_msa_features
 from alphafold.data.pipeline import make_sequence_features
 from alphafold.data.tools import hhblits
 from alphafold.data.tools import hhsearch
@@ -37,11 +41,36 @@ from alphafold.data.tools import jackhmmer
 from alphafold.model import config
 from alphafold.model import data
 from alphafold.model import model
+from alphafold.model.features import make_data_config
 from alphafold.relax import relax
 
 
 import numpy as np
 
+from adaptive_recycling import AdaptiveRecycling
+from artifact_writer import AsyncArtifactWriter
+import feature_io
+from feature_cache import FeatureCache
+from feature_io import LazyFeatures
+from jackhmmer_shards import ShardedJackhmmer
+from msa_cache import MsaCache
+from msa_features import make_msa_features
+from msa_scheduler import ConcurrentDataPipeline
+from msa_subsampling import MsaSubsampler
+from msa_utils import msa_file_stats
+from msa_utils import preprocess_stockholm_for_templates
+from params_store import ParamsStore
+import prediction_buckets
+import prediction_pool
+from prediction_buckets import ShapeBuckets
+from prediction_io import PredictionOutputPolicy
+from prediction_io import save_prediction_result
+from stage_profiler import ProfiledObject
+from stage_profiler import StageProfiler
+from template_store import StoreHhsearchHitFeaturizer
+from template_store import StoreHmmsearchHitFeaturizer
+from template_store import TemplateStore
+
 
 JACKHMMER_BINARY_PATH = shutil.which('jackhmmer')
 HHBLITS_BINARY_PATH = shutil.which('hhblits')
@@ -54,10 +83,28 @@ MAX_TEMPLATE_HITS = 20
 
 
 def _load_features(features_path: str) -> Dict[str, str]:
-    """Loads pickeled features."""
-    with open(features_path, 'rb') as f:
-        features = pickle.load(f)
-    return features
+    """Loads memory-mapped or pickeled features."""
+    return feature_io.load_features(features_path)
+
+
+def _select_raw_features(
+    raw_features: Mapping[str, Any],
+    model_runner: model.RunModel
+) -> Dict[str, Any]:
+    """Returns the raw features that a model runner processes.
+
+    Monomer models only use the features listed in their data config, so
+    other features are not read. Multimer models use all raw features.
+    """
+    if model_runner.multimer_mode:
+        return dict(raw_features)
+    num_res = int(raw_features['seq_length'][0])
+    _, feature_names = make_data_config(model_runner.config, num_res=num_res)
+    # The data pipeline saves integer deletion counts that are converted to
+    # the 'deletion_matrix' feature during processing.
+    feature_names = set(feature_names) | {'deletion_matrix_int'}
+    return {name: raw_features[name] for name in raw_features
+            if name in feature_names}
 
 
 def _read_msa(msa_path: str, msa_format: str) -> str:
@@ -92,8 +139,71 @@ def _read_template_features(template_features_path) -> Dict[str, str]:
     return template_features
 
 
-def run_data_pipeline(
-    fasta_path: str,
+def _chain_reuse_metadata(msa_output_path: str) -> Dict[str, Any]:
+    """Maps every chain to the chain whose features it reuses.
+
+    The multimer data pipeline processes every unique chain sequence once
+    and copies its features to the other chains with the same sequence.
+    """
+    with open(os.path.join(msa_output_path, 'chain_id_map.json')) as f:
+        chain_id_map = json.load(f)
+    source_chains = {}
+    chain_sources = {}
+    for chain_id, fasta_chain in chain_id_map.items():
+        chain_sources[chain_id] = source_chains.setdefault(
+            fasta_chain['sequence'], chain_id)
+    return {
+        'num_chains': len(chain_sources),
+        'num_unique_chains': len(source_chains),
+        'chain_sources': chain_sources,
+    }
+
+
+def _create_template_featurizer(
+    run_multimer_system: bool,
+    template_store_path: Optional[str],
+    **featurizer_args
+) -> templates.TemplateHitFeaturizer:
+    """Creates a template featurizer reading mmCIF files or a template store."""
+    if template_store_path:
+        template_store = TemplateStore(template_store_path)
+        if run_multimer_system:
+            return StoreHmmsearchHitFeaturizer(
+                template_store=template_store, **featurizer_args)
+        return StoreHhsearchHitFeaturizer(
+            template_store=template_store, **featurizer_args)
+    if run_multimer_system:
+        return templates.HmmsearchHitFeaturizer(**featurizer_args)
+    return templates.HhsearchHitFeaturizer(**featurizer_args)
+
+
+def _msa_search_params(runner: Any) -> Dict[str, Any]:
+    """Returns the settings of an MSA runner that change its results."""
+    param_names = ['n_iter', 'e_value', 'z_value', 'maxseq', 'realign_max',
+                   'maxfilt', 'min_prefilter_hits', 'all_seqs', 'alt', 'p',
+                   'z', 'filter_f1', 'filter_f2', 'filter_f3', 'incdom_e',
+                   'dom_e']
+    return {name: getattr(runner, name) for name in param_names
+            if hasattr(runner, name)}
+
+
+def _cache_msa_runner(
+    msa_cache: MsaCache,
+    runner: Any,
+    tool: str,
+    database_paths: List[str],
+    msa_format: str
+) -> Any:
+    """Routes the queries of an MSA runner through an MSA cache."""
+    return msa_cache.wrap(
+        runner=runner,
+        tool=tool,
+        database_paths=database_paths,
+        msa_format=msa_format,
+        params=_msa_search_params(runner))
+
+
+def create_data_pipeline(
     run_multimer_system: bool,
     uniref90_database_path: str,
     mgnify_database_path: str,
@@ -106,36 +216,41 @@ def run_data_pipeline(
     seqres_database_path: str,
     mmcif_path: str,
     max_template_date: str,
-    msa_output_path: str,
-    features_output_path: str,
     use_small_bfd: bool,
-) -> Dict[str, str]:
-    """Runs AlphaFold data pipeline."""
+    msa_cache: Optional[MsaCache] = None,
+    concurrent_msa_search: bool = False,
+    n_cpu: Optional[int] = None,
+    template_store_path: Optional[str] = None,
+    uniref90_shards_path: Optional[str] = None,
+    uniprot_shards_path: Optional[str] = None,
+    num_shard_workers: Optional[int] = None,
+    profiler: Optional[StageProfiler] = None,
+) -> Any:
+    """Creates an AlphaFold data pipeline with its searchers and featurizers.
+
+    If a profiler is given, the MSA searches, the template search and the
+    template featurization are recorded as separate stages.
+    """
     if run_multimer_system:
         template_searcher = hmmsearch.Hmmsearch(
             binary_path=HMMSEARCH_BINARY_PATH,
             hmmbuild_binary_path=HMMBUILD_BINARY_PATH,
             database_path=seqres_database_path)
-        template_featurizer = templates.HmmsearchHitFeaturizer(
-            mmcif_dir=mmcif_path,
-            max_template_date=max_template_date,
-            max_hits=MAX_TEMPLATE_HITS,
-            kalign_binary_path=KALIGN_BINARY_PATH,
-            release_dates_path=None,
-            obsolete_pdbs_path=obsolete_pdbs_path)
     else:
         template_searcher = hhsearch.HHSearch(
             binary_path=HHSEARCH_BINARY_PATH,
             databases=[pdb70_database_path])
-        template_featurizer = templates.HhsearchHitFeaturizer(
-            mmcif_dir=mmcif_path,
-            max_template_date=max_template_date,
-            max_hits=MAX_TEMPLATE_HITS,
-            kalign_binary_path=KALIGN_BINARY_PATH,
-            release_dates_path=None,
-            obsolete_pdbs_path=obsolete_pdbs_path)
-
-    monomer_data_pipeline = pipeline.DataPipeline(
+    template_featurizer = _create_template_featurizer(
+        run_multimer_system=run_multimer_system,
+        template_store_path=template_store_path,
+        mmcif_dir=mmcif_path,
+        max_template_date=max_template_date,
+        max_hits=MAX_TEMPLATE_HITS,
+        kalign_binary_path=KALIGN_BINARY_PATH,
+        release_dates_path=None,
+        obsolete_pdbs_path=obsolete_pdbs_path)
+
+    monomer_pipeline_args = dict(
         jackhmmer_binary_path=JACKHMMER_BINARY_PATH,
         hhblits_binary_path=HHBLITS_BINARY_PATH,
         uniref90_database_path=uniref90_database_path,
@@ -146,27 +261,159 @@ def run_data_pipeline(
         template_searcher=template_searcher,
         template_featurizer=template_featurizer,
         use_small_bfd=use_small_bfd)
+    if concurrent_msa_search:
+        monomer_data_pipeline = ConcurrentDataPipeline(
+            n_cpu=n_cpu, **monomer_pipeline_args)
+    else:
+        monomer_data_pipeline = pipeline.DataPipeline(**monomer_pipeline_args)
+
+    if uniref90_shards_path:
+        monomer_data_pipeline.jackhmmer_uniref90_runner = ShardedJackhmmer(
+            binary_path=JACKHMMER_BINARY_PATH,
+            shards_path=uniref90_shards_path,
+            n_cpu=monomer_data_pipeline.jackhmmer_uniref90_runner.n_cpu,
+            num_workers=num_shard_workers)
+        uniref90_database_paths = (
+            monomer_data_pipeline.jackhmmer_uniref90_runner.database_paths)
+    else:
+        uniref90_database_paths = [uniref90_database_path]
+
+    if msa_cache:
+        monomer_data_pipeline.jackhmmer_uniref90_runner = _cache_msa_runner(
+            msa_cache, monomer_data_pipeline.jackhmmer_uniref90_runner,
+            'jackhmmer', uniref90_database_paths, 'sto')
+        monomer_data_pipeline.jackhmmer_mgnify_runner = _cache_msa_runner(
+            msa_cache, monomer_data_pipeline.jackhmmer_mgnify_runner,
+            'jackhmmer', [mgnify_database_path], 'sto')
+        if use_small_bfd:
+            monomer_data_pipeline.jackhmmer_small_bfd_runner = _cache_msa_runner(
+                msa_cache, monomer_data_pipeline.jackhmmer_small_bfd_runner,
+                'jackhmmer', [small_bfd_database_path], 'sto')
+        else:
+            monomer_data_pipeline.hhblits_bfd_uniclust_runner = _cache_msa_runner(
+                msa_cache, monomer_data_pipeline.hhblits_bfd_uniclust_runner,
+                'hhblits', [bfd_database_path, uniclust30_database_path], 'a3m')
+
+    if profiler:
+        # The searches of the concurrent pipeline run in worker processes
+        # and are profiled by the pipeline itself.
+        if not concurrent_msa_search:
+            monomer_data_pipeline.jackhmmer_uniref90_runner = ProfiledObject(
+                monomer_data_pipeline.jackhmmer_uniref90_runner, profiler,
+                {'query': 'jackhmmer_uniref90'})
+            monomer_data_pipeline.jackhmmer_mgnify_runner = ProfiledObject(
+                monomer_data_pipeline.jackhmmer_mgnify_runner, profiler,
+                {'query': 'jackhmmer_mgnify'})
+            if use_small_bfd:
+                monomer_data_pipeline.jackhmmer_small_bfd_runner = ProfiledObject(
+                    monomer_data_pipeline.jackhmmer_small_bfd_runner, profiler,
+                    {'query': 'jackhmmer_small_bfd'})
+            else:
+                monomer_data_pipeline.hhblits_bfd_uniclust_runner = ProfiledObject(
+                    monomer_data_pipeline.hhblits_bfd_uniclust_runner, profiler,
+                    {'query': 'hhblits_bfd_uniclust'})
+        monomer_data_pipeline.template_searcher = ProfiledObject(
+            monomer_data_pipeline.template_searcher, profiler,
+            {'query': 'template_search'})
+        monomer_data_pipeline.template_featurizer = ProfiledObject(
+            monomer_data_pipeline.template_featurizer, profiler,
+            {'get_templates': 'template_featurization'})
 
     if run_multimer_system:
         data_pipeline = pipeline_multimer.DataPipeline(
             monomer_data_pipeline=monomer_data_pipeline,
             jackhmmer_binary_path=JACKHMMER_BINARY_PATH,
             uniprot_database_path=uniprot_database_path)
+        if uniprot_shards_path:
+            data_pipeline._uniprot_msa_runner = ShardedJackhmmer(
+                binary_path=JACKHMMER_BINARY_PATH,
+                shards_path=uniprot_shards_path,
+                n_cpu=data_pipeline._uniprot_msa_runner.n_cpu,
+                num_workers=num_shard_workers)
+            uniprot_database_paths = (
+                data_pipeline._uniprot_msa_runner.database_paths)
+        else:
+            uniprot_database_paths = [uniprot_database_path]
+        if msa_cache:
+            data_pipeline._uniprot_msa_runner = _cache_msa_runner(
+                msa_cache, data_pipeline._uniprot_msa_runner,
+                'jackhmmer', uniprot_database_paths, 'sto')
+        if profiler:
+            data_pipeline._uniprot_msa_runner = ProfiledObject(
+                data_pipeline._uniprot_msa_runner, profiler,
+                {'query': 'jackhmmer_uniprot'})
     else:
         data_pipeline = monomer_data_pipeline
 
-    feature_dict = data_pipeline.process(
-        input_fasta_path=fasta_path,
-        msa_output_dir=msa_output_path
-    )
+    return data_pipeline
 
-    with open(features_output_path, 'wb') as f:
-        pickle.dump(feature_dict, f, protocol=4)
 
-    msas_metadata = {}
-    paths = glob.glob(os.path.join(msa_output_path, '**'), recursive=True)
-    paths = [path for path in paths if os.path.isfile(path)]
+def _restore_cached_target(
+    feature_cache: FeatureCache,
+    cache_key: str,
+    msa_output_path: str,
+    features_output_path: str,
+    profiler: StageProfiler,
+    features_format: str = 'pickle',
+) -> Optional[Tuple[Mapping[str, Any], Dict[str, Any]]]:
+    """Materializes the features and MSAs of a cached target.
+
+    Returns the features and the metadata of the run that produced them or
+    None on a cache miss.
+    """
+    with profiler.stage('feature_cache'):
+        msas_metadata = feature_cache.get(
+            key=cache_key,
+            msa_output_path=msa_output_path,
+            features_output_path=features_output_path,
+            features_format=features_format)
+    if msas_metadata is None:
+        return None
+    msas_metadata['feature_cache'] = {'status': 'hit', 'key': cache_key}
+    msas_metadata['stage_profile'] = profiler.pop_report()
+    return feature_io.load_features(features_output_path), msas_metadata
+
+
+def _process_fasta(
+    data_pipeline: Any,
+    fasta_path: str,
+    run_multimer_system: bool,
+    msa_output_path: str,
+    features_output_path: str,
+    profiler: Optional[StageProfiler] = None,
+    features_format: str = 'pickle',
+    msa_subsampler: Optional[MsaSubsampler] = None,
+    feature_cache: Optional[FeatureCache] = None,
+    cache_key: Optional[str] = None,
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Runs a data pipeline on a FASTA file and saves features and MSAs.
+
+    If an MSA subsampler is given, the depth of the MSA features of monomer
+    targets is capped before they are saved. If a feature cache is given,
+    the outputs are stored in it under the cache key.
+    """
+    profiler = profiler or StageProfiler()
+    with profiler.stage('data_pipeline'):
+        feature_dict = data_pipeline.process(
+            input_fasta_path=fasta_path,
+            msa_output_dir=msa_output_path
+        )
+
+    msa_subsampling_stats = None
+    if msa_subsampler and run_multimer_system:
+        logging.warning('MSA subsampling is not supported for multimer '
+                        'targets, skipping')
+        msa_subsampling_stats = dict(msa_subsampler.params(), skipped=True)
+    elif msa_subsampler:
+        with profiler.stage('msa_subsampling'):
+            feature_dict, msa_subsampling_stats = (
+                msa_subsampler.subsample_features(feature_dict))
+
+    with profiler.stage('save_features'):
+        feature_io.save_features(
+            feature_dict, features_output_path, features_format)
 
+    msas_metadata = {}
     if run_multimer_system:
         folders = [os.path.join(msa_output_path, folder)
                    for folder in os.listdir(msa_output_path)
@@ -178,73 +425,520 @@ def run_data_pipeline(
     else:
         paths = [os.path.join(msa_output_path, file)
                  for file in os.listdir(msa_output_path)]
+    msa_stats = {}
     for file in paths:
-        with open(file, 'r') as f:
-            artifact = f.read()
-        file_format = file.split('.')[-1]
-        if file_format == 'sto':
-            artifact = parsers.parse_stockholm(artifact)
-        elif file_format == 'a3m':
-            artifact = parsers.parse_a3m(artifact)
-        elif file_format == 'hhr':
-            artifact = parsers.parse_hhr(artifact)
-        else:
-            raise ValueError('Unknown artifact type')
-        msas_metadata[os.path.join(
-            file.split(os.sep)[-2], file.split(os.sep)[-1])] = len(artifact)
+        artifact_name = os.path.join(
+            file.split(os.sep)[-2], file.split(os.sep)[-1])
+        msa_stats[artifact_name] = msa_file_stats(file)
+        msas_metadata[artifact_name] = msa_stats[artifact_name]['num_sequences']
+    msas_metadata['msa_stats'] = msa_stats
+    if msa_subsampling_stats:
+        msas_metadata['msa_subsampling'] = msa_subsampling_stats
+
+    if run_multimer_system:
+        msas_metadata['chain_reuse'] = _chain_reuse_metadata(msa_output_path)
+
+    monomer_data_pipeline = getattr(
+        data_pipeline, '_monomer_data_pipeline', data_pipeline)
+    if isinstance(monomer_data_pipeline, ConcurrentDataPipeline):
+        search_stats = {}
+        for msa_dir in list(monomer_data_pipeline.search_stats):
+            relative_dir = os.path.relpath(msa_dir, msa_output_path)
+            if not relative_dir.startswith(os.pardir):
+                search_stats[relative_dir] = (
+                    monomer_data_pipeline.search_stats.pop(msa_dir))
+        msas_metadata['msa_search_stats'] = search_stats
+
+    if feature_cache:
+        with profiler.stage('feature_cache'):
+            feature_cache.put(
+                key=cache_key,
+                msa_output_path=msa_output_path,
+                features_output_path=features_output_path,
+                features_format=features_format,
+                metadata=msas_metadata)
+        msas_metadata['feature_cache'] = {'status': 'miss', 'key': cache_key}
+
+    msas_metadata['stage_profile'] = profiler.pop_report()
 
     return feature_dict, msas_metadata
 
 
-def predict(
-    model_features_path: str,
+def run_data_pipeline(
+    fasta_path: str,
+    run_multimer_system: bool,
+    uniref90_database_path: str,
+    mgnify_database_path: str,
+    bfd_database_path: str,
+    small_bfd_database_path: str,
+    uniclust30_database_path: str,
+    uniprot_database_path: str,
+    pdb70_database_path: str,
+    obsolete_pdbs_path: str,
+    seqres_database_path: str,
+    mmcif_path: str,
+    max_template_date: str,
+    msa_output_path: str,
+    features_output_path: str,
+    use_small_bfd: bool,
+    msa_cache: Optional[MsaCache] = None,
+    concurrent_msa_search: bool = False,
+    n_cpu: Optional[int] = None,
+    template_store_path: Optional[str] = None,
+    uniref90_shards_path: Optional[str] = None,
+    uniprot_shards_path: Optional[str] = None,
+    num_shard_workers: Optional[int] = None,
+    features_format: str = 'pickle',
+    msa_subsampler: Optional[MsaSubsampler] = None,
+    feature_cache: Optional[FeatureCache] = None,
+) -> Dict[str, str]:
+    """Runs AlphaFold data pipeline.
+
+    If a feature cache is given and holds the target, the cached outputs are
+    materialized and no searches are run.
+    """
+    profiler = StageProfiler()
+    cache_key = None
+    if feature_cache:
+        cache_key = feature_cache.make_key(fasta_path)
+        cached_target = _restore_cached_target(
+            feature_cache=feature_cache,
+            cache_key=cache_key,
+            msa_output_path=msa_output_path,
+            features_output_path=features_output_path,
+            profiler=profiler,
+            features_format=features_format)
+        if cached_target:
+            return cached_target
+
+    data_pipeline = create_data_pipeline(
+        run_multimer_system=run_multimer_system,
+        uniref90_database_path=uniref90_database_path,
+        mgnify_database_path=mgnify_database_path,
+        bfd_database_path=bfd_database_path,
+        small_bfd_database_path=small_bfd_database_path,
+        uniclust30_database_path=uniclust30_database_path,
+        uniprot_database_path=uniprot_database_path,
+        pdb70_database_path=pdb70_database_path,
+        obsolete_pdbs_path=obsolete_pdbs_path,
+        seqres_database_path=seqres_database_path,
+        mmcif_path=mmcif_path,
+        max_template_date=max_template_date,
+        use_small_bfd=use_small_bfd,
+        msa_cache=msa_cache,
+        concurrent_msa_search=concurrent_msa_search,
+        n_cpu=n_cpu,
+        template_store_path=template_store_path,
+        uniref90_shards_path=uniref90_shards_path,
+        uniprot_shards_path=uniprot_shards_path,
+        num_shard_workers=num_shard_workers,
+        profiler=profiler)
+
+    return _process_fasta(
+        data_pipeline=data_pipeline,
+        fasta_path=fasta_path,
+        run_multimer_system=run_multimer_system,
+        msa_output_path=msa_output_path,
+        features_output_path=features_output_path,
+        profiler=profiler,
+        features_format=features_format,
+        msa_subsampler=msa_subsampler,
+        feature_cache=feature_cache,
+        cache_key=cache_key)
+
+
+def split_fasta_targets(
+    fasta_path: str,
+    output_path: str
+) -> List[Tuple[str, str]]:
+    """Writes every record of a multi-record FASTA file to its own file.
+
+    Returns (target name, FASTA path) pairs. Target names are derived from
+    the first word of the record descriptions.
+    """
+    with open(fasta_path) as f:
+        sequences, descriptions = parsers.parse_fasta(f.read())
+    targets = []
+    target_names = set()
+    for index, (sequence, description) in enumerate(
+            zip(sequences, descriptions)):
+        words = description.split()
+        target_name = re.sub(r'[^A-Za-z0-9_.-]', '_', words[0]) if words else ''
+        if not target_name or target_name in target_names:
+            target_name = f'{target_name or "target"}_{index}'
+        target_names.add(target_name)
+        target_path = os.path.join(output_path, target_name)
+        os.makedirs(target_path, exist_ok=True)
+        target_fasta_path = os.path.join(target_path, 'sequence.fasta')
+        with open(target_fasta_path, 'w') as f:
+            f.write(f'>{description}\n{sequence}\n')
+        targets.append((target_name, target_fasta_path))
+    return targets
+
+
+def run_data_pipeline_batch(
+    targets: Sequence[Tuple[str, str]],
+    output_path: str,
+    num_workers: int,
+    run_multimer_system: bool,
+    features_format: str = 'pickle',
+    msa_subsampler: Optional[MsaSubsampler] = None,
+    feature_cache: Optional[FeatureCache] = None,
+    **pipeline_args,
+) -> List[Dict[str, Any]]:
+    """Runs AlphaFold data pipeline on many targets in one process.
+
+    Each worker thread builds its data pipeline once and reuses its searchers
+    and featurizers for all the targets it processes. The features, MSAs and
+    metadata of a target are written to a subdirectory of the output path
+    named after the target. Targets found in the feature cache are
+    materialized from it. A failed target is recorded in the returned
+    manifest and does not stop the batch.
+    """
+    local = threading.local()
+
+    def process_target(target: Tuple[str, str]) -> Dict[str, Any]:
+        target_name, fasta_path = target
+        target_path = os.path.join(output_path, target_name)
+        entry = {
+            'target': target_name,
+            'fasta_path': fasta_path,
+            'msas_path': os.path.join(target_path, 'msas'),
+            'features_path': os.path.join(
+                target_path, feature_io.FEATURES_FILE_NAMES[features_format]),
+            'metadata_path': os.path.join(target_path, 'data_pipeline.json'),
+        }
+        t_0 = time.time()
+        try:
+            if not hasattr(local, 'profiler'):
+                local.profiler = StageProfiler()
+            os.makedirs(entry['msas_path'], exist_ok=True)
+            # Drops stages left over from a failed target.
+            local.profiler.pop_report()
+            cache_key = None
+            cached_target = None
+            if feature_cache:
+                cache_key = feature_cache.make_key(fasta_path)
+                cached_target = _restore_cached_target(
+                    feature_cache=feature_cache,
+                    cache_key=cache_key,
+                    msa_output_path=entry['msas_path'],
+                    features_output_path=entry['features_path'],
+                    profiler=local.profiler,
+                    features_format=features_format)
+            if cached_target:
+                _, msas_metadata = cached_target
+            else:
+                if not hasattr(local, 'data_pipeline'):
+                    local.data_pipeline = create_data_pipeline(
+                        run_multimer_system=run_multimer_system,
+                        profiler=local.profiler,
+                        **pipeline_args)
+                _, msas_metadata = _process_fasta(
+                    data_pipeline=local.data_pipeline,
+                    fasta_path=fasta_path,
+                    run_multimer_system=run_multimer_system,
+                    msa_output_path=entry['msas_path'],
+                    features_output_path=entry['features_path'],
+                    profiler=local.profiler,
+                    features_format=features_format,
+                    msa_subsampler=msa_subsampler,
+                    feature_cache=feature_cache,
+                    cache_key=cache_key)
+            if feature_cache:
+                entry['feature_cache'] = msas_metadata['feature_cache']['status']
+            with open(entry['metadata_path'], 'w') as f:
+                json.dump(msas_metadata, f, indent=4)
+            entry['status'] = 'succeeded'
+        except Exception as e:
+            logging.exception('Data pipeline failed on target %s', target_name)
+            entry['status'] = 'failed'
+            entry['error'] = str(e)
+        entry['elapsed_time'] = time.time() - t_0
+        logging.info('Target %s %s in %.1fs', target_name, entry['status'],
+                     entry['elapsed_time'])
+        return entry
+
+    with futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        manifest = list(executor.map(process_target, targets))
+
+    return manifest
+
+
+def create_model_runner(
     model_params_path: str,
     model_name: str,
     num_ensemble: int,
     run_multimer_system: bool,
-    random_seed: int,
-    raw_prediction_path: str,
-    unrelaxed_protein_path: str,
-) -> Mapping[str, str]:
-    """Runs inference on an AlphaFold model."""
+    params_store: Optional[ParamsStore] = None,
+    recycling: Optional[AdaptiveRecycling] = None,
+) -> model.RunModel:
+    """Creates a model runner with loaded parameters.
+
+    If a parameter store is given, the parameters are mapped from it. If
+    adaptive recycling is given, the number of recycles of the model is set
+    to its maximum.
+    """
 
     model_config = config.model_config(model_name)
     if run_multimer_system:
         model_config.model.num_ensemble_eval = num_ensemble
     else:
-        model_config.data.eval.num_ensemble_eval = num_ensemble
+        model_config.data.eval.num_ensemble = num_ensemble
+    if recycling:
+        recycling.configure(model_config)
 
-    model_params = data.get_model_haiku_params(
-        model_name=model_name, data_dir=model_params_path)
-    model_runner = model.RunModel(model_config, model_params)
+    if params_store:
+        model_params = params_store.load(model_name, model_params_path)
+    else:
+        model_params = data.get_model_haiku_params(
+            model_name=model_name, data_dir=model_params_path)
+    return model.RunModel(model_config, model_params)
 
-    features = _load_features(model_features_path)
-    processed_feature_dict = model_runner.process_features(
-        raw_features=features,
-        random_seed=random_seed)
 
-    prediction_result = model_runner.predict(
-        feat=processed_feature_dict,
-        random_seed=random_seed)
+def predict(
+    model_features_path: str,
+    model_params_path: str,
+    model_name: str,
+    num_ensemble: int,
+    run_multimer_system: bool,
+    random_seed: int,
+    raw_prediction_path: str,
+    unrelaxed_protein_path: str,
+    output_policy: Optional[PredictionOutputPolicy] = None,
+    metadata: Optional[Dict[str, Any]] = None,
+    model_runner: Optional[model.RunModel] = None,
+    shape_buckets: Optional[ShapeBuckets] = None,
+    params_store: Optional[ParamsStore] = None,
+    recycling: Optional[AdaptiveRecycling] = None,
+    artifact_writer: Optional[AsyncArtifactWriter] = None,
+) -> Mapping[str, str]:
+    """Runs inference on an AlphaFold model.
+
+    The raw prediction result is saved under the output policy. If a metadata
+    dict is given, stats of the run are added to it. A model runner created
+    earlier with create_model_runner can be passed to skip loading the model
+    and to reuse its compiled functions. If shape buckets are given, the
+    features are padded to the bucket shapes and the outputs are un-padded.
+    If adaptive recycling is given, recycling stops once the structure
+    converges and the number of recycles is added to the metadata. A model
+    runner passed in must then be created with the same adaptive recycling.
+    If an artifact writer is given, the result and the unrelaxed protein
+    are written in the background and the output stats are added to the
+    metadata once the result is written. The caller flushes the writer.
+    """
+
+    if model_runner is None:
+        model_runner = create_model_runner(
+            model_params_path=model_params_path,
+            model_name=model_name,
+            num_ensemble=num_ensemble,
+            run_multimer_system=run_multimer_system,
+            params_store=params_store,
+            recycling=recycling)
 
-    with open(raw_prediction_path, 'wb') as f:
-        pickle.dump(prediction_result, f, protocol=4)
+    timings = {}
+    t_0 = time.time()
+    # Raw features are read on first access and released once processed.
+    features = LazyFeatures(model_features_path)
+    processed_feature_dict, shape = prediction_buckets.process_features(
+        model_runner=model_runner,
+        raw_features=_select_raw_features(features, model_runner),
+        random_seed=random_seed,
+        shape_buckets=shape_buckets)
+    timings['process_features'] = time.time() - t_0
+    if metadata is not None:
+        metadata['touched_feature_keys'] = list(features.touched_keys)
+        metadata['untouched_feature_keys'] = [
+            key for key in features if key not in features.touched_keys]
+    features.release()
+    del features
+
+    recycling_stats = {}
+    prediction_result = prediction_buckets.run_model(
+        model_runner=model_runner,
+        processed_features=processed_feature_dict,
+        random_seed=random_seed,
+        shape=shape,
+        timings=timings,
+        recycling=recycling,
+        recycling_stats=recycling_stats)
+
+    if artifact_writer:
+        output_stats = {}
+        artifact_writer.save_prediction_result(
+            prediction_result, raw_prediction_path, output_policy,
+            stats=output_stats)
+    else:
+        output_stats = save_prediction_result(
+            prediction_result, raw_prediction_path, output_policy)
+    if metadata is not None:
+        metadata['raw_prediction_output'] = output_stats
+        metadata['timings'] = timings
+        metadata['shape'] = shape
+        if shape_buckets:
+            metadata['shape_buckets'] = shape_buckets.params()
+        if recycling:
+            metadata['recycling'] = recycling_stats
 
     plddt = prediction_result['plddt']
     plddt_b_factors = np.repeat(
         plddt[:, None], residue_constants.atom_type_num, axis=-1)
     unrelaxed_structure = protein.from_prediction(
-        features=processed_feature_dict,
+        features=prediction_buckets.structure_features(
+            processed_feature_dict, shape, model_runner.multimer_mode),
         result=prediction_result,
         b_factors=plddt_b_factors,
         remove_leading_feature_dimension=not model_runner.multimer_mode)
     unrelaxed_pdbs = protein.to_pdb(unrelaxed_structure)
-    with open(unrelaxed_protein_path, 'w') as f:
-        f.write(unrelaxed_pdbs)
+    _write_pdb(unrelaxed_pdbs, unrelaxed_protein_path, artifact_writer)
 
     return prediction_result
 
 
+def _num_res(features_path: str) -> int:
+    """Returns the number of residues of a features file."""
+    features = LazyFeatures(features_path)
+    num_res = int(np.ravel(features['seq_length'])[0])
+    features.release()
+    return num_res
+
+
+def _write_pending_metadata(
+    artifact_writer: AsyncArtifactWriter,
+    pending_metadata: List[Tuple[Dict[str, Any], Dict[str, Any]]]
+):
+    """Flushes the writer and writes the metadata of written predictions.
+
+    Predictions whose outputs failed to write are marked failed.
+    """
+    try:
+        artifact_writer.flush()
+    except RuntimeError:
+        logging.exception('Failed to write prediction outputs')
+    for entry, prediction_metadata in pending_metadata:
+        # The output stats are only added once the result is written.
+        if (not prediction_metadata['raw_prediction_output']
+                or not os.path.exists(entry['unrelaxed_protein_path'])):
+            entry['status'] = 'failed'
+            entry['error'] = 'Failed to write prediction outputs'
+            continue
+        with open(entry['metadata_path'], 'w') as f:
+            json.dump(prediction_metadata, f, indent=4)
+
+
+def predict_batch(
+    targets: Sequence[Tuple[str, str]],
+    output_path: str,
+    model_params_path: str,
+    model_names: Sequence[str],
+    num_ensemble: int,
+    run_multimer_system: bool,
+    random_seed: int,
+    prediction_index: int = 0,
+    output_policy: Optional[PredictionOutputPolicy] = None,
+    shape_buckets: Optional[ShapeBuckets] = None,
+    params_store: Optional[ParamsStore] = None,
+    recycling: Optional[AdaptiveRecycling] = None,
+    artifact_writer: Optional[AsyncArtifactWriter] = None,
+) -> List[Dict[str, Any]]:
+    """Runs predictions of many targets with one model runner per model.
+
+    Targets are given as (name, features path) pairs and predicted in order
+    of length, so consecutive predictions can reuse compiled model
+    functions. The raw prediction, unrelaxed protein and metadata of a
+    target are written to a subdirectory of the output path named after the
+    target. A failed prediction is recorded in the returned manifest and
+    does not stop the batch. If an artifact writer is given, the outputs are
+    written in the background and the metadata of the predictions of a model
+    is written once the writer is flushed after its last target.
+    """
+    lengths = {}
+    for target_name, features_path in targets:
+        try:
+            lengths[target_name] = _num_res(features_path)
+        except Exception:
+            # The prediction of the target fails and is recorded later.
+            logging.exception('Cannot read features of target %s', target_name)
+            lengths[target_name] = 0
+    ordered_targets = sorted(targets, key=lambda target: lengths[target[0]])
+
+    manifest = []
+    pending_metadata = []
+    for model_name in model_names:
+        model_runner = create_model_runner(
+            model_params_path=model_params_path,
+            model_name=model_name,
+            num_ensemble=num_ensemble,
+            run_multimer_system=run_multimer_system,
+            params_store=params_store,
+            recycling=recycling)
+        prediction_name = f'{model_name}_pred_{prediction_index}'
+        for target_name, features_path in ordered_targets:
+            target_path = os.path.join(output_path, target_name)
+            entry = {
+                'target': target_name,
+                'features_path': features_path,
+                'num_res': lengths[target_name],
+                'model_name': model_name,
+                'raw_prediction_path': os.path.join(
+                    target_path, f'result_{prediction_name}.pkl'),
+                'unrelaxed_protein_path': os.path.join(
+                    target_path, f'unrelaxed_{prediction_name}.pdb'),
+                'metadata_path': os.path.join(
+                    target_path, f'metadata_{prediction_name}.json'),
+            }
+            t_0 = time.time()
+            try:
+                os.makedirs(target_path, exist_ok=True)
+                prediction_stats = {}
+                prediction_result = predict(
+                    model_features_path=features_path,
+                    model_params_path=model_params_path,
+                    model_name=model_name,
+                    num_ensemble=num_ensemble,
+                    run_multimer_system=run_multimer_system,
+                    random_seed=random_seed,
+                    raw_prediction_path=entry['raw_prediction_path'],
+                    unrelaxed_protein_path=entry['unrelaxed_protein_path'],
+                    output_policy=output_policy,
+                    metadata=prediction_stats,
+                    model_runner=model_runner,
+                    shape_buckets=shape_buckets,
+                    recycling=recycling,
+                    artifact_writer=artifact_writer)
+                entry['ranking_confidence'] = float(
+                    prediction_result['ranking_confidence'])
+                prediction_metadata = {
+                    'model_name': model_name,
+                    'prediction_index': prediction_index,
+                    'random_seed': random_seed,
+                    'ranking_confidence': entry['ranking_confidence'],
+                    **prediction_stats,
+                }
+                if artifact_writer:
+                    pending_metadata.append((entry, prediction_metadata))
+                else:
+                    with open(entry['metadata_path'], 'w') as f:
+                        json.dump(prediction_metadata, f, indent=4)
+                entry['status'] = 'succeeded'
+            except Exception as e:
+                logging.exception('Prediction %s failed on target %s',
+                                  prediction_name, target_name)
+                entry['status'] = 'failed'
+                entry['error'] = str(e)
+            entry['elapsed_time'] = time.time() - t_0
+            logging.info('Target %s %s with %s in %.1fs', target_name,
+                         entry['status'], model_name, entry['elapsed_time'])
+            manifest.append(entry)
+        del model_runner
+        if artifact_writer:
+            _write_pending_metadata(artifact_writer, pending_metadata)
+            pending_metadata = []
+
+    return manifest
+
+
 def relax_protein(
     unrelaxed_protein_path: str,
     relaxed_protein_path: str,
@@ -277,6 +971,338 @@ def relax_protein(
     return relaxed_protein_pdb
 
 
+def _processed_features_key(model_runner: Any, random_seed: int) -> str:
+    """Returns a key shared by runners that process features identically.
+
+    Multimer runners use the raw features as they are, so one key covers all
+    of them. Monomer processing samples MSA clusters and masks MSA positions
+    with the random seed, so the key holds the data config and the seed.
+    """
+    if model_runner.multimer_mode:
+        return 'raw'
+    return json.dumps([
+        json.loads(model_runner.config.data.to_json_best_effort(sort_keys=True)),
+        random_seed,
+    ], sort_keys=True)
+
+
+def _predict_and_save(
+    model_name: str,
+    model_runner: model.RunModel,
+    random_seed: int,
+    processed_features: Mapping[str, Any],
+    shape: Mapping[str, int],
+    raw_prediction_path: str,
+    unrelaxed_protein_path: str,
+    output_policy: Optional[PredictionOutputPolicy],
+    timings: Dict[str, float],
+    recycling: Optional[AdaptiveRecycling] = None,
+    artifact_writer: Optional[AsyncArtifactWriter] = None
+) -> Tuple[Any, protein.Protein, Dict[str, Any], Optional[int]]:
+    """Runs a prediction and saves its result and unrelaxed protein.
+
+    Returns the ranking confidence, the unrelaxed protein, the output stats
+    of the result and, with adaptive recycling, the number of recycles. If
+    an artifact writer is given, the outputs are written in the background
+    and the output stats are filled in once the result is written.
+    """
+    t_0 = time.time()
+    model_timings = {}
+    recycling_stats = {}
+    prediction_result = prediction_buckets.run_model(
+        model_runner=model_runner,
+        processed_features=processed_features,
+        random_seed=random_seed,
+        shape=shape,
+        timings=model_timings,
+        recycling=recycling,
+        recycling_stats=recycling_stats)
+    t_diff = time.time() - t_0
+    timings[f'predict_and_compile_{model_name}'] = t_diff
+    timings[f'compile_{model_name}'] = model_timings['compile']
+    timings[f'execute_{model_name}'] = model_timings['execute']
+    logging.info(
+        'Total JAX model %s predict time (includes compilation time): %.1fs',
+        model_name, t_diff)
+
+    plddt = prediction_result['plddt']
+
+    # Save the model outputs.
+    result_output_path = os.path.join(
+        raw_prediction_path, f'result_{model_name}.pkl')
+    if artifact_writer:
+        output_stats = {}
+        artifact_writer.save_prediction_result(
+            prediction_result, result_output_path, output_policy,
+            stats=output_stats)
+    else:
+        output_stats = save_prediction_result(
+            prediction_result, result_output_path, output_policy)
+
+    # Add the predicted LDDT in the b-factor column.
+    # Note that higher predicted LDDT value means higher model confidence.
+    plddt_b_factors = np.repeat(
+        plddt[:, None], residue_constants.atom_type_num, axis=-1)
+    unrelaxed_protein = protein.from_prediction(
+        features=prediction_buckets.structure_features(
+            processed_features, shape, model_runner.multimer_mode),
+        result=prediction_result,
+        b_factors=plddt_b_factors,
+        remove_leading_feature_dimension=not model_runner.multimer_mode)
+
+    unrelaxed_pdb_path = os.path.join(
+        unrelaxed_protein_path, f'unrelaxed_{model_name}.pdb')
+    _write_pdb(protein.to_pdb(unrelaxed_protein), unrelaxed_pdb_path,
+               artifact_writer)
+
+    return (prediction_result['ranking_confidence'], unrelaxed_protein,
+            output_stats, recycling_stats.get('num_recycles'))
+
+
+def _write_pdb(
+    pdb_str: str,
+    path: str,
+    artifact_writer: Optional[AsyncArtifactWriter] = None
+):
+    if artifact_writer:
+        artifact_writer.write_text(path, pdb_str)
+    else:
+        with open(path, 'w') as f:
+            f.write(pdb_str)
+
+
+def _save_relaxed_pdb(
+    relaxed_pdb_str: str,
+    relaxed_protein_path: str,
+    model_name: str,
+    artifact_writer: Optional[AsyncArtifactWriter] = None
+):
+    relaxed_output_path = os.path.join(
+        relaxed_protein_path, f'relaxed_{model_name}.pdb')
+    _write_pdb(relaxed_pdb_str, relaxed_output_path, artifact_writer)
+
+
+def _prediction_pool_task(
+    state: Dict[str, Any],
+    model_name: str,
+    prediction_name: str,
+    random_seed: int,
+    settings: Mapping[str, Any]
+) -> Tuple[Any, Dict[str, float], int, Optional[int],
+           Optional[protein.Protein]]:
+    """Runs a prediction of predict_relax in a prediction pool worker.
+
+    The worker keeps the raw features, a model runner per model, the AMBER
+    relaxer and the last processed features in its state. The unrelaxed
+    protein is returned if the relaxation is deferred to the pool owner.
+    """
+    if 'features' not in state:
+        state['features'] = _load_features(settings['model_features_path'])
+        state['runners'] = {}
+        state['processed_features'] = (None, None)
+    if model_name not in state['runners']:
+        logging.info('Loading model %s', model_name)
+        state['runners'][model_name] = create_model_runner(
+            model_params_path=settings['model_params_path'],
+            model_name=model_name,
+            num_ensemble=settings['num_ensemble'],
+            run_multimer_system=settings['run_multimer_system'],
+            params_store=settings['params_store'],
+            recycling=settings['recycling'])
+    model_runner = state['runners'][model_name]
+
+    logging.info('Running prediction %s', prediction_name)
+    timings = {}
+    t_0 = time.time()
+    features_key = (model_name,
+                    _processed_features_key(model_runner, random_seed))
+    if state['processed_features'][0] == features_key:
+        processed_features, shape = state['processed_features'][1]
+    else:
+        processed_features, shape = prediction_buckets.process_features(
+            model_runner=model_runner,
+            raw_features=state['features'],
+            random_seed=random_seed,
+            shape_buckets=settings['shape_buckets'])
+        state['processed_features'] = (
+            features_key, (processed_features, shape))
+    timings[f'process_features_{prediction_name}'] = time.time() - t_0
+
+    ranking_confidence, unrelaxed_protein, output_stats, num_recycles = (
+        _predict_and_save(
+            model_name=prediction_name,
+            model_runner=model_runner,
+            random_seed=random_seed,
+            processed_features=processed_features,
+            shape=shape,
+            raw_prediction_path=settings['raw_prediction_path'],
+            unrelaxed_protein_path=settings['unrelaxed_protein_path'],
+            output_policy=settings['output_policy'],
+            timings=timings,
+            recycling=settings['recycling']))
+
+    if settings['relax_params'] is not None:
+        if 'relaxer' not in state:
+            state['relaxer'] = relax.AmberRelaxation(**settings['relax_params'])
+        t_0 = time.time()
+        relaxed_pdb_str, _, _ = state['relaxer'].process(
+            prot=unrelaxed_protein)
+        timings[f'relax_{prediction_name}'] = time.time() - t_0
+        _save_relaxed_pdb(
+            relaxed_pdb_str, settings['relaxed_protein_path'], prediction_name)
+
+    if not settings['return_proteins']:
+        unrelaxed_protein = None
+    return (ranking_confidence, timings, output_stats['bytes_saved'],
+            num_recycles, unrelaxed_protein)
+
+
+def _relax_protein_task(
+    unrelaxed_protein: protein.Protein,
+    relax_params: Mapping[str, Any]
+) -> Tuple[str, float, float]:
+    """Relaxes a protein in a relax pool process.
+
+    Returns the relaxed PDB string and the start and end times.
+    """
+    start_time = time.time()
+    amber_relaxer = relax.AmberRelaxation(**relax_params)
+    relaxed_pdb_str, _, _ = amber_relaxer.process(prot=unrelaxed_protein)
+    return relaxed_pdb_str, start_time, time.time()
+
+
+def _relax_top_k(
+    unrelaxed_proteins: Mapping[str, protein.Protein],
+    ranking_confidences: Mapping[str, Any],
+    relax_top_k: int,
+    relax_params: Mapping[str, Any],
+    num_relax_workers: int,
+    relaxed_protein_path: str,
+    timings: Dict[str, float],
+    artifact_writer: Optional[AsyncArtifactWriter] = None
+) -> Dict[str, Dict[str, Any]]:
+    """Relaxes the predictions with the highest ranking confidences.
+
+    Returns the rank of every prediction and whether it was relaxed.
+    Predictions with equal confidences are ranked in prediction order.
+    """
+    ranked_names = sorted(ranking_confidences,
+                          key=lambda name: -float(ranking_confidences[name]))
+    selected_names = ranked_names[:relax_top_k]
+    logging.info('Relaxing the top %d predictions: %s', len(selected_names),
+                 selected_names)
+
+    if num_relax_workers and selected_names:
+        relax_pool = futures.ProcessPoolExecutor(
+            max_workers=min(num_relax_workers, len(selected_names)),
+            mp_context=multiprocessing.get_context('spawn'))
+        try:
+            relax_futures = {
+                model_name: relax_pool.submit(
+                    _relax_protein_task, unrelaxed_proteins[model_name],
+                    relax_params)
+                for model_name in selected_names}
+            for model_name, relax_future in relax_futures.items():
+                relaxed_pdb_str, start_time, end_time = relax_future.result()
+                timings[f'relax_{model_name}'] = end_time - start_time
+                _save_relaxed_pdb(relaxed_pdb_str, relaxed_protein_path,
+                                  model_name, artifact_writer)
+        finally:
+            relax_pool.shutdown()
+    elif selected_names:
+        amber_relaxer = relax.AmberRelaxation(**relax_params)
+        for model_name in selected_names:
+            t_0 = time.time()
+            relaxed_pdb_str, _, _ = amber_relaxer.process(
+                prot=unrelaxed_proteins[model_name])
+            timings[f'relax_{model_name}'] = time.time() - t_0
+            _save_relaxed_pdb(relaxed_pdb_str, relaxed_protein_path,
+                              model_name, artifact_writer)
+
+    return {model_name: {'rank': rank, 'relaxed': rank < relax_top_k}
+            for rank, model_name in enumerate(ranked_names)}
+
+
+def _predict_relax_in_pool(
+    prediction_runners: List[Dict],
+    num_workers: int,
+    gpu_devices: Optional[Sequence[str]],
+    settings: Mapping[str, Any],
+    relax_top_k: Optional[int] = None,
+    relax_params: Optional[Mapping[str, Any]] = None,
+    num_relax_workers: int = 0,
+    metadata: Optional[Dict[str, Any]] = None,
+    artifact_writer: Optional[AsyncArtifactWriter] = None
+) -> Dict[str, Any]:
+    """Runs the predictions of predict_relax in a prediction pool.
+
+    With relax_top_k, the workers only predict and the top predictions are
+    relaxed after all predictions complete. Workers write their outputs
+    themselves, so an artifact writer is only used for the relaxed proteins
+    of the top predictions.
+    """
+    tasks = []
+    for runner in prediction_runners:
+        prediction_name = f'{runner["model_name"]}_pred_{runner["prediction_index"]}'
+        tasks.append((runner['model_name'], (
+            runner['model_name'], prediction_name, runner['random_seed'],
+            settings)))
+    logging.info('Running %d predictions in %d workers', len(tasks),
+                 num_workers)
+
+    pool_stats = {}
+    results = prediction_pool.run_tasks(
+        task_fn=_prediction_pool_task,
+        tasks=tasks,
+        num_workers=num_workers,
+        gpu_devices=gpu_devices,
+        stats=pool_stats)
+
+    timings = {}
+    bytes_saved = 0
+    ranking_confidences = {}
+    num_recycles = {}
+    unrelaxed_proteins = {}
+    for (_, (_, prediction_name, _, _)), result, task_stats in zip(
+            tasks, results, pool_stats['tasks']):
+        (ranking_confidence, prediction_timings, output_bytes_saved,
+         num_recycles[prediction_name],
+         unrelaxed_proteins[prediction_name]) = result
+        ranking_confidences[prediction_name] = ranking_confidence
+        timings.update(prediction_timings)
+        timings[f'worker_{prediction_name}'] = task_stats['worker']
+        bytes_saved += output_bytes_saved
+
+    if relax_top_k is not None:
+        relaxation = _relax_top_k(
+            unrelaxed_proteins=unrelaxed_proteins,
+            ranking_confidences=ranking_confidences,
+            relax_top_k=relax_top_k,
+            relax_params=relax_params,
+            num_relax_workers=num_relax_workers,
+            relaxed_protein_path=settings['relaxed_protein_path'],
+            timings=timings,
+            artifact_writer=artifact_writer)
+
+    if artifact_writer:
+        t_0 = time.time()
+        artifact_writer.flush()
+        timings['artifact_flush'] = time.time() - t_0
+
+    logging.info('Final timings  %s ',  timings)
+    logging.info('Predictions taken from other workers: %d',
+                 pool_stats['num_stolen'])
+    logging.info('Bytes saved by the output policy: %d', bytes_saved)
+    if settings['recycling']:
+        logging.info('Recycles used: %s', num_recycles)
+        if metadata is not None:
+            metadata['num_recycles'] = num_recycles
+    if relax_top_k is not None and metadata is not None:
+        metadata['relaxation'] = relaxation
+
+    return ranking_confidences
+
+
 def predict_relax(
     model_features_path: str,
     model_params_path: str,
@@ -292,22 +1318,78 @@ def predict_relax(
     stiffness: float = 10.0,
     exclude_residues: List[str] = [],
     max_outer_iterations: int = 3,
-    use_gpu=True
+    use_gpu=True,
+    output_policy: Optional[PredictionOutputPolicy] = None,
+    shape_buckets: Optional[ShapeBuckets] = None,
+    params_store: Optional[ParamsStore] = None,
+    num_relax_workers: int = 0,
+    num_prediction_workers: int = 0,
+    prediction_worker_devices: Optional[Sequence[str]] = None,
+    recycling: Optional[AdaptiveRecycling] = None,
+    metadata: Optional[Dict[str, Any]] = None,
+    relax_top_k: Optional[int] = None,
+    artifact_writer: Optional[AsyncArtifactWriter] = None
 ) -> Mapping[str, str]:
-    """Runs predictions and relaxations sequentially on all specified models."""
+    """Runs predictions and relaxations on all specified models.
+
+    Args:
+      output_policy: which parts of the raw prediction results are saved.
+      shape_buckets: if given, features are padded to the bucket shapes.
+      params_store: if given, model parameters are mapped from the store.
+      num_relax_workers: relaxes in a process pool while predictions run.
+      num_prediction_workers: runs the predictions in a pool of workers.
+      prediction_worker_devices: CUDA_VISIBLE_DEVICES of every worker.
+      recycling: if given, recycling stops once a structure converges.
+      metadata: if given, recycles and relaxation ranks are added to it.
+      relax_top_k: relaxes only the k predictions ranked highest.
+      artifact_writer: writes outputs in the background, flushed on return.
+    """
+
+    relax_params = dict(
+        max_iterations=max_iterations,
+        tolerance=tolerance,
+        stiffness=stiffness,
+        exclude_residues=exclude_residues,
+        max_outer_iterations=max_outer_iterations,
+        use_gpu=use_gpu)
+    if not run_relax:
+        relax_top_k = None
+    if num_prediction_workers:
+        return _predict_relax_in_pool(
+            prediction_runners=prediction_runners,
+            num_workers=num_prediction_workers,
+            gpu_devices=prediction_worker_devices,
+            settings=dict(
+                model_features_path=model_features_path,
+                model_params_path=model_params_path,
+                num_ensemble=num_ensemble,
+                run_multimer_system=run_multimer_system,
+                params_store=params_store,
+                shape_buckets=shape_buckets,
+                output_policy=output_policy,
+                raw_prediction_path=raw_prediction_path,
+                unrelaxed_protein_path=unrelaxed_protein_path,
+                relaxed_protein_path=relaxed_protein_path,
+                relax_params=(relax_params if run_relax and relax_top_k is None
+                              else None),
+                return_proteins=relax_top_k is not None,
+                recycling=recycling),
+            relax_top_k=relax_top_k,
+            relax_params=relax_params,
+            num_relax_workers=num_relax_workers,
+            metadata=metadata,
+            artifact_writer=artifact_writer)
 
     model_names = set([runner['model_name'] for runner in prediction_runners])
     runners = {}
     for model_name in model_names:
-        model_config = config.model_config(model_name)
-        if run_multimer_system:
-            model_config.model.num_ensemble_eval = num_ensemble
-        else:
-            model_config.data.eval.num_ensemble = num_ensemble
-        model_params = data.get_model_haiku_params(
-            model_name=model_name, data_dir=model_params_path)
-        model_runner = model.RunModel(model_config, model_params)
-        runners[model_name] = model_runner
+        runners[model_name] = create_model_runner(
+            model_params_path=model_params_path,
+            model_name=model_name,
+            num_ensemble=num_ensemble,
+            run_multimer_system=run_multimer_system,
+            params_store=params_store,
+            recycling=recycling)
 
     model_runners = {}
     for runner in prediction_runners:
@@ -318,93 +1400,166 @@ def predict_relax(
     logging.info('Have %d models: %s', len(model_runners),
                  list(model_runners.keys()))
 
-    if run_relax:
-        amber_relaxer = relax.AmberRelaxation(
-            max_iterations=max_iterations,
-            tolerance=tolerance,
-            stiffness=stiffness,
-            exclude_residues=exclude_residues,
-            max_outer_iterations=max_outer_iterations,
-            use_gpu=use_gpu)
-    else:
-        amber_relaxer = None
+    amber_relaxer = None
+    relax_pool = None
+    # With relax_top_k, predictions are ranked and relaxed after the last one.
+    relax_each = run_relax and relax_top_k is None
+    if relax_each and num_relax_workers:
+        if use_gpu:
+            logging.warning('Relaxing on GPU while predicting, the GPU memory '
+                            'preallocated by JAX may need to be limited')
+        # OpenMM and JAX state must not be inherited from this process.
+        relax_pool = futures.ProcessPoolExecutor(
+            max_workers=num_relax_workers,
+            mp_context=multiprocessing.get_context('spawn'))
+    elif relax_each:
+        amber_relaxer = relax.AmberRelaxation(**relax_params)
+    relax_futures = {}
 
     feature_dict = _load_features(model_features_path)
+    features_keys = {
+        model_name: _processed_features_key(*prediction_runner)
+        for model_name, prediction_runner in model_runners.items()}
+    remaining_uses = collections.Counter(features_keys.values())
+    shared_features = {}
 
     timings = {}
-    unrelaxed_pdbs = {}
-    relaxed_pdbs = {}
     ranking_confidences = {}
+    num_recycles = {}
+    unrelaxed_proteins = {}
+    output_stats = []
     for model_name, prediction_runner in model_runners.items():
         logging.info('Running prediction %s', model_name)
         t_0 = time.time()
         model_random_seed = prediction_runner[1]
         model_runner = prediction_runner[0]
-        processed_feature_dict = model_runner.process_features(
-            feature_dict, random_seed=model_random_seed)
+        features_key = features_keys[model_name]
+        if features_key in shared_features:
+            logging.info('Reusing processed features for %s', model_name)
+            processed_feature_dict, shape = shared_features[features_key]
+        else:
+            processed_feature_dict, shape = prediction_buckets.process_features(
+                model_runner=model_runner,
+                raw_features=feature_dict,
+                random_seed=model_random_seed,
+                shape_buckets=shape_buckets)
+        remaining_uses[features_key] -= 1
+        if remaining_uses[features_key]:
+            shared_features[features_key] = (processed_feature_dict, shape)
+        else:
+            shared_features.pop(features_key, None)
         timings[f'process_features_{model_name}'] = time.time() - t_0
 
-        t_0 = time.time()
-        prediction_result = model_runner.predict(processed_feature_dict,
-                                                 random_seed=model_random_seed)
-        t_diff = time.time() - t_0
-        timings[f'predict_and_compile_{model_name}'] = t_diff
-        logging.info(
-            'Total JAX model %s predict time (includes compilation time, see --benchmark): %.1fs',
-            model_name, t_diff)
-
-        plddt = prediction_result['plddt']
-        ranking_confidences[model_name] = prediction_result['ranking_confidence']
-
-        # Save the model outputs.
-        result_output_path = os.path.join(
-            raw_prediction_path, f'result_{model_name}.pkl')
-        with open(result_output_path, 'wb') as f:
-            pickle.dump(prediction_result, f, protocol=4)
-
-        # Add the predicted LDDT in the b-factor column.
-        # Note that higher predicted LDDT value means higher model confidence.
-        plddt_b_factors = np.repeat(
-            plddt[:, None], residue_constants.atom_type_num, axis=-1)
-        unrelaxed_protein = protein.from_prediction(
-            features=processed_feature_dict,
-            result=prediction_result,
-            b_factors=plddt_b_factors,
-            remove_leading_feature_dimension=not model_runner.multimer_mode)
-
-        unrelaxed_pdbs[model_name] = protein.to_pdb(unrelaxed_protein)
-        unrelaxed_pdb_path = os.path.join(
-            unrelaxed_protein_path, f'unrelaxed_{model_name}.pdb')
-        with open(unrelaxed_pdb_path, 'w') as f:
-            f.write(unrelaxed_pdbs[model_name])
-
-        if amber_relaxer:
+        (ranking_confidence, unrelaxed_protein, prediction_output_stats,
+         num_recycles[model_name]) = _predict_and_save(
+            model_name=model_name,
+            model_runner=model_runner,
+            random_seed=model_random_seed,
+            processed_features=processed_feature_dict,
+            shape=shape,
+            raw_prediction_path=raw_prediction_path,
+            unrelaxed_protein_path=unrelaxed_protein_path,
+            output_policy=output_policy,
+            timings=timings,
+            recycling=recycling,
+            artifact_writer=artifact_writer)
+        ranking_confidences[model_name] = ranking_confidence
+        output_stats.append(prediction_output_stats)
+
+        if relax_top_k is not None:
+            unrelaxed_proteins[model_name] = unrelaxed_protein
+        elif relax_pool:
+            relax_futures[model_name] = relax_pool.submit(
+                _relax_protein_task, unrelaxed_protein, relax_params)
+        elif amber_relaxer:
             # Relax the prediction.
             t_0 = time.time()
             relaxed_pdb_str, _, _ = amber_relaxer.process(
                 prot=unrelaxed_protein)
             timings[f'relax_{model_name}'] = time.time() - t_0
 
-            relaxed_pdbs[model_name] = relaxed_pdb_str
-
             # Save the relaxed PDB.
-            relaxed_output_path = os.path.join(
-                relaxed_protein_path, f'relaxed_{model_name}.pdb')
-            with open(relaxed_output_path, 'w') as f:
-                f.write(relaxed_pdb_str)
+            _save_relaxed_pdb(relaxed_pdb_str, relaxed_protein_path,
+                              model_name, artifact_writer)
+
+    if relax_pool:
+        predictions_end_time = time.time()
+        try:
+            for model_name, relax_future in relax_futures.items():
+                relaxed_pdb_str, start_time, end_time = relax_future.result()
+                timings[f'relax_{model_name}'] = end_time - start_time
+                # The part of the relaxation that ran while predicting.
+                timings[f'relax_overlap_{model_name}'] = max(
+                    0.0, min(end_time, predictions_end_time) - start_time)
+                _save_relaxed_pdb(relaxed_pdb_str, relaxed_protein_path,
+                                  model_name, artifact_writer)
+        finally:
+            relax_pool.shutdown()
+        timings['relax_wait'] = time.time() - predictions_end_time
+
+    if relax_top_k is not None:
+        relaxation = _relax_top_k(
+            unrelaxed_proteins=unrelaxed_proteins,
+            ranking_confidences=ranking_confidences,
+            relax_top_k=relax_top_k,
+            relax_params=relax_params,
+            num_relax_workers=num_relax_workers,
+            relaxed_protein_path=relaxed_protein_path,
+            timings=timings,
+            artifact_writer=artifact_writer)
+
+    if artifact_writer:
+        t_0 = time.time()
+        artifact_writer.flush()
+        timings['artifact_flush'] = time.time() - t_0
+    bytes_saved = sum(stats['bytes_saved'] for stats in output_stats)
 
     logging.info('Final timings  %s ',  timings)
+    logging.info('Bytes saved by the output policy: %d', bytes_saved)
+    if recycling:
+        logging.info('Recycles used: %s', num_recycles)
+        if metadata is not None:
+            metadata['num_recycles'] = num_recycles
+    if relax_top_k is not None and metadata is not None:
+        metadata['relaxation'] = relaxation
 
     return ranking_confidences
 
 
+def _save_stage_profile(
+    profiler: StageProfiler,
+    output_path: str,
+    metadata: Optional[Dict[str, Any]] = None
+):
+    """Writes the stage profile of a component next to its output file."""
+    stage_profile = profiler.pop_report()
+    if metadata is not None:
+        metadata['stage_profile'] = stage_profile
+    profile_path = os.path.splitext(output_path)[0] + '_stage_profile.json'
+    with open(profile_path, 'w') as f:
+        json.dump(stage_profile, f, indent=4)
+
+
 def aggregate(
     sequence_path: str,
     msa_paths: List[Tuple[str, str]],
     template_features_path: str,
-    output_features_path: str
+    output_features_path: str,
+    profiler: Optional[StageProfiler] = None,
+    features_format: str = 'pickle',
+    msa_subsampler: Optional[MsaSubsampler] = None,
+    metadata: Optional[Dict[str, Any]] = None
 ) -> Dict[str, str]:
-    """Aggregates MSAs and template features to create model features."""
+    """Aggregates MSAs and template features to create model features.
+
+    Reading the MSAs, creating the MSA features and saving the model
+    features are recorded as separate stages of the profiler, or of a new
+    one if none is given. The stage profile is written next to the model
+    features. If an MSA subsampler is given, the total depth of the MSAs is
+    capped before the MSA features are created. If a metadata dict is
+    given, the subsampling stats and the stage profile are added to it.
+    """
+    profiler = profiler or StageProfiler()
 
     # Create sequence features
     seq, seq_desc, num_res = _read_sequence(sequence_path)
@@ -415,11 +1570,18 @@ def aggregate(
     )
     # Create MSA features
     msas = []
-    for msa_path, msa_format in msa_paths:
-        msas.append(_read_msa(msa_path, msa_format))
+    with profiler.stage('read_msas'):
+        for msa_path, msa_format in msa_paths:
+            msas.append(_read_msa(msa_path, msa_format))
     if not msas:
         raise RuntimeError('No MSAs passed to the component')
-    msa_features = make_msa_features(msas=msas)
+    if msa_subsampler:
+        with profiler.stage('msa_subsampling'):
+            msas, msa_subsampling_stats = msa_subsampler.subsample_msas(msas)
+        if metadata is not None:
+            metadata['msa_subsampling'] = msa_subsampling_stats
+    with profiler.stage('msa_features'):
+        msa_features = make_msa_features(msas=msas)
     # Create template features
     template_features = _read_template_features(template_features_path)
 
@@ -428,8 +1590,10 @@ def aggregate(
         **msa_features,
         **template_features
     }
-    with open(output_features_path, 'wb') as f:
-        pickle.dump(model_features, f, protocol=4)
+    with profiler.stage('save_features'):
+        feature_io.save_features(
+            model_features, output_features_path, features_format)
+    _save_stage_profile(profiler, output_features_path, metadata)
 
     return model_features
 
@@ -439,19 +1603,45 @@ def run_jackhmmer(
     msa_path: str,
     database_path: str,
     maxseq: int,
-    n_cpu: int = 8
+    n_cpu: int = 8,
+    msa_cache: Optional[MsaCache] = None,
+    shards_path: Optional[str] = None,
+    num_shard_workers: Optional[int] = None,
+    profiler: Optional[StageProfiler] = None
 ):
-    """Runs jackhmeer and saves results to files."""
-
-    runner = jackhmmer.Jackhmmer(
-        binary_path=JACKHMMER_BINARY_PATH,
-        database_path=database_path,
-        n_cpu=n_cpu,
-    )
-
-    results = runner.query(input_path, maxseq)[0]
-    with open(msa_path, 'w') as f:
-        f.write(results['sto'])
+    """Runs jackhmeer and saves results to files.
+
+    If shards_path is set, the shards of the database created by
+    jackhmmer_shards.split_fasta_database are searched in parallel instead of
+    database_path and the hits are merged into one MSA. The search is
+    recorded as the 'jackhmmer' stage of the profiler, or of a new one if
+    none is given, and the stage profile is written next to the MSA.
+    """
+    profiler = profiler or StageProfiler()
+
+    if shards_path:
+        runner = ShardedJackhmmer(
+            binary_path=JACKHMMER_BINARY_PATH,
+            shards_path=shards_path,
+            n_cpu=n_cpu,
+            num_workers=num_shard_workers)
+        database_paths = runner.database_paths
+    else:
+        runner = jackhmmer.Jackhmmer(
+            binary_path=JACKHMMER_BINARY_PATH,
+            database_path=database_path,
+            n_cpu=n_cpu,
+        )
+        database_paths = [database_path]
+    if msa_cache:
+        runner = _cache_msa_runner(
+            msa_cache, runner, 'jackhmmer', database_paths, 'sto')
+
+    with profiler.stage('jackhmmer'):
+        results = runner.query(input_path, maxseq)[0]
+        with open(msa_path, 'w') as f:
+            f.write(results['sto'])
+    _save_stage_profile(profiler, msa_path)
 
     return parsers.parse_stockholm(results['sto']), 'sto'
 
@@ -461,9 +1651,17 @@ def run_hhblits(
     msa_path: str,
     database_paths: List[str],
     n_cpu: int,
-    maxseq: int
+    maxseq: int,
+    msa_cache: Optional[MsaCache] = None,
+    profiler: Optional[StageProfiler] = None
 ):
-    """Runs hhblits and saves results to a file."""
+    """Runs hhblits and saves results to a file.
+
+    The search is recorded as the 'hhblits' stage of the profiler, or of a
+    new one if none is given, and the stage profile is written next to the
+    MSA.
+    """
+    profiler = profiler or StageProfiler()
 
     runner = hhblits.HHBlits(
         binary_path=HHBLITS_BINARY_PATH,
@@ -471,10 +1669,15 @@ def run_hhblits(
         n_cpu=n_cpu,
         maxseq=maxseq,
     )
+    if msa_cache:
+        runner = _cache_msa_runner(
+            msa_cache, runner, 'hhblits', database_paths, 'a3m')
 
-    results = runner.query(input_path)[0]
-    with open(msa_path, 'w') as f:
-        f.write(results['a3m'])
+    with profiler.stage('hhblits'):
+        results = runner.query(input_path)[0]
+        with open(msa_path, 'w') as f:
+            f.write(results['a3m'])
+    _save_stage_profile(profiler, msa_path)
 
     return parsers.parse_a3m(results['a3m']), 'a3m'
 
@@ -490,9 +1693,18 @@ def run_hhsearch(
     obsolete_path: str,
     max_template_date: str,
     max_template_hits: int,
-    maxseq: int
+    maxseq: int,
+    template_store_path: Optional[str] = None,
+    profiler: Optional[StageProfiler] = None
 ):
-    """Runs hhsearch and saves results to a file."""
+    """Runs hhsearch and saves results to a file.
+
+    The MSA preprocessing, the template search and the template
+    featurization are recorded as separate stages of the profiler, or of a
+    new one if none is given. The stage profile is written next to the
+    template features.
+    """
+    profiler = profiler or StageProfiler()
 
     if msa_data_format != 'sto' and msa_data_format != 'a3m':
         raise ValueError(f'Unsupported MSA format: {msa_data_format}')
@@ -505,7 +1717,9 @@ def run_hhsearch(
         maxseq=maxseq
     )
 
-    template_featurizer = templates.HhsearchHitFeaturizer(
+    template_featurizer = _create_template_featurizer(
+        run_multimer_system=False,
+        template_store_path=template_store_path,
         mmcif_dir=mmcif_path,
         max_template_date=max_template_date,
         max_hits=max_template_hits,
@@ -514,26 +1728,30 @@ def run_hhsearch(
         release_dates_path=None,
     )
 
-    with open(msa_path) as f:
-        msa_str = f.read()
-
-    if msa_data_format == 'sto':
-        msa_for_templates = parsers.deduplicate_stockholm_msa(msa_str)
-        msa_for_templates = parsers.remove_empty_columns_from_stockholm_msa(
-            msa_for_templates)
-        msa_for_templates = parsers.convert_stockholm_to_a3m(msa_for_templates)
-
-    hhr_str = template_searcher.query(msa_for_templates)
-    with open(template_hits_path, 'w') as f:
-        f.write(hhr_str)
-
-    template_hits = template_searcher.get_template_hits(
-        output_string=hhr_str, input_sequence=sequence)
-    templates_result = template_featurizer.get_templates(
-        query_sequence=sequence,
-        hits=template_hits)
-    with open(template_features_path, 'wb') as f:
-        pickle.dump(templates_result.features, f, protocol=4)
+    with profiler.stage('msa_preprocessing'):
+        if msa_data_format == 'sto':
+            # HHsearch reads at most maxseq input sequences, so the MSA is
+            # truncated while it is preprocessed.
+            msa_for_templates = preprocess_stockholm_for_templates(
+                msa_path, output_format='a3m', max_sequences=maxseq)
+        else:
+            with open(msa_path) as f:
+                msa_for_templates = f.read()
+
+    with profiler.stage('template_search'):
+        hhr_str = template_searcher.query(msa_for_templates)
+        with open(template_hits_path, 'w') as f:
+            f.write(hhr_str)
+
+    with profiler.stage('template_featurization'):
+        template_hits = template_searcher.get_template_hits(
+            output_string=hhr_str, input_sequence=sequence)
+        templates_result = template_featurizer.get_templates(
+            query_sequence=sequence,
+            hits=template_hits)
+        with open(template_features_path, 'wb') as f:
+            pickle.dump(templates_result.features, f, protocol=4)
+    _save_stage_profile(profiler, template_features_path)
 
     return parsers.parse_hhr(hhr_str), templates_result.features
 
@@ -548,9 +1766,18 @@ def run_hmmsearch(
     mmcif_path: str,
     obsolete_path: str,
     max_template_date,
-    max_template_hits
+    max_template_hits,
+    template_store_path: Optional[str] = None,
+    profiler: Optional[StageProfiler] = None
 ):
-    """Runs hhsearch and saves results to a file."""
+    """Runs hhsearch and saves results to a file.
+
+    The MSA preprocessing, the template search and the template
+    featurization are recorded as separate stages of the profiler, or of a
+    new one if none is given. The stage profile is written next to the
+    template features.
+    """
+    profiler = profiler or StageProfiler()
 
     if msa_data_format != 'sto':
         raise ValueError(f'Unsupported MSA format: {msa_data_format}')
@@ -563,7 +1790,9 @@ def run_hmmsearch(
         database_path=template_db_path
     )
 
-    template_featurizer = templates.HmmsearchHitFeaturizer(
+    template_featurizer = _create_template_featurizer(
+        run_multimer_system=True,
+        template_store_path=template_store_path,
         mmcif_dir=mmcif_path,
         max_template_date=max_template_date,
         max_hits=max_template_hits,
@@ -572,24 +1801,24 @@ def run_hmmsearch(
         release_dates_path=None
     )
 
-    with open(msa_path) as f:
-        msa_str = f.read()
-
-    msa_for_templates = parsers.deduplicate_stockholm_msa(msa_str)
-    msa_for_templates = parsers.remove_empty_columns_from_stockholm_msa(
-        msa_for_templates)
-
-    sto_str = template_searcher.query(msa_for_templates)
-    with open(template_hits_path, 'w') as f:
-        f.write(sto_str)
-
-    template_hits = template_searcher.get_template_hits(
-        output_string=sto_str, input_sequence=sequence)
-    templates_result = template_featurizer.get_templates(
-        query_sequence=sequence,
-        hits=template_hits)
-
-    with open(template_features_path, 'wb') as f:
-        pickle.dump(templates_result.features, f, protocol=4)
+    with profiler.stage('msa_preprocessing'):
+        msa_for_templates = preprocess_stockholm_for_templates(
+            msa_path, output_format='sto')
+
+    with profiler.stage('template_search'):
+        sto_str = template_searcher.query(msa_for_templates)
+        with open(template_hits_path, 'w') as f:
+            f.write(sto_str)
+
+    with profiler.stage('template_featurization'):
+        template_hits = template_searcher.get_template_hits(
+            output_string=sto_str, input_sequence=sequence)
+        templates_result = template_featurizer.get_templates(
+            query_sequence=sequence,
+            hits=template_hits)
+
+        with open(template_features_path, 'wb') as f:
+            pickle.dump(templates_result.features, f, protocol=4)
+    _save_stage_profile(profiler, template_features_path)
 
     return parsers.parse_stockholm(template_hits), templates_result.features
@@ -0,0 +1,161 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Background writing of prediction artifacts.
+
+Writing results and proteins to a GCS Fuse mount can take seconds per
+file. The writer serializes and writes artifacts in worker threads while
+inference continues. Every artifact is written to a temporary file in its
+directory and renamed when complete, so readers never see partial files.
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent import futures
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+
+from prediction_io import PredictionOutputPolicy
+from prediction_io import result_nbytes
+from prediction_io import save_prediction_result
+
+
+class AsyncArtifactWriter:
+    """Writes artifacts in background threads.
+
+    Artifacts wait for a thread in a queue bounded by their total size in
+    memory. Submitting an artifact blocks while the queued artifacts exceed
+    max_pending_bytes, so inference cannot run ahead of slow storage. An
+    artifact larger than the bound is queued alone. Write errors are logged
+    when they happen and raised by flush, which waits for all artifacts
+    submitted before it.
+    """
+
+    def __init__(self,
+                 num_threads: int = 2,
+                 max_pending_bytes: int = 2 * 1024**3):
+        self.max_pending_bytes = max_pending_bytes
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=num_threads, thread_name_prefix='artifact_writer')
+        self._condition = threading.Condition()
+        self._pending_bytes = 0
+        self._submitted: List[Tuple[str, futures.Future]] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self.close()
+
+    def _write(
+        self,
+        path: str,
+        write_fn: Callable[[str], Optional[Dict[str, Any]]],
+        size: int,
+        stats: Optional[Dict[str, Any]]
+    ) -> Optional[Dict[str, Any]]:
+        directory, name = os.path.split(path)
+        tmp_path = os.path.join(
+            directory, f'.tmp-{uuid.uuid4().hex[:8]}-{name}')
+        try:
+            t_0 = time.time()
+            write_stats = write_fn(tmp_path)
+            os.replace(tmp_path, path)
+            if stats is not None:
+                stats.update(write_stats or {})
+                stats['write_time'] = time.time() - t_0
+            return write_stats
+        except BaseException:
+            logging.exception('Failed to write %s', path)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            with self._condition:
+                self._pending_bytes -= size
+                self._condition.notify_all()
+
+    def submit(
+        self,
+        path: str,
+        write_fn: Callable[[str], Optional[Dict[str, Any]]],
+        size: int,
+        stats: Optional[Dict[str, Any]] = None
+    ) -> futures.Future:
+        """Queues an artifact, waiting while the queue is full.
+
+        write_fn writes the artifact to the temporary path it is given and
+        may return stats of the write. If a stats dict is given, these stats
+        and the write time are added to it once the artifact is written.
+        """
+        with self._condition:
+            while (self._pending_bytes
+                   and self._pending_bytes + size > self.max_pending_bytes):
+                self._condition.wait()
+            self._pending_bytes += size
+        future = self._executor.submit(self._write, path, write_fn, size, stats)
+        with self._condition:
+            self._submitted.append((path, future))
+        return future
+
+    def write_text(self, path: str, text: str) -> futures.Future:
+        """Queues a text file, e.g. a PDB."""
+
+        def write_fn(tmp_path):
+            with open(tmp_path, 'w') as f:
+                f.write(text)
+
+        return self.submit(path, write_fn, len(text))
+
+    def save_prediction_result(
+        self,
+        prediction_result: Mapping[str, Any],
+        path: str,
+        policy: Optional[PredictionOutputPolicy] = None,
+        stats: Optional[Dict[str, Any]] = None
+    ) -> futures.Future:
+        """Queues a raw prediction result saved under an output policy.
+
+        The result must not be modified until it is written. The stats of
+        prediction_io.save_prediction_result are added to the stats dict.
+        """
+        return self.submit(
+            path,
+            lambda tmp_path: save_prediction_result(
+                prediction_result, tmp_path, policy),
+            result_nbytes(prediction_result),
+            stats)
+
+    def flush(self):
+        """Waits for the queued artifacts and raises if any write failed."""
+        with self._condition:
+            submitted = self._submitted
+            self._submitted = []
+        futures.wait([future for _, future in submitted])
+        errors = [(path, future.exception()) for path, future in submitted
+                  if future.exception() is not None]
+        if errors:
+            path, error = errors[0]
+            raise RuntimeError(f'Failed to write {len(errors)} artifacts, '
+                               f'first {path}: {error}') from error
+
+    def close(self):
+        """Stops the threads after the queued artifacts are written."""
+        self._executor.shutdown(wait=True)
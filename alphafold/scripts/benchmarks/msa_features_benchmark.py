@@ -0,0 +1,112 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares MSA featurization time of AlphaFold and the vectorized version.
+
+MSAs are read from files given with --msa_paths or, if none are given,
+generated with a share of duplicate sequences. The benchmark also checks
+that both implementations produce identical features.
+"""
+
+import random
+import time
+
+from absl import flags
+from absl import app
+from absl import logging
+
+from alphafold.data import parsers
+from alphafold.data import pipeline
+
+import numpy as np
+
+from msa_features import make_msa_features
+
+flags.DEFINE_list('msa_paths', None, 'Paths to MSA files in the sto or a3m format')
+flags.DEFINE_integer('num_sequences', 50_000, 'The number of sequences of a generated MSA')
+flags.DEFINE_integer('num_res', 500, 'The query length of a generated MSA')
+flags.DEFINE_float('duplicate_fraction', 0.2, 'The share of duplicate sequences in a generated MSA')
+flags.DEFINE_integer('num_repeats', 3, 'The number of timed runs of each implementation')
+flags.DEFINE_integer('random_seed', 0, 'The random seed used to generate MSAs')
+FLAGS = flags.FLAGS
+
+_RESIDUES = 'ACDEFGHIKLMNPQRSTVWY'
+
+
+def _generate_msa(num_sequences, num_res, duplicate_fraction):
+    query = ''.join(random.choice(_RESIDUES) for _ in range(num_res))
+    sequences = [query]
+    descriptions = ['query']
+    while len(sequences) < num_sequences:
+        if random.random() < duplicate_fraction:
+            sequences.append(random.choice(sequences))
+        else:
+            sequences.append(''.join(
+                res if random.random() < 0.5 else random.choice(_RESIDUES + '-')
+                for res in query))
+        descriptions.append(
+            f'tr|A0A{len(sequences):06d}|A0A{len(sequences):06d}_HUMAN/1-{num_res}')
+    deletion_matrix = [[random.randint(0, 2) if random.random() < 0.05 else 0
+                        for _ in range(num_res)]
+                       for _ in sequences]
+    return parsers.Msa(
+        sequences=sequences,
+        deletion_matrix=deletion_matrix,
+        descriptions=descriptions)
+
+
+def _read_msa(msa_path):
+    with open(msa_path) as f:
+        msa = f.read()
+    if msa_path.endswith('.sto'):
+        return parsers.parse_stockholm(msa)
+    return parsers.parse_a3m(msa)
+
+
+def _time(fn, msas):
+    times = []
+    for _ in range(FLAGS.num_repeats):
+        t0 = time.perf_counter()
+        features = fn(msas)
+        times.append(time.perf_counter() - t0)
+    return features, np.array(times)
+
+
+def _main(argv):
+
+    random.seed(FLAGS.random_seed)
+    if FLAGS.msa_paths:
+        msas = [_read_msa(msa_path) for msa_path in FLAGS.msa_paths]
+    else:
+        msas = [_generate_msa(
+            FLAGS.num_sequences, FLAGS.num_res, FLAGS.duplicate_fraction)]
+    logging.info(f'Featurizing {sum(len(msa) for msa in msas)} sequences '
+                 f'of length {len(msas[0].sequences[0])}')
+
+    reference_features, reference_times = _time(pipeline.make_msa_features, msas)
+    features, times = _time(make_msa_features, msas)
+
+    for name, value in reference_features.items():
+        if (value.dtype != features[name].dtype
+                or value.shape != features[name].shape
+                or not np.array_equal(value, features[name])):
+            raise ValueError(f'Feature {name} differs between implementations')
+
+    logging.info(f'AlphaFold make_msa_features: median {np.median(reference_times):.3f}s')
+    logging.info(f'Vectorized make_msa_features: median {np.median(times):.3f}s')
+    logging.info(f'Speedup: {np.median(reference_times) / np.median(times):.1f}x')
+
+
+if __name__ == "__main__":
+    app.run(_main)
@@ -0,0 +1,117 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares model parameter loading of AlphaFold and the parameter store.
+
+Several processes load the parameters of a model at the same time and read
+every array, as a model does on its first run. For each loader the
+benchmark reports the load time and the resident (RSS) and proportional
+(PSS) memory of the processes while all of them hold the parameters. PSS
+splits shared pages between the processes that map them, so it shows the
+memory each process actually adds to the host.
+"""
+
+import multiprocessing
+import time
+
+from absl import flags
+from absl import app
+from absl import logging
+
+from alphafold.model import data
+
+import numpy as np
+
+from params_store import ParamsStore
+
+flags.DEFINE_string('model_params_path', None, 'A path to the AlphaFold parameters directory')
+flags.DEFINE_string('params_store_path', None, 'A path to a parameter store directory')
+flags.DEFINE_string('model_name', 'model_1', 'The model whose parameters are loaded')
+flags.DEFINE_integer('num_processes', 4, 'The number of processes loading parameters at once')
+flags.mark_flag_as_required('model_params_path')
+flags.mark_flag_as_required('params_store_path')
+FLAGS = flags.FLAGS
+
+
+def _memory_stats():
+    """Returns RSS and PSS of the current process in bytes."""
+    stats = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            if name in ('Rss', 'Pss'):
+                stats[name.lower()] = int(value.split()[0]) * 1024
+    return stats
+
+
+def _load(loader, model_params_path, params_store_path, model_name,
+          barrier, results):
+    t0 = time.perf_counter()
+    if loader == 'npz':
+        params = data.get_model_haiku_params(
+            model_name=model_name, data_dir=model_params_path)
+    else:
+        params = ParamsStore(params_store_path).load(model_name, model_params_path)
+    # Read every array, so mapped parameters are paged in.
+    checksum = sum(float(np.sum(value))
+                   for module in params.values() for value in module.values())
+    load_time = time.perf_counter() - t0
+    barrier.wait()
+    results.put(dict(_memory_stats(), load_time=load_time, checksum=checksum))
+    barrier.wait()
+
+
+def _run(loader):
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(FLAGS.num_processes)
+    results = context.Queue()
+    processes = [
+        context.Process(target=_load, args=(
+            loader, FLAGS.model_params_path, FLAGS.params_store_path,
+            FLAGS.model_name, barrier, results))
+        for _ in range(FLAGS.num_processes)]
+    for process in processes:
+        process.start()
+    stats = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return stats
+
+
+def _main(argv):
+
+    t0 = time.perf_counter()
+    ParamsStore(FLAGS.params_store_path).convert(
+        FLAGS.model_name, FLAGS.model_params_path)
+    logging.info(f'Conversion (skipped if already converted): '
+                 f'{time.perf_counter() - t0:.1f}s')
+
+    checksums = {}
+    for loader in ['npz', 'mapped']:
+        stats = _run(loader)
+        checksums[loader] = stats[0]['checksum']
+        load_times = np.array([s['load_time'] for s in stats])
+        rss = np.array([s['rss'] for s in stats]) / 1024**2
+        pss = np.array([s['pss'] for s in stats]) / 1024**2
+        logging.info(f'{loader}: load time median {np.median(load_times):.2f}s, '
+                     f'max {load_times.max():.2f}s; '
+                     f'RSS per process {rss.mean():.0f} MB; '
+                     f'PSS per process {pss.mean():.0f} MB, total {pss.sum():.0f} MB')
+
+    if checksums['npz'] != checksums['mapped']:
+        raise ValueError('Parameters differ between loaders')
+
+
+if __name__ == "__main__":
+    app.run(_main)
@@ -0,0 +1,106 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares per-hit structure loading latency of mmCIF files and the template store.
+
+For every sampled hit the benchmark measures what the template featurizers
+do per hit before building features: reading the release date, the chain
+SEQRES sequences and the atom positions of the hit chain.
+"""
+
+import os
+import random
+import time
+
+from absl import flags
+from absl import app
+from absl import logging
+
+from alphafold.data import mmcif_parsing
+from alphafold.data import templates
+
+import numpy as np
+
+from template_store import TemplateStore
+
+flags.DEFINE_string('mmcif_path', None, 'A path to a directory with mmCIF files')
+flags.DEFINE_string('template_store_path', None, 'A path to a template store')
+flags.DEFINE_integer('num_hits', 100, 'The number of sampled template hits')
+flags.DEFINE_integer('random_seed', 0, 'The random seed used to sample hits')
+flags.mark_flag_as_required('mmcif_path')
+flags.mark_flag_as_required('template_store_path')
+FLAGS = flags.FLAGS
+
+
+def _load_from_mmcif(pdb_id, chain_id):
+    with open(os.path.join(FLAGS.mmcif_path, pdb_id + '.cif')) as f:
+        cif_string = f.read()
+    mmcif_object = mmcif_parsing.parse(
+        file_id=pdb_id, mmcif_string=cif_string).mmcif_object
+    # The featurizers skip hits whose mmCIF file failed to parse.
+    if mmcif_object is None:
+        return None
+    return templates._get_atom_positions(
+        mmcif_object, chain_id, max_ca_ca_distance=150.0)
+
+
+def _load_from_store(store, pdb_id, chain_id):
+    if store.get_mmcif_object(pdb_id) is None:
+        return None
+    return store.get_atom_positions(
+        pdb_id, chain_id, max_ca_ca_distance=150.0)
+
+
+def _time_hits(load_fns, hits):
+    """Times every loader on every hit.
+
+    The loaders run back to back on each hit in a random order, so neither
+    of them consistently reads a page cache warmed up by the other.
+    """
+    latencies = {name: [] for name in load_fns}
+    for pdb_id, chain_id in hits:
+        names = list(load_fns)
+        random.shuffle(names)
+        for name in names:
+            t0 = time.perf_counter()
+            try:
+                load_fns[name](pdb_id, chain_id)
+            except (templates.Error, KeyError):
+                pass
+            latencies[name].append(time.perf_counter() - t0)
+    return {name: np.array(values) for name, values in latencies.items()}
+
+
+def _main(argv):
+
+    store = TemplateStore(FLAGS.template_store_path)
+    chain_keys = [key.decode() for key in store._chains['key']]
+    random.seed(FLAGS.random_seed)
+    sampled_keys = random.sample(chain_keys, min(FLAGS.num_hits, len(chain_keys)))
+    hits = [tuple(key.split('_', 1)) for key in sampled_keys]
+
+    results = _time_hits({
+        'mmcif': _load_from_mmcif,
+        'template_store': lambda pdb_id, chain_id: _load_from_store(store, pdb_id, chain_id),
+    }, hits)
+    for name, latencies in results.items():
+        logging.info(f'{name}: mean {latencies.mean() * 1000:.2f} ms, '
+                     f'p50 {np.percentile(latencies, 50) * 1000:.2f} ms, '
+                     f'p95 {np.percentile(latencies, 95) * 1000:.2f} ms per hit')
+    speedup = results['mmcif'].mean() / results['template_store'].mean()
+    logging.info(f'Template store speedup: {speedup:.1f}x over {len(hits)} hits')
+
+
+if __name__ == "__main__":
+    app.run(_main)
@@ -0,0 +1,275 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Staging of reference databases on local scratch disks."""
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+from msa_cache import database_files
+from msa_cache import fingerprint_database
+
+_LOCK_FILE = '.lock'
+# Markers, locks and leases live outside of the staged database directories,
+# so they are not matched by the file patterns of HHblits database prefixes.
+_MARKERS_DIR = '.markers'
+_LOCKS_DIR = '.locks'
+_LEASES_DIR = '.leases'
+
+
+class DatabaseStager:
+    """Copies reference databases to a local directory with an LRU size budget.
+
+    A staged database is described by a marker file that holds the
+    fingerprint of its source files. A database is copied again when its
+    source changes. Markers are touched on every use and the least recently
+    used databases are evicted when a new one does not fit the budget.
+
+    Markers and evictions are guarded by a short-lived lock on the staging
+    directory. A database is copied under a lock of its own, so concurrent
+    tasks on the same node copy every database only once without waiting
+    for the copies of other databases. Every task that uses a staged
+    database holds a lease on it, a lease file with a shared lock that is
+    released when the stager is closed or the task exits. Databases with
+    live leases are never evicted or overwritten.
+    """
+
+    def __init__(self,
+                 staging_path: str,
+                 source_root_path: str,
+                 max_size_bytes: Optional[int] = None):
+        self.staging_path = staging_path
+        self.source_root_path = source_root_path
+        self.max_size_bytes = max_size_bytes
+        self._leases = {}
+        os.makedirs(staging_path, exist_ok=True)
+
+    @contextlib.contextmanager
+    def _lock(self, lock_path: Optional[str] = None):
+        if lock_path is None:
+            lock_path = os.path.join(self.staging_path, _LOCK_FILE)
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+        with open(lock_path, 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _staged_path(self, database_path: str) -> str:
+        relative_path = os.path.relpath(database_path, self.source_root_path)
+        if relative_path.startswith(os.pardir):
+            raise ValueError(f'{database_path} is not under '
+                             f'{self.source_root_path}')
+        return os.path.join(self.staging_path, relative_path)
+
+    def _state_path(self, directory: str, staged_path: str) -> str:
+        relative_path = os.path.relpath(staged_path, self.staging_path)
+        return os.path.join(self.staging_path, directory, relative_path)
+
+    def _marker_path(self, staged_path: str) -> str:
+        return self._state_path(_MARKERS_DIR, staged_path) + '.json'
+
+    def _acquire_lease(self, staged_path: str):
+        """Takes a lease on a staged database. Requires the staging lock."""
+        if staged_path in self._leases:
+            return
+        lease_dir = self._state_path(_LEASES_DIR, staged_path)
+        os.makedirs(lease_dir, exist_ok=True)
+        f = open(os.path.join(lease_dir, uuid.uuid4().hex), 'w')
+        fcntl.flock(f, fcntl.LOCK_SH)
+        self._leases[staged_path] = f
+
+    def _release_lease(self, staged_path: str):
+        f = self._leases.pop(staged_path, None)
+        if f is not None:
+            os.remove(f.name)
+            f.close()
+
+    def _has_live_leases(self, staged_path: str) -> bool:
+        """Checks for leases of running tasks and removes stale ones.
+
+        Requires the staging lock. Leases of this stager count as live.
+        """
+        lease_dir = self._state_path(_LEASES_DIR, staged_path)
+        if not os.path.isdir(lease_dir):
+            return False
+        live = False
+        for file in os.listdir(lease_dir):
+            lease_path = os.path.join(lease_dir, file)
+            with open(lease_path) as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    live = True
+                    continue
+                # The task that held the lease is gone.
+                os.remove(lease_path)
+        return live
+
+    def close(self):
+        """Releases the leases on the databases staged by this stager."""
+        with self._lock():
+            for staged_path in list(self._leases):
+                self._release_lease(staged_path)
+
+    def _entries(self) -> List[Tuple[str, int, float]]:
+        """Returns (marker path, size, last use time) of staged databases."""
+        entries = []
+        markers_path = os.path.join(self.staging_path, _MARKERS_DIR)
+        for root, _, files in os.walk(markers_path):
+            for file in files:
+                marker_path = os.path.join(root, file)
+                with open(marker_path) as f:
+                    marker = json.load(f)
+                entries.append((marker_path, marker['size'],
+                                os.path.getmtime(marker_path)))
+        return entries
+
+    def _remove(self, marker_path: str):
+        with open(marker_path) as f:
+            marker = json.load(f)
+        os.remove(marker_path)
+        for file in marker['files']:
+            path = os.path.join(os.path.dirname(marker['staged_path']), file)
+            # Copies of a task that died leave temporary files behind.
+            for path in (path, path + '.tmp'):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _evict(self, required_bytes: int) -> bool:
+        """Evicts databases until required_bytes fit the budget.
+
+        Returns whether they fit.
+        """
+        if self.max_size_bytes is None:
+            return True
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total_size = sum(entry[1] for entry in entries)
+        for marker_path, size, _ in entries:
+            if total_size + required_bytes <= self.max_size_bytes:
+                break
+            with open(marker_path) as f:
+                staged_path = json.load(f)['staged_path']
+            if self._has_live_leases(staged_path):
+                continue
+            logging.info('Evicting staged database %s', staged_path)
+            self._remove(marker_path)
+            total_size -= size
+        return total_size + required_bytes <= self.max_size_bytes
+
+    def _write_marker(self, marker_path: str, marker: Dict[str, Any]):
+        os.makedirs(os.path.dirname(marker_path), exist_ok=True)
+        tmp_path = marker_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(marker, f)
+        os.replace(tmp_path, marker_path)
+
+    def stage(self, database_path: str) -> str:
+        """Stages a database and returns the path to use for it.
+
+        Falls back to the source path if the database does not fit the size
+        budget or the free space of the staging disk, if the copy fails or
+        if its source changed while other tasks still use the staged copy.
+        """
+        staged_path = self._staged_path(database_path)
+        marker_path = self._marker_path(staged_path)
+        fingerprint = [[os.path.basename(path), size, mtime]
+                       for path, size, mtime in fingerprint_database(
+                           database_path)]
+        if not fingerprint:
+            logging.warning('No files found for database %s', database_path)
+            return database_path
+        size = sum(entry[1] for entry in fingerprint)
+        marker = {
+            'source': database_path,
+            'staged_path': staged_path,
+            'files': [entry[0] for entry in fingerprint],
+            'fingerprint': fingerprint,
+            'size': size,
+            'complete': False,
+        }
+
+        # Tasks that stage the same database wait here for the one that
+        # copies it, while databases are evicted under the staging lock.
+        with self._lock(self._state_path(_LOCKS_DIR, staged_path) + '.lock'):
+            with self._lock():
+                if os.path.exists(marker_path):
+                    with open(marker_path) as f:
+                        staged_marker = json.load(f)
+                    if (staged_marker['fingerprint'] == fingerprint
+                            and staged_marker.get('complete')):
+                        os.utime(marker_path)
+                        self._acquire_lease(staged_path)
+                        logging.info('Using staged database %s', staged_path)
+                        return staged_path
+                    if self._has_live_leases(staged_path):
+                        logging.info('Database %s changed while its staged '
+                                     'copy is in use', database_path)
+                        return database_path
+                    self._remove(marker_path)
+
+                if self.max_size_bytes is not None and size > self.max_size_bytes:
+                    logging.info('Database %s (%d bytes) exceeds the staging '
+                                 'budget', database_path, size)
+                    return database_path
+                if not self._evict(size):
+                    logging.info('Databases in use leave no room to stage '
+                                 'database %s', database_path)
+                    return database_path
+                os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+                if shutil.disk_usage(os.path.dirname(staged_path)).free < size:
+                    logging.info('Not enough free space to stage database %s',
+                                 database_path)
+                    return database_path
+                # The incomplete marker reserves the size of the database in
+                # the budget and the lease keeps it from being evicted.
+                self._write_marker(marker_path, marker)
+                self._acquire_lease(staged_path)
+
+            logging.info('Staging database %s to %s', database_path,
+                         staged_path)
+            t_0 = time.time()
+            try:
+                for path in database_files(database_path):
+                    target_path = os.path.join(
+                        os.path.dirname(staged_path), os.path.basename(path))
+                    tmp_path = target_path + '.tmp'
+                    shutil.copyfile(path, tmp_path)
+                    # Keep modification times, so staged databases have the
+                    # same fingerprint in the MSA cache as their sources.
+                    shutil.copystat(path, tmp_path)
+                    os.replace(tmp_path, target_path)
+            except OSError as e:
+                # E.g. the disk filled up with the copies of other tasks or
+                # the source could not be read.
+                logging.warning('Failed to stage database %s, using the '
+                                'source: %s', database_path, e)
+                with self._lock():
+                    self._release_lease(staged_path)
+                    # Also removes the partial copies.
+                    self._remove(marker_path)
+                return database_path
+            with self._lock():
+                marker['complete'] = True
+                self._write_marker(marker_path, marker)
+            logging.info('Staged %d bytes in %.1fs', size, time.time() - t_0)
+        return staged_path
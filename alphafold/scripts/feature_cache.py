@@ -0,0 +1,236 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A job-level cache of data pipeline outputs."""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+from alphafold.data import parsers
+
+import feature_io
+from msa_cache import fingerprint_database
+
+_LOCK_FILE = '.lock'
+_ENTRY_FILE = 'entry.json'
+_MSAS_DIR = 'msas'
+
+
+def _copy_tree(source_path: str, target_path: str):
+    """Copies the files of a directory tree into a possibly existing one."""
+    for root, _, files in os.walk(source_path):
+        target_root = os.path.join(
+            target_path, os.path.relpath(root, source_path))
+        os.makedirs(target_root, exist_ok=True)
+        for file in files:
+            shutil.copyfile(os.path.join(root, file),
+                            os.path.join(target_root, file))
+
+
+def _tree_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            size += os.path.getsize(os.path.join(root, file))
+    return size
+
+
+def sequences_hash(fasta_path: str) -> str:
+    """Returns a hash of the sequences and descriptions of a FASTA file.
+
+    Sequences are upper-cased and kept in input order, since the order
+    determines the chain IDs of multimer features. Descriptions are part of
+    the hash, since they end up in the domain name of monomer features and
+    in the chain ID map of multimer targets.
+    """
+    with open(fasta_path) as f:
+        sequences, descriptions = parsers.parse_fasta(f.read())
+    canonical = json.dumps([
+        [description, sequence.strip().upper()]
+        for sequence, description in zip(sequences, descriptions)])
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def structure_source_fingerprint(
+    mmcif_path: str,
+    template_store_path: Optional[str] = None
+) -> List[Tuple[str, int, int]]:
+    """Returns (name, size, mtime) of the source of template structures.
+
+    The files of a template store are fingerprinted when it is used. The
+    mmCIF directory is too large to fingerprint file by file, so only the
+    modification time of the directory is used, which changes when mmCIF
+    files are added or removed.
+    """
+    if template_store_path:
+        return [(os.path.basename(path), size, mtime)
+                for path, size, mtime in fingerprint_database(
+                    os.path.join(template_store_path, ''))]
+    stat = os.stat(mmcif_path)
+    return [(os.path.basename(os.path.normpath(mmcif_path)), 0,
+             int(stat.st_mtime))]
+
+
+class FeatureCache:
+    """A size-bounded LRU cache of features and MSAs of whole targets.
+
+    Entries are keyed by the hash of the target sequences and their
+    descriptions, the fingerprints of the reference databases and the job
+    parameters that change the features, such as the model and database
+    presets, the max template date and the source of template structures. An entry is a directory holding the
+    features file, the MSA directory and the data pipeline metadata. Entries
+    are written to a temporary directory and renamed into place, so readers
+    never see partial entries. Storing and evicting entries hold an
+    exclusive lock on the cache directory.
+    """
+
+    def __init__(self,
+                 cache_path: str,
+                 database_paths: Mapping[str, str],
+                 params: Mapping[str, Any],
+                 max_size_bytes: Optional[int] = None):
+        self.cache_path = cache_path
+        self.max_size_bytes = max_size_bytes
+        os.makedirs(cache_path, exist_ok=True)
+        # Databases are identified by file names rather than full paths, so
+        # copies staged on local disks share cache entries with their sources.
+        databases = {
+            name: [(os.path.basename(path), size, mtime)
+                   for path, size, mtime in fingerprint_database(database_path)]
+            for name, database_path in database_paths.items()}
+        self._job_fields = {'databases': databases, 'params': dict(params)}
+
+    @contextlib.contextmanager
+    def _lock(self):
+        with open(os.path.join(self.cache_path, _LOCK_FILE), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_path, key)
+
+    def make_key(self, fasta_path: str) -> str:
+        """Computes the cache key of a target."""
+        key_fields = dict(self._job_fields, sequences=sequences_hash(fasta_path))
+        key_str = json.dumps(key_fields, sort_keys=True)
+        return hashlib.sha256(key_str.encode()).hexdigest()
+
+    def contains(self, key: str) -> bool:
+        return os.path.exists(os.path.join(self._entry_path(key), _ENTRY_FILE))
+
+    def get(self,
+            key: str,
+            msa_output_path: str,
+            features_output_path: str,
+            features_format: str = 'pickle') -> Optional[Dict[str, Any]]:
+        """Materializes a cached target and returns its metadata.
+
+        The features are converted if they were cached in another format.
+        Returns None if the key is not in the cache.
+        """
+        entry_path = self._entry_path(key)
+        entry_file = os.path.join(entry_path, _ENTRY_FILE)
+        try:
+            with open(entry_file) as f:
+                entry = json.load(f)
+            # The modification time of the entry file is the LRU access time.
+            os.utime(entry_file)
+            _copy_tree(os.path.join(entry_path, _MSAS_DIR), msa_output_path)
+            features_path = os.path.join(
+                entry_path,
+                feature_io.FEATURES_FILE_NAMES[entry['features_format']])
+            if entry['features_format'] == features_format:
+                shutil.copyfile(features_path, features_output_path)
+            else:
+                feature_io.save_features(
+                    feature_io.load_features(features_path),
+                    features_output_path, features_format)
+        except FileNotFoundError:
+            # The entry is missing or was evicted while it was read.
+            logging.info('Feature cache miss for key %s', key)
+            return None
+        logging.info('Feature cache hit for key %s', key)
+        return entry['metadata']
+
+    def put(self,
+            key: str,
+            msa_output_path: str,
+            features_output_path: str,
+            features_format: str,
+            metadata: Mapping[str, Any]):
+        """Stores the outputs of a target and evicts entries over the budget."""
+        tmp_path = tempfile.mkdtemp(dir=self.cache_path, prefix='.tmp-')
+        try:
+            _copy_tree(msa_output_path, os.path.join(tmp_path, _MSAS_DIR))
+            shutil.copyfile(features_output_path,
+                            os.path.join(
+                                tmp_path,
+                                feature_io.FEATURES_FILE_NAMES[features_format]))
+            with open(os.path.join(tmp_path, _ENTRY_FILE), 'w') as f:
+                json.dump({
+                    'features_format': features_format,
+                    'size': _tree_size(tmp_path),
+                    'metadata': metadata,
+                }, f)
+            with self._lock():
+                if self.contains(key):
+                    logging.info('Feature cache entry %s already exists', key)
+                    return
+                os.rename(tmp_path, self._entry_path(key))
+                self._evict()
+        finally:
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path)
+
+    def _entries(self) -> List[Tuple[str, int, float]]:
+        """Returns (key, size, last access time) of all entries."""
+        entries = []
+        for entry in os.scandir(self.cache_path):
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            entry_file = os.path.join(entry.path, _ENTRY_FILE)
+            try:
+                with open(entry_file) as f:
+                    size = json.load(f)['size']
+                entries.append((entry.name, size, os.path.getmtime(entry_file)))
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def _evict(self):
+        """Removes least recently used entries above the size budget."""
+        if self.max_size_bytes is None:
+            return
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total_size = sum(entry[1] for entry in entries)
+        for key, size, _ in entries:
+            if total_size <= self.max_size_bytes:
+                break
+            logging.info('Evicting feature cache entry %s', key)
+            entry_path = self._entry_path(key)
+            # Removing the entry file first makes the entry invisible to
+            # readers before its outputs are deleted.
+            os.remove(os.path.join(entry_path, _ENTRY_FILE))
+            shutil.rmtree(entry_path, ignore_errors=True)
+            total_size -= size
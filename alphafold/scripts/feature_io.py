@@ -0,0 +1,218 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A memory-mappable file format for feature dicts.
+
+A file starts with a magic string and the length of a JSON header followed by
+the header. The header describes every feature. Arrays with a fixed-size
+dtype are stored as raw, 64-byte aligned C-ordered blobs that are mapped into
+memory read-only when the file is loaded, so processes loading the same file
+share its pages and pay no deserialization cost. Other values, such as the
+object arrays holding sequences and descriptions, are stored as pickles.
+
+Pickle remains the default format, so features files keep loading with
+pickle.load. Mapped files are named with their own extension, so they are
+never mistaken for pickles.
+"""
+
+import collections.abc
+import json
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+from typing import Any, Dict, Iterator, Mapping, Tuple
+
+import numpy as np
+
+MAGIC = b'AFFEAT01'
+ALIGNMENT = 64
+FORMATS = ('mapped', 'pickle')
+# Names of features files written by the pipeline in every format.
+FEATURES_FILE_NAMES = {'mapped': 'features.npmap', 'pickle': 'features.pkl'}
+
+_HEADER_LENGTH = struct.Struct('<Q')
+
+
+def _align(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _is_mappable(value: Any) -> bool:
+    return isinstance(value, np.ndarray) and not value.dtype.hasobject
+
+
+def write_mapped_features(features: Mapping[str, Any], path: str):
+    """Writes features to a file in the memory-mappable format."""
+    entries = {}
+    blobs = []
+    offset = 0
+    for name, value in features.items():
+        if _is_mappable(value):
+            if not value.flags.c_contiguous:
+                value = value.copy(order='C')
+            entries[name] = {
+                'kind': 'array',
+                'dtype': value.dtype.str,
+                'shape': list(value.shape),
+            }
+        else:
+            value = pickle.dumps(value, protocol=4)
+            entries[name] = {'kind': 'pickle'}
+        offset = _align(offset)
+        nbytes = value.nbytes if isinstance(value, np.ndarray) else len(value)
+        entries[name].update(offset=offset, nbytes=nbytes)
+        blobs.append((offset, value))
+        offset += nbytes
+
+    header = json.dumps({'version': 1, 'entries': entries}).encode()
+    data_offset = _align(len(MAGIC) + _HEADER_LENGTH.size + len(header))
+
+    output_dir = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=output_dir, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC)
+            f.write(_HEADER_LENGTH.pack(len(header)))
+            f.write(header)
+            for blob_offset, value in blobs:
+                f.seek(data_offset + blob_offset)
+                if isinstance(value, np.ndarray):
+                    value = value.reshape(-1).view(np.uint8)
+                f.write(value)
+            f.truncate(data_offset + offset)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def is_mapped_features_file(path: str) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _map_file(path: str) -> Tuple[mmap.mmap, Dict[str, Any], int]:
+    """Maps a file and returns the mapping, its entries and data offset."""
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buffer[:len(MAGIC)] != MAGIC:
+        raise ValueError(f'{path} is not a mapped features file')
+    header_start = len(MAGIC) + _HEADER_LENGTH.size
+    header_length, = _HEADER_LENGTH.unpack_from(buffer, len(MAGIC))
+    header = json.loads(buffer[header_start:header_start + header_length])
+    return buffer, header['entries'], _align(header_start + header_length)
+
+
+def _read_entry(buffer: mmap.mmap, data_offset: int, entry: Mapping[str, Any]):
+    start = data_offset + entry['offset']
+    if entry['kind'] == 'pickle':
+        return pickle.loads(buffer[start:start + entry['nbytes']])
+    dtype = np.dtype(entry['dtype'])
+    shape = tuple(entry['shape'])
+    if entry['nbytes'] == 0:
+        return np.empty(shape, dtype=dtype)
+    return np.frombuffer(
+        buffer, dtype=dtype, count=entry['nbytes'] // dtype.itemsize,
+        offset=start).reshape(shape)
+
+
+def read_mapped_features(path: str) -> Dict[str, Any]:
+    """Loads a file in the memory-mappable format.
+
+    Arrays are returned as read-only views of the mapped file. Copy an array
+    before modifying it.
+    """
+    buffer, entries, data_offset = _map_file(path)
+    return {name: _read_entry(buffer, data_offset, entry)
+            for name, entry in entries.items()}
+
+
+def save_features(
+    features: Mapping[str, Any],
+    path: str,
+    features_format: str = 'pickle'
+):
+    """Saves features in the 'mapped' or 'pickle' format."""
+    if features_format == 'mapped':
+        write_mapped_features(features, path)
+    elif features_format == 'pickle':
+        with open(path, 'wb') as f:
+            pickle.dump(features, f, protocol=4)
+    else:
+        raise ValueError(f'Unsupported features format: {features_format}')
+
+
+class LazyFeatures(collections.abc.Mapping):
+    """A read-only mapping that loads features on first access.
+
+    Files in the mapped format are read key by key. Pickled files cannot be
+    read partially, so they are loaded when the mapping is created. Accessed
+    keys are recorded in touched_keys. After release() the mapping drops its
+    references to loaded features and to the mapped file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.touched_keys = []
+        self._loaded = {}
+        if is_mapped_features_file(path):
+            self._buffer, self._entries, self._data_offset = _map_file(path)
+            self._keys = list(self._entries)
+        else:
+            self._buffer = None
+            with open(path, 'rb') as f:
+                self._loaded = pickle.load(f)
+            self._keys = list(self._loaded)
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self._keys:
+            raise KeyError(key)
+        if key not in self.touched_keys:
+            self.touched_keys.append(key)
+        if key not in self._loaded:
+            if self._buffer is None:
+                raise RuntimeError(f'Features of {self.path} were released')
+            self._loaded[key] = _read_entry(
+                self._buffer, self._data_offset, self._entries[key])
+        return self._loaded[key]
+
+    def __contains__(self, key: Any) -> bool:
+        # Mapping implements membership with __getitem__, which would load
+        # the feature.
+        return key in self._keys
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._keys)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def release(self):
+        """Drops the loaded features so that their memory can be freed.
+
+        The mapped file is unmapped once no returned array refers to it.
+        """
+        self._loaded = {}
+        self._buffer = None
+
+
+def load_features(path: str) -> Dict[str, Any]:
+    """Loads features saved in either the mapped or the pickle format."""
+    if is_mapped_features_file(path):
+        return read_mapped_features(path)
+    with open(path, 'rb') as f:
+        return pickle.load(f)
@@ -0,0 +1,287 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Jackhmmer searches over a database split into shards.
+
+A FASTA database is split offline into shards with an index. Every shard is
+searched with the E-value database size (-Z) set to the number of sequences
+in the full database, so E-values of hits from different shards are
+comparable. The shard alignments are then merged into one Stockholm MSA
+sorted by E-value and truncated to the requested number of sequences.
+"""
+
+import collections
+import json
+import logging
+import os
+import tempfile
+from concurrent import futures
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
+
+from alphafold.data import parsers
+from alphafold.data.tools import jackhmmer
+
+INDEX_FILE = 'index.json'
+
+
+def split_fasta_database(
+    database_path: str,
+    output_path: str,
+    num_shards: int
+) -> Dict[str, Any]:
+    """Splits a FASTA database into shards and writes the shard index.
+
+    Records are streamed to the shard with the fewest residues so far, which
+    balances search time across shards.
+    """
+    os.makedirs(output_path, exist_ok=True)
+    shard_names = [f'shard_{index:04d}.fasta' for index in range(num_shards)]
+    shard_files = [open(os.path.join(output_path, name), 'w')
+                   for name in shard_names]
+    num_sequences = [0] * num_shards
+    num_residues = [0] * num_shards
+    try:
+        record = []
+        record_residues = 0
+
+        def write_record():
+            shard = num_residues.index(min(num_residues))
+            shard_files[shard].writelines(record)
+            num_sequences[shard] += 1
+            num_residues[shard] += record_residues
+
+        with open(database_path) as f:
+            for line in f:
+                if line.startswith('>'):
+                    if record:
+                        write_record()
+                    record = [line]
+                    record_residues = 0
+                elif record:
+                    record.append(line)
+                    record_residues += len(line.strip())
+        if record:
+            write_record()
+    finally:
+        for shard_file in shard_files:
+            shard_file.close()
+
+    index = {
+        'source': database_path,
+        'num_sequences': sum(num_sequences),
+        'shards': [
+            {'path': name, 'num_sequences': sequences, 'num_residues': residues}
+            for name, sequences, residues in zip(
+                shard_names, num_sequences, num_residues)
+        ],
+    }
+    with open(os.path.join(output_path, INDEX_FILE), 'w') as f:
+        json.dump(index, f, indent=4)
+    logging.info('Split %s into %d shards with %d sequences', database_path,
+                 num_shards, index['num_sequences'])
+    return index
+
+
+def load_shard_index(shards_path: str) -> Dict[str, Any]:
+    with open(os.path.join(shards_path, INDEX_FILE)) as f:
+        return json.load(f)
+
+
+def search_shard(
+    binary_path: str,
+    input_fasta_path: str,
+    shards_path: str,
+    shard_index: int,
+    output_path: str,
+    n_cpu: int,
+    max_sequences: Optional[int] = None
+) -> Tuple[str, str]:
+    """Searches one shard and saves its alignment and hit table.
+
+    Returns paths to the Stockholm alignment and the hit table.
+    """
+    index = load_shard_index(shards_path)
+    shard = index['shards'][shard_index]
+    runner = jackhmmer.Jackhmmer(
+        binary_path=binary_path,
+        database_path=os.path.join(shards_path, shard['path']),
+        n_cpu=n_cpu,
+        z_value=index['num_sequences'],
+        get_tblout=True)
+    result = runner.query(input_fasta_path, max_sequences)[0]
+
+    os.makedirs(output_path, exist_ok=True)
+    sto_path = os.path.join(output_path, f'shard_{shard_index:04d}.sto')
+    tbl_path = os.path.join(output_path, f'shard_{shard_index:04d}.tbl')
+    with open(sto_path, 'w') as f:
+        f.write(result['sto'])
+    with open(tbl_path, 'w') as f:
+        f.write(result['tbl'])
+    return sto_path, tbl_path
+
+
+def _parse_stockholm_rows(
+    stockholm: str
+) -> Tuple[Dict[str, str], str, Dict[str, List[str]]]:
+    """Returns concatenated rows, the RF annotation and #=GS lines by name."""
+    rows = collections.OrderedDict()
+    reference = []
+    gs_lines = collections.defaultdict(list)
+    for line in stockholm.splitlines():
+        if line.startswith('#=GC RF'):
+            reference.append(line.split()[-1])
+        elif line[:4] == '#=GS':
+            gs_lines[line.split(maxsplit=2)[1]].append(line)
+        elif line.strip() and not line.startswith(('#', '//')):
+            seqname, aligned_seq = line.split(maxsplit=1)
+            rows[seqname] = rows.get(seqname, '') + aligned_seq.strip()
+    return rows, ''.join(reference), gs_lines
+
+
+def _split_row(row: str, reference: str) -> Tuple[List[str], List[str]]:
+    """Splits a row into insertions before every match state and the states.
+
+    Returns M + 1 insertion strings (without gaps) and M match characters,
+    where M is the number of match columns in the RF annotation.
+    """
+    insertions = []
+    matches = []
+    insertion = []
+    for res, ref in zip(row, reference):
+        if ref in '.-':
+            if res not in '.-':
+                insertion.append(res)
+        else:
+            insertions.append(''.join(insertion))
+            matches.append(res)
+            insertion = []
+    insertions.append(''.join(insertion))
+    return insertions, matches
+
+
+def merge_shard_alignments(
+    shard_results: Sequence[Tuple[str, str]],
+    max_sequences: Optional[int] = None
+) -> str:
+    """Merges per-shard (Stockholm, tblout) results into one Stockholm MSA.
+
+    The query row is taken from the first shard and hits are ordered by their
+    full sequence E-value. As every shard is searched with the same model,
+    match columns are shared and insert columns are re-aligned to the
+    longest insertion at every position.
+    """
+    hits = []
+    query = None
+    gs_lines = {}
+    for shard_index, (stockholm, tblout) in enumerate(shard_results):
+        rows, reference, shard_gs_lines = _parse_stockholm_rows(stockholm)
+        if not rows:
+            continue
+        e_values = parsers.parse_e_values_from_tblout(tblout)
+        gs_lines.update(shard_gs_lines)
+        for row_index, (seqname, row) in enumerate(rows.items()):
+            segments = _split_row(row, reference)
+            if row_index == 0:
+                # Every shard alignment starts with the query.
+                if query is None:
+                    query = (seqname, segments)
+                continue
+            e_value = e_values.get(seqname.partition('/')[0], float('inf'))
+            hits.append((e_value, shard_index, row_index, seqname, segments))
+    if query is None:
+        raise ValueError('No shard alignments to merge')
+
+    hits.sort(key=lambda hit: hit[:3])
+    selected = [query] + [(hit[3], hit[4]) for hit in hits]
+    if max_sequences is not None:
+        selected = selected[:max_sequences]
+
+    num_matches = len(query[1][1])
+    insertion_lengths = [
+        max(len(segments[0][k]) for _, segments in selected)
+        for k in range(num_matches + 1)]
+
+    def format_row(segments):
+        insertions, matches = segments
+        parts = []
+        for k in range(num_matches + 1):
+            parts.append(insertions[k].ljust(insertion_lengths[k], '-'))
+            if k < num_matches:
+                parts.append(matches[k])
+        return ''.join(parts)
+
+    reference = ''.join(
+        '.' * insertion_lengths[k] + ('x' if k < num_matches else '')
+        for k in range(num_matches + 1))
+    name_width = max(len('#=GC RF'),
+                     *(len(seqname) for seqname, _ in selected))
+
+    lines = ['# STOCKHOLM 1.0', '']
+    for seqname, _ in selected:
+        lines.extend(gs_lines.get(seqname, []))
+    lines.append('')
+    for seqname, segments in selected:
+        lines.append(f'{seqname.ljust(name_width)} {format_row(segments)}')
+    lines.append(f'{"#=GC RF".ljust(name_width)} {reference}')
+    lines.append('//')
+    return '\n'.join(lines) + '\n'
+
+
+class ShardedJackhmmer:
+    """A Jackhmmer runner that searches database shards in parallel.
+
+    Has the same query() interface as jackhmmer.Jackhmmer, so it can replace
+    a Jackhmmer runner in the data pipelines and be wrapped by an MsaCache.
+    """
+
+    def __init__(self,
+                 binary_path: str,
+                 shards_path: str,
+                 n_cpu: int = 8,
+                 num_workers: Optional[int] = None):
+        self.binary_path = binary_path
+        self.shards_path = shards_path
+        self.index = load_shard_index(shards_path)
+        self.num_shards = len(self.index['shards'])
+        self.database_paths = [os.path.join(shards_path, shard['path'])
+                               for shard in self.index['shards']]
+        self.num_workers = min(num_workers or self.num_shards, self.num_shards)
+        self.n_cpu = n_cpu
+        self.z_value = self.index['num_sequences']
+
+    def query(self,
+              input_fasta_path: str,
+              max_sequences: Optional[int] = None) -> List[Mapping[str, Any]]:
+        n_cpu = max(1, self.n_cpu // self.num_workers)
+        with tempfile.TemporaryDirectory() as output_path:
+            with futures.ThreadPoolExecutor(self.num_workers) as executor:
+                shard_paths = list(executor.map(
+                    lambda shard_index: search_shard(
+                        binary_path=self.binary_path,
+                        input_fasta_path=input_fasta_path,
+                        shards_path=self.shards_path,
+                        shard_index=shard_index,
+                        output_path=output_path,
+                        n_cpu=n_cpu,
+                        max_sequences=max_sequences),
+                    range(self.num_shards)))
+            shard_results = []
+            for sto_path, tbl_path in shard_paths:
+                with open(sto_path) as f:
+                    sto = f.read()
+                with open(tbl_path) as f:
+                    tbl = f.read()
+                shard_results.append((sto, tbl))
+        sto = merge_shard_alignments(shard_results, max_sequences)
+        return [{'sto': sto}]
@@ -0,0 +1,237 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A persistent, content-addressed cache for MSA search results."""
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
+
+from alphafold.data import parsers
+
+
+class CacheBackend:
+    """Interface of a key-value store holding cached entries."""
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns a value or None if the key is not in the store."""
+        raise NotImplementedError()
+
+    def put(self, key: str, value: str):
+        """Stores a value under a key."""
+        raise NotImplementedError()
+
+    def delete(self, key: str):
+        """Removes a key from the store."""
+        raise NotImplementedError()
+
+    def entries(self) -> List[Tuple[str, int, float]]:
+        """Returns (key, size in bytes, last access time) of all entries."""
+        raise NotImplementedError()
+
+
+class LocalDirectoryBackend(CacheBackend):
+    """Stores cache entries as files in a local directory."""
+
+    def __init__(self, root_path: str):
+        self.root_path = root_path
+        os.makedirs(root_path, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root_path, key)
+
+    def get(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                value = f.read()
+        except FileNotFoundError:
+            return None
+        # The modification time doubles as the LRU access time.
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return value
+
+    def put(self, key: str, value: str):
+        fd, tmp_path = tempfile.mkstemp(dir=self.root_path, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(value)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def entries(self) -> List[Tuple[str, int, float]]:
+        entries = []
+        for entry in os.scandir(self.root_path):
+            if entry.name.startswith('.tmp-') or not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((entry.name, stat.st_size, stat.st_mtime))
+        return entries
+
+
+def database_files(database_path: str) -> List[str]:
+    """Returns paths of all files that make up a database.
+
+    Jackhmmer databases are single FASTA files while HHblits databases are
+    prefixes of a set of ffindex files, so a prefix is expanded to all files
+    that start with it.
+    """
+    if os.path.isfile(database_path):
+        return [database_path]
+    return sorted(path for path in glob.glob(database_path + '*')
+                  if os.path.isfile(path))
+
+
+def fingerprint_database(database_path: str) -> List[Tuple[str, int, int]]:
+    """Returns (path, size, mtime) of all files that make up a database."""
+    fingerprint = []
+    for path in database_files(database_path):
+        stat = os.stat(path)
+        fingerprint.append((path, stat.st_size, int(stat.st_mtime)))
+    return fingerprint
+
+
+class MsaCache:
+    """A size-bounded LRU cache of MSA search outputs.
+
+    Entries are keyed by the hash of the query sequence, the search tool,
+    the fingerprint of the searched databases and the search parameters
+    that change the result.
+    """
+
+    def __init__(self,
+                 backend: CacheBackend,
+                 max_size_bytes: Optional[int] = None):
+        self.backend = backend
+        self.max_size_bytes = max_size_bytes
+
+    def make_key(self,
+                 sequence: str,
+                 tool: str,
+                 database_paths: Sequence[str],
+                 params: Mapping[str, Any]) -> str:
+        """Computes a cache key for a search."""
+        # Databases are identified by file names rather than full paths, so
+        # copies staged on local disks share cache entries with their sources.
+        databases = [[(os.path.basename(path), size, mtime)
+                      for path, size, mtime in fingerprint_database(
+                          database_path)]
+                     for database_path in database_paths]
+        key_fields = {
+            'sequence': hashlib.sha256(sequence.encode()).hexdigest(),
+            'tool': tool,
+            'databases': databases,
+            'params': dict(params),
+        }
+        key_str = json.dumps(key_fields, sort_keys=True)
+        return hashlib.sha256(key_str.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        value = self.backend.get(key)
+        logging.info('MSA cache %s for key %s',
+                     'miss' if value is None else 'hit', key)
+        return value
+
+    def put(self, key: str, value: str):
+        self.backend.put(key, value)
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used entries above the size budget."""
+        if self.max_size_bytes is None:
+            return
+        entries = sorted(self.backend.entries(), key=lambda entry: entry[2])
+        total_size = sum(entry[1] for entry in entries)
+        for key, size, _ in entries:
+            if total_size <= self.max_size_bytes:
+                break
+            logging.info('Evicting MSA cache entry %s', key)
+            self.backend.delete(key)
+            total_size -= size
+
+    def wrap(self,
+             runner: Any,
+             tool: str,
+             database_paths: Sequence[str],
+             msa_format: str,
+             params: Optional[Mapping[str, Any]] = None) -> 'CachingMsaRunner':
+        """Wraps an MSA tool runner so that its queries go through the cache."""
+        return CachingMsaRunner(
+            runner=runner,
+            cache=self,
+            tool=tool,
+            database_paths=database_paths,
+            msa_format=msa_format,
+            params=params or {})
+
+
+class CachingMsaRunner:
+    """An MSA tool runner that serves repeated queries from an MsaCache.
+
+    Exposes the same query() interface as the Jackhmmer and HHBlits runners
+    so it can replace them in the AlphaFold data pipelines. On a cache hit
+    the result only holds the MSA in the requested format.
+    """
+
+    def __init__(self,
+                 runner: Any,
+                 cache: MsaCache,
+                 tool: str,
+                 database_paths: Sequence[str],
+                 msa_format: str,
+                 params: Mapping[str, Any]):
+        self.runner = runner
+        self.cache = cache
+        self.tool = tool
+        self.database_paths = list(database_paths)
+        self.msa_format = msa_format
+        self.params = dict(params)
+
+    def query(self, input_fasta_path: str, *args) -> List[Dict[str, Any]]:
+        with open(input_fasta_path) as f:
+            sequences, _ = parsers.parse_fasta(f.read())
+        params = dict(self.params, query_args=list(args))
+        key = self.cache.make_key(
+            sequence='\n'.join(sequences),
+            tool=self.tool,
+            database_paths=self.database_paths,
+            params=params)
+
+        msa = self.cache.get(key)
+        if msa is not None:
+            return [{self.msa_format: msa}]
+
+        results = self.runner.query(input_fasta_path, *args)
+        if len(results) == 1:
+            self.cache.put(key, results[0][self.msa_format])
+        return results
@@ -0,0 +1,95 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Vectorized construction of MSA features."""
+
+import itertools
+from typing import Sequence
+
+from alphafold.common import residue_constants
+from alphafold.data import msa_identifiers
+from alphafold.data import parsers
+from alphafold.data import pipeline
+
+import numpy as np
+
+# Maps ASCII codes of residues to HHblits residue IDs. Codes of characters
+# that are not residues map to -1.
+_AA_TO_ID_TABLE = np.full(256, -1, dtype=np.int32)
+for _res, _res_id in residue_constants.HHBLITS_AA_TO_ID.items():
+    _AA_TO_ID_TABLE[ord(_res)] = _res_id
+
+
+def make_msa_features(msas: Sequence[parsers.Msa]) -> pipeline.FeatureDict:
+    """Constructs a feature dict of MSA features.
+
+    Produces the same features as pipeline.make_msa_features. All aligned
+    sequences are copied into one byte matrix, duplicate rows are removed by
+    sorting the rows as fixed-size records and residues are converted to IDs
+    with a lookup table. Only the species identifiers of the unique
+    sequences are parsed in Python.
+    """
+    if not msas:
+        raise ValueError('At least one MSA must be provided.')
+    for msa_index, msa in enumerate(msas):
+        if not msa:
+            raise ValueError(
+                f'MSA {msa_index} must contain at least one sequence.')
+
+    num_res = len(msas[0].sequences[0])
+    sequences = list(itertools.chain.from_iterable(
+        msa.sequences for msa in msas))
+    if num_res == 0 or any(len(sequence) != num_res for sequence in sequences):
+        return pipeline.make_msa_features(msas)
+    try:
+        sequences_bytes = ''.join(sequences).encode('ascii')
+    except UnicodeEncodeError:
+        return pipeline.make_msa_features(msas)
+    del sequences
+
+    rows = np.frombuffer(sequences_bytes, dtype=np.uint8).reshape(-1, num_res)
+    # np.unique sorts stably when returning indices, so the first occurrence
+    # of every sequence is kept, in the order of the input MSAs.
+    records = rows.view(np.dtype((np.void, num_res))).ravel()
+    _, first_indices = np.unique(records, return_index=True)
+    keep = np.sort(first_indices)
+
+    int_msa = _AA_TO_ID_TABLE[rows[keep]]
+    unknown = int_msa < 0
+    if unknown.any():
+        unknown_index = np.flatnonzero(unknown.ravel())[0]
+        raise KeyError(chr(rows[keep].ravel()[unknown_index]))
+
+    deletion_matrix = list(itertools.chain.from_iterable(
+        msa.deletion_matrix for msa in msas))
+    if any(len(deletion_matrix[index]) != num_res for index in keep):
+        return pipeline.make_msa_features(msas)
+    descriptions = list(itertools.chain.from_iterable(
+        msa.descriptions for msa in msas))
+    species_ids = [
+        msa_identifiers.get_identifiers(
+            descriptions[index]).species_id.encode('utf-8')
+        for index in keep]
+
+    features = {}
+    # The parsers return deletion counts as nested lists, which np.fromiter
+    # converts faster than np.array.
+    features['deletion_matrix_int'] = np.fromiter(
+        itertools.chain.from_iterable(
+            deletion_matrix[index] for index in keep),
+        dtype=np.int32, count=len(keep) * num_res).reshape(-1, num_res)
+    features['msa'] = int_msa
+    features['num_alignments'] = np.full(num_res, len(keep), dtype=np.int32)
+    features['msa_species_identifiers'] = np.array(species_ids, dtype=np.object_)
+    return features
@@ -0,0 +1,281 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Concurrent execution of the MSA searches of the AlphaFold data pipeline."""
+
+import logging
+import math
+import multiprocessing
+import os
+import resource
+import time
+from concurrent import futures
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+from alphafold.data import parsers
+from alphafold.data import pipeline
+
+from msa_features import make_msa_features
+
+DEFAULT_SEARCH_WEIGHTS = {
+    'uniref90': 1.0,
+    'mgnify': 1.0,
+    'bfd': 1.0,
+}
+
+
+def available_cpus() -> int:
+    """Returns the number of cores available to this process.
+
+    Honors cgroup (v2 and v1) CPU quotas set by container runtimes, then
+    the CPU affinity mask, then the total number of cores on the host.
+    """
+    quota = None
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            max_str, period_str = f.read().split()
+        if max_str != 'max':
+            quota = int(max_str) / int(period_str)
+    except (OSError, ValueError):
+        try:
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                quota_us = int(f.read())
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                period_us = int(f.read())
+            if quota_us > 0:
+                quota = quota_us / period_us
+        except (OSError, ValueError):
+            pass
+
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    if quota is not None:
+        cpus = min(cpus, max(1, math.floor(quota)))
+    return cpus
+
+
+def split_cpu_budget(
+    total_cpus: int,
+    weights: Mapping[str, float]
+) -> Dict[str, int]:
+    """Splits a number of cores across tasks proportionally to their weights.
+
+    Every task gets at least one core, so the budget can be oversubscribed
+    when there are more tasks than cores.
+    """
+    total_weight = sum(weights.values())
+    shares = {name: total_cpus * weight / total_weight
+              for name, weight in weights.items()}
+    budget = {name: max(1, math.floor(share))
+              for name, share in shares.items()}
+    remainder = total_cpus - sum(budget.values())
+    by_fraction = sorted(shares, key=lambda name: shares[name] - budget[name],
+                         reverse=True)
+    for name in by_fraction[:max(0, remainder)]:
+        budget[name] += 1
+    return budget
+
+
+def _cpu_time(usage: resource.struct_rusage) -> float:
+    return usage.ru_utime + usage.ru_stime
+
+
+def _timed_msa_search(
+    msa_runner: Any,
+    input_fasta_path: str,
+    msa_out_path: str,
+    msa_format: str,
+    use_precomputed_msas: bool,
+    max_sto_sequences: Optional[int]
+) -> Tuple[Mapping[str, Any], Dict[str, float]]:
+    """Runs an MSA tool and measures its wall time and CPU time."""
+    t_0 = time.time()
+    usage_0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+    result = pipeline.run_msa_tool(
+        msa_runner=msa_runner,
+        input_fasta_path=input_fasta_path,
+        msa_out_path=msa_out_path,
+        msa_format=msa_format,
+        use_precomputed_msas=use_precomputed_msas,
+        max_sto_sequences=max_sto_sequences)
+    usage_1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+    stats = {
+        'wall_time': time.time() - t_0,
+        'cpu_time': _cpu_time(usage_1) - _cpu_time(usage_0),
+    }
+    return result, stats
+
+
+class ConcurrentDataPipeline(pipeline.DataPipeline):
+    """Runs the monomer data pipeline with the MSA searches in parallel.
+
+    The uniref90, mgnify and BFD searches are independent, so they run in
+    separate worker processes that share a CPU budget. The template search
+    starts as soon as the uniref90 search completes. The resulting features
+    are the same as the ones of the sequential pipeline.
+
+    The CPU time of the template search is the CPU time of all child
+    processes this process reaped while it ran. It is process-wide, so when
+    several targets run in threads of one process, as in a data pipeline
+    batch, it includes search tools run for the other targets.
+    """
+
+    def __init__(self,
+                 *args,
+                 n_cpu: Optional[int] = None,
+                 search_weights: Optional[Mapping[str, float]] = None,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.n_cpu = n_cpu or available_cpus()
+        self.cpu_budget = split_cpu_budget(
+            self.n_cpu, search_weights or DEFAULT_SEARCH_WEIGHTS)
+        self.jackhmmer_uniref90_runner.n_cpu = self.cpu_budget['uniref90']
+        self.jackhmmer_mgnify_runner.n_cpu = self.cpu_budget['mgnify']
+        if self._use_small_bfd:
+            self.jackhmmer_small_bfd_runner.n_cpu = self.cpu_budget['bfd']
+        else:
+            self.hhblits_bfd_uniclust_runner.n_cpu = self.cpu_budget['bfd']
+        # Search stats of each processed sequence keyed by MSA output dir.
+        self.search_stats = {}
+        logging.info('MSA search CPU budget: %s', self.cpu_budget)
+
+    def process(self,
+                input_fasta_path: str,
+                msa_output_dir: str) -> pipeline.FeatureDict:
+        """Runs alignment tools on the input sequence and creates features."""
+        with open(input_fasta_path) as f:
+            input_fasta_str = f.read()
+        input_seqs, input_descs = parsers.parse_fasta(input_fasta_str)
+        if len(input_seqs) != 1:
+            raise ValueError(
+                f'More than one input sequence found in {input_fasta_path}.')
+        input_sequence = input_seqs[0]
+        input_description = input_descs[0]
+        num_res = len(input_sequence)
+
+        if self._use_small_bfd:
+            bfd_runner = self.jackhmmer_small_bfd_runner
+            bfd_out_path = os.path.join(msa_output_dir, 'small_bfd_hits.sto')
+            bfd_format = 'sto'
+        else:
+            bfd_runner = self.hhblits_bfd_uniclust_runner
+            bfd_out_path = os.path.join(
+                msa_output_dir, 'bfd_uniclust_hits.a3m')
+            bfd_format = 'a3m'
+        searches = {
+            'uniref90': (self.jackhmmer_uniref90_runner,
+                         os.path.join(msa_output_dir, 'uniref90_hits.sto'),
+                         'sto', self.uniref_max_hits),
+            'mgnify': (self.jackhmmer_mgnify_runner,
+                       os.path.join(msa_output_dir, 'mgnify_hits.sto'),
+                       'sto', self.mgnify_max_hits),
+            'bfd': (bfd_runner, bfd_out_path, bfd_format, None),
+        }
+
+        t_0 = time.time()
+        search_stats = {}
+        # Workers are spawned rather than forked from a process that may run
+        # other threads, e.g. of a batch of targets.
+        with futures.ProcessPoolExecutor(
+                max_workers=len(searches),
+                mp_context=multiprocessing.get_context('spawn')) as executor:
+            search_futures = {}
+            for name, (runner, out_path, msa_format, max_hits) in searches.items():
+                search_futures[name] = executor.submit(
+                    _timed_msa_search,
+                    msa_runner=runner,
+                    input_fasta_path=input_fasta_path,
+                    msa_out_path=out_path,
+                    msa_format=msa_format,
+                    use_precomputed_msas=self.use_precomputed_msas,
+                    max_sto_sequences=max_hits)
+
+            jackhmmer_uniref90_result, search_stats['uniref90'] = (
+                search_futures['uniref90'].result())
+
+            t_templates = time.time()
+            # Process-wide, unlike the CPU times of the worker processes.
+            usage_0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+            msa_for_templates = jackhmmer_uniref90_result['sto']
+            msa_for_templates = parsers.deduplicate_stockholm_msa(
+                msa_for_templates)
+            msa_for_templates = parsers.remove_empty_columns_from_stockholm_msa(
+                msa_for_templates)
+
+            if self.template_searcher.input_format == 'sto':
+                pdb_templates_result = self.template_searcher.query(
+                    msa_for_templates)
+            elif self.template_searcher.input_format == 'a3m':
+                uniref90_msa_as_a3m = parsers.convert_stockholm_to_a3m(
+                    msa_for_templates)
+                pdb_templates_result = self.template_searcher.query(
+                    uniref90_msa_as_a3m)
+            else:
+                raise ValueError('Unrecognized template input format: '
+                                 f'{self.template_searcher.input_format}')
+            usage_1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+            search_stats['templates'] = {
+                'wall_time': time.time() - t_templates,
+                'cpu_time': _cpu_time(usage_1) - _cpu_time(usage_0),
+            }
+
+            pdb_hits_out_path = os.path.join(
+                msa_output_dir,
+                f'pdb_hits.{self.template_searcher.output_format}')
+            with open(pdb_hits_out_path, 'w') as f:
+                f.write(pdb_templates_result)
+
+            jackhmmer_mgnify_result, search_stats['mgnify'] = (
+                search_futures['mgnify'].result())
+            bfd_result, search_stats['bfd'] = search_futures['bfd'].result()
+
+        search_stats['total_wall_time'] = time.time() - t_0
+        search_stats['total_cpu_time'] = sum(
+            stats['cpu_time'] for name, stats in search_stats.items()
+            if name != 'total_wall_time')
+        search_stats['cpu_budget'] = dict(self.cpu_budget)
+        self.search_stats[msa_output_dir] = search_stats
+        logging.info('MSA search stats: %s', search_stats)
+
+        uniref90_msa = parsers.parse_stockholm(jackhmmer_uniref90_result['sto'])
+        mgnify_msa = parsers.parse_stockholm(jackhmmer_mgnify_result['sto'])
+        if bfd_format == 'sto':
+            bfd_msa = parsers.parse_stockholm(bfd_result['sto'])
+        else:
+            bfd_msa = parsers.parse_a3m(bfd_result['a3m'])
+
+        pdb_template_hits = self.template_searcher.get_template_hits(
+            output_string=pdb_templates_result, input_sequence=input_sequence)
+        templates_result = self.template_featurizer.get_templates(
+            query_sequence=input_sequence,
+            hits=pdb_template_hits)
+
+        sequence_features = pipeline.make_sequence_features(
+            sequence=input_sequence,
+            description=input_description,
+            num_res=num_res)
+        msa_features = make_msa_features((uniref90_msa, bfd_msa, mgnify_msa))
+
+        logging.info('Uniref90 MSA size: %d sequences.', len(uniref90_msa))
+        logging.info('BFD MSA size: %d sequences.', len(bfd_msa))
+        logging.info('MGnify MSA size: %d sequences.', len(mgnify_msa))
+        logging.info('Final (deduplicated) MSA size: %d sequences.',
+                     msa_features['num_alignments'][0])
+        logging.info('Total number of templates (NB: this can include bad '
+                     'templates and is later filtered to top 4): %d.',
+                     templates_result.features['template_domain_names'].shape[0])
+
+        return {**sequence_features, **msa_features, **templates_result.features}
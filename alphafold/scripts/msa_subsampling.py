@@ -0,0 +1,218 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Diversity-aware capping of MSA depth."""
+
+import itertools
+import logging
+from typing import Any, Dict, List, Mapping, Sequence, Tuple
+
+from alphafold.data import parsers
+
+import numpy as np
+
+# Features with one row per aligned sequence.
+MSA_ROW_FEATURES = (
+    'msa',
+    'deletion_matrix_int',
+    'msa_species_identifiers',
+    'msa_uniprot_accession_identifiers',
+)
+# The gap residue ID of the 'msa' feature.
+_GAP_ID = 21
+# Number of rows compared with a cluster center at a time.
+_CHUNK_SIZE = 8192
+
+
+def _identity_to_row(
+    rows: np.ndarray,
+    non_gap_counts: np.ndarray,
+    index: int,
+    gap: int
+) -> np.ndarray:
+    """Returns the sequence identity of all rows to one row.
+
+    Identity is the number of identical residues divided by the number of
+    columns in which either of the two sequences has a residue.
+    """
+    center = rows[index]
+    columns = np.flatnonzero(center != gap)
+    center_residues = center[columns]
+    identity = np.empty(len(rows), dtype=np.float32)
+    for start in range(0, len(rows), _CHUNK_SIZE):
+        chunk = rows[start:start + _CHUNK_SIZE, columns]
+        matches = np.count_nonzero(chunk == center_residues, axis=1)
+        both = np.count_nonzero(chunk != gap, axis=1)
+        either = non_gap_counts[start:start + _CHUNK_SIZE] + len(columns) - both
+        identity[start:start + _CHUNK_SIZE] = matches / np.maximum(either, 1)
+    return identity
+
+
+def select_diverse_rows(
+    rows: np.ndarray,
+    gap: int,
+    max_depth: int,
+    num_clusters: int,
+    identity_threshold: float
+) -> Tuple[np.ndarray, int]:
+    """Selects up to max_depth diverse rows of an alignment matrix.
+
+    Rows are clustered around centers picked by farthest-point sampling: the
+    first row (the query) is the first center and every next center is the
+    row least identical to all centers so far. Clustering stops after
+    num_clusters centers or when every row is at least identity_threshold
+    identical to a center. Rows are then taken from the clusters round-robin
+    in their input order, so small clusters are kept whole and large clusters
+    of near-identical sequences are thinned out.
+
+    Returns sorted indices of the selected rows and the number of clusters.
+    """
+    num_rows = len(rows)
+    if num_rows <= max_depth:
+        return np.arange(num_rows), 0
+
+    non_gap_counts = np.count_nonzero(rows != gap, axis=1)
+    best_identity = np.full(num_rows, -1.0, dtype=np.float32)
+    assignment = np.zeros(num_rows, dtype=np.int64)
+    center = 0
+    for cluster in range(num_clusters):
+        identity = _identity_to_row(rows, non_gap_counts, center, gap)
+        closer = identity > best_identity
+        best_identity[closer] = identity[closer]
+        assignment[closer] = cluster
+        # A row with no residues is 0 identical even to itself, so it would
+        # be picked as the next center again.
+        best_identity[center] = 1.0
+        assignment[center] = cluster
+        center = int(np.argmin(best_identity))
+        if best_identity[center] >= identity_threshold:
+            break
+    num_clusters = cluster + 1
+
+    # Rank of every row within its cluster in input order.
+    order = np.lexsort((np.arange(num_rows), assignment))
+    cluster_starts = np.searchsorted(assignment[order], np.arange(num_clusters))
+    ranks = np.empty(num_rows, dtype=np.int64)
+    ranks[order] = np.arange(num_rows) - cluster_starts[assignment[order]]
+
+    selected = np.lexsort((assignment, ranks))[:max_depth]
+    return np.sort(selected), num_clusters
+
+
+class MsaSubsampler:
+    """Caps the depth of MSAs with diversity-aware subsampling.
+
+    Exact duplicate sequences are removed first. If more than max_depth
+    unique sequences remain, a diverse subset is selected with
+    select_diverse_rows.
+    """
+
+    def __init__(self,
+                 max_depth: int,
+                 num_clusters: int = 64,
+                 identity_threshold: float = 0.9):
+        self.max_depth = max_depth
+        self.num_clusters = num_clusters
+        self.identity_threshold = identity_threshold
+
+    def params(self) -> Dict[str, Any]:
+        return {
+            'max_depth': self.max_depth,
+            'num_clusters': self.num_clusters,
+            'identity_threshold': self.identity_threshold,
+        }
+
+    def _select(self, rows: np.ndarray, gap: int) -> Tuple[np.ndarray, int]:
+        return select_diverse_rows(
+            rows=rows,
+            gap=gap,
+            max_depth=self.max_depth,
+            num_clusters=self.num_clusters,
+            identity_threshold=self.identity_threshold)
+
+    def subsample_msas(
+        self,
+        msas: Sequence[parsers.Msa]
+    ) -> Tuple[List[parsers.Msa], Dict[str, Any]]:
+        """Returns subsampled MSAs and stats of the subsampling.
+
+        Every MSA keeps the order of its sequences. MSAs left without
+        sequences are dropped, except the first one, which holds the query.
+        """
+        stats = dict(self.params(), input_depth=sum(len(msa) for msa in msas))
+        sequences = list(itertools.chain.from_iterable(
+            msa.sequences for msa in msas))
+        num_res = len(sequences[0]) if sequences else 0
+        try:
+            sequences_bytes = ''.join(sequences).encode('ascii')
+        except UnicodeEncodeError:
+            sequences_bytes = None
+        if (num_res == 0 or sequences_bytes is None
+                or any(len(sequence) != num_res for sequence in sequences)):
+            logging.warning('MSAs are not aligned to the query, skipping '
+                            'subsampling')
+            return list(msas), dict(stats, output_depth=stats['input_depth'])
+
+        rows = np.frombuffer(sequences_bytes, dtype=np.uint8).reshape(-1, num_res)
+        records = rows.view(np.dtype((np.void, num_res))).ravel()
+        _, unique_indices = np.unique(records, return_index=True)
+        unique_indices = np.sort(unique_indices)
+        selected, num_clusters = self._select(rows[unique_indices], ord('-'))
+        keep = np.zeros(len(rows), dtype=bool)
+        keep[unique_indices[selected]] = True
+
+        subsampled_msas = []
+        offset = 0
+        for msa_index, msa in enumerate(msas):
+            msa_keep = np.flatnonzero(keep[offset:offset + len(msa)])
+            offset += len(msa)
+            if not len(msa_keep) and msa_index:
+                continue
+            subsampled_msas.append(parsers.Msa(
+                sequences=[msa.sequences[i] for i in msa_keep],
+                deletion_matrix=[msa.deletion_matrix[i] for i in msa_keep],
+                descriptions=[msa.descriptions[i] for i in msa_keep]))
+
+        stats.update(
+            unique_depth=len(unique_indices),
+            output_depth=int(keep.sum()),
+            clusters=num_clusters)
+        logging.info('MSA subsampling: %s', stats)
+        return subsampled_msas, stats
+
+    def subsample_features(
+        self,
+        features: Mapping[str, Any]
+    ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """Subsamples the MSA rows of monomer features.
+
+        The rows of make_msa_features output are already unique.
+        """
+        msa = features['msa']
+        # Residue IDs fit in a byte, which makes comparisons cheaper.
+        selected, num_clusters = self._select(msa.astype(np.uint8), _GAP_ID)
+        subsampled = dict(features)
+        for name in MSA_ROW_FEATURES:
+            if name in subsampled:
+                subsampled[name] = subsampled[name][selected]
+        subsampled['num_alignments'] = np.full_like(
+            features['num_alignments'], len(selected))
+
+        stats = dict(
+            self.params(),
+            input_depth=len(msa),
+            output_depth=len(selected),
+            clusters=num_clusters)
+        logging.info('MSA subsampling: %s', stats)
+        return subsampled, stats
@@ -0,0 +1,351 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Streaming utilities for MSA and template hit files."""
+
+import collections
+import hashlib
+import io
+import os
+import tempfile
+from typing import IO, Any, Dict, Iterator, List, Optional, Sequence, Set
+
+import numpy as np
+
+
+def _stockholm_stats(path: str) -> Dict[str, Any]:
+    """Counts sequences and alignment columns of a Stockholm file.
+
+    Sequences are counted in the first alignment block and columns are
+    summed over the first row of every block, so the file is scanned line
+    by line in constant memory.
+    """
+    num_sequences = 0
+    alignment_width = 0
+    block_index = 0
+    in_block = False
+    first_row_seen = False
+    with open(path) as f:
+        for line in f:
+            if not line.strip() or line.startswith('//'):
+                if in_block:
+                    block_index += 1
+                    in_block = False
+                    first_row_seen = False
+                continue
+            if line.startswith('#'):
+                continue
+            in_block = True
+            if block_index == 0:
+                num_sequences += 1
+            if not first_row_seen:
+                _, _, aligned_seq = line.rstrip().rpartition(' ')
+                alignment_width += len(aligned_seq)
+                first_row_seen = True
+    return {
+        'num_sequences': num_sequences,
+        'alignment_width': alignment_width,
+    }
+
+
+def _a3m_stats(path: str) -> Dict[str, Any]:
+    """Counts sequences and query match columns of an A3M file."""
+    num_sequences = 0
+    alignment_width = 0
+    with open(path) as f:
+        for line in f:
+            if line.startswith('>'):
+                num_sequences += 1
+            elif num_sequences == 1:
+                # Lowercase residues are insertions with respect to the query.
+                alignment_width += sum(
+                    1 for res in line.strip() if not res.islower())
+    return {
+        'num_sequences': num_sequences,
+        'alignment_width': alignment_width,
+    }
+
+
+def _hhr_stats(path: str) -> Dict[str, Any]:
+    """Counts template hits of an HHR file."""
+    num_hits = 0
+    with open(path) as f:
+        for line in f:
+            if line.startswith('No '):
+                num_hits += 1
+    return {
+        'num_sequences': num_hits,
+        'alignment_width': None,
+    }
+
+
+def msa_file_stats(path: str) -> Dict[str, Any]:
+    """Returns the sequence count, alignment width and size of an MSA file.
+
+    The counts match the lengths of the objects returned by the AlphaFold
+    parsers without loading the file into memory.
+    """
+    file_format = path.split('.')[-1]
+    if file_format == 'sto':
+        stats = _stockholm_stats(path)
+    elif file_format == 'a3m':
+        stats = _a3m_stats(path)
+    elif file_format == 'hhr':
+        stats = _hhr_stats(path)
+    else:
+        raise ValueError('Unknown artifact type')
+    stats['file_size'] = os.path.getsize(path)
+    return stats
+
+
+def _is_alignment_line(line: str) -> bool:
+    return bool(line.strip()) and not line.startswith(('#', '//'))
+
+
+def _keep_line(line: str, seqnames: Set[str]) -> bool:
+    """Mirrors the line filter of parsers.deduplicate_stockholm_msa."""
+    if not line.strip():
+        return True
+    elif line.strip() == '//':
+        return True
+    elif line.startswith('# STOCKHOLM'):
+        return True
+    elif line.startswith('#=GC RF'):
+        return True
+    elif line[:4] == '#=GS':
+        _, seqname, _ = line.split(maxsplit=2)
+        return seqname in seqnames
+    elif line.startswith('#'):
+        return False
+    else:
+        seqname = line.partition(' ')[0]
+        return seqname in seqnames
+
+
+def _iter_lines(path: str) -> Iterator[str]:
+    with open(path) as f:
+        for line in f:
+            yield line.rstrip('\n')
+
+
+def _to_array(alignment: str) -> np.ndarray:
+    return np.frombuffer(alignment.encode(), dtype=np.uint8)
+
+
+def _compress(alignment: str, mask: np.ndarray) -> str:
+    length = min(len(alignment), len(mask))
+    return _to_array(alignment[:length])[mask[:length]].tobytes().decode()
+
+
+def _unique_seqnames(path: str, max_sequences: Optional[int]) -> Set[str]:
+    """Returns names of sequences that are unique when ignoring insertions.
+
+    Per-sequence hashes of the alignment with query insert columns removed
+    are accumulated block by block, so the MSA is never held in memory.
+    """
+    hashes = collections.OrderedDict()
+    query_seqname = None
+    block_mask = None
+    pending = []
+
+    def update(seqname, alignment):
+        if seqname not in hashes:
+            hashes[seqname] = hashlib.sha1()
+        hashes[seqname].update(_compress(alignment, block_mask).encode())
+
+    for line in _iter_lines(path):
+        if not line.strip():
+            block_mask = None
+            continue
+        if not _is_alignment_line(line):
+            continue
+        seqname, alignment = line.strip().split()
+        if query_seqname is None:
+            query_seqname = seqname
+        if seqname == query_seqname:
+            # The query defines which columns are insertions in this block.
+            block_mask = _to_array(alignment) != ord('-')
+            if seqname not in hashes:
+                hashes[seqname] = hashlib.sha1()
+            for pending_seqname, pending_alignment in pending:
+                update(pending_seqname, pending_alignment)
+            pending = []
+            hashes[seqname].update(_compress(alignment, block_mask).encode())
+        elif block_mask is None:
+            hashes.setdefault(seqname, hashlib.sha1())
+            pending.append((seqname, alignment))
+        else:
+            update(seqname, alignment)
+
+    seen_digests = set()
+    seqnames = set()
+    for seqname, seq_hash in hashes.items():
+        if max_sequences is not None and len(seqnames) >= max_sequences:
+            break
+        digest = seq_hash.digest()
+        if digest in seen_digests:
+            continue
+        seen_digests.add(digest)
+        seqnames.add(seqname)
+    return seqnames
+
+
+def _non_empty_column_masks(path: str, seqnames: Set[str]) -> List[np.ndarray]:
+    """Returns masks of the columns that are not all gaps for each chunk.
+
+    A chunk ends with a '#=GC RF' line, like in
+    parsers.remove_empty_columns_from_stockholm_msa.
+    """
+    masks = []
+    chunk_mask = None
+    for line in _iter_lines(path):
+        if line.startswith('#=GC RF'):
+            _, _, reference = line.rpartition(' ')
+            mask = np.zeros(len(reference), dtype=bool)
+            if chunk_mask is not None:
+                length = min(len(mask), len(chunk_mask))
+                mask[:length] = chunk_mask[:length]
+            masks.append(mask)
+            chunk_mask = None
+        elif _is_alignment_line(line) and _keep_line(line, seqnames):
+            _, _, alignment = line.rpartition(' ')
+            non_gaps = _to_array(alignment) != ord('-')
+            if chunk_mask is None:
+                chunk_mask = non_gaps
+            else:
+                if len(non_gaps) > len(chunk_mask):
+                    non_gaps, chunk_mask = chunk_mask, non_gaps
+                chunk_mask = chunk_mask.copy()
+                chunk_mask[:len(non_gaps)] |= non_gaps
+    if chunk_mask is not None:
+        raise ValueError(f'Alignment lines after the last #=GC RF line in {path}')
+    return masks
+
+
+def _iter_preprocessed_stockholm(path: str,
+                                 max_sequences: Optional[int]) -> Iterator[str]:
+    """Yields lines of the deduplicated MSA with empty columns removed."""
+    seqnames = _unique_seqnames(path, max_sequences)
+    masks = _non_empty_column_masks(path, seqnames)
+    chunk_index = 0
+    for line in _iter_lines(path):
+        if not _keep_line(line, seqnames):
+            continue
+        is_reference = line.startswith('#=GC RF')
+        if not is_reference and not _is_alignment_line(line):
+            yield line
+            continue
+        mask = masks[chunk_index]
+        if not mask.any():
+            # Every column of the chunk is empty.
+            yield ''
+        else:
+            prefix, _, alignment = line.rpartition(' ')
+            yield f'{prefix} {_compress(alignment, mask)}'
+        if is_reference:
+            chunk_index += 1
+
+
+def _convert_sto_seq_to_a3m(
+    query_non_gaps: Sequence[bool],
+    sto_seq: str
+) -> Iterator[str]:
+    for is_query_res_non_gap, sequence_res in zip(query_non_gaps, sto_seq):
+        if is_query_res_non_gap:
+            yield sequence_res
+        elif sequence_res != '-':
+            yield sequence_res.lower()
+
+
+def _write_a3m(lines: Iterator[str], output: IO[str]):
+    """Converts preprocessed Stockholm lines to A3M.
+
+    Sequences can span several alignment blocks, so their fragments are
+    spooled to a temporary file and assembled one sequence at a time.
+    """
+    fragments = collections.OrderedDict()
+    descriptions = {}
+    description_lines = []
+    with tempfile.TemporaryFile() as spool:
+        offset = 0
+        for line in lines:
+            if _is_alignment_line(line):
+                seqname, aligned_seq = line.split(maxsplit=1)
+                aligned_seq = aligned_seq.encode()
+                spool.write(aligned_seq)
+                fragments.setdefault(seqname, []).append(
+                    (offset, len(aligned_seq)))
+                offset += len(aligned_seq)
+            elif line[:4] == '#=GS':
+                description_lines.append(line)
+
+        for line in description_lines:
+            columns = line.split(maxsplit=3)
+            seqname, feature = columns[1:3]
+            value = columns[3] if len(columns) == 4 else ''
+            if feature != 'DE':
+                continue
+            descriptions[seqname] = value
+            if len(descriptions) == len(fragments):
+                break
+
+        def read_sequence(seqname):
+            chunks = []
+            for chunk_offset, length in fragments[seqname]:
+                spool.seek(chunk_offset)
+                chunks.append(spool.read(length))
+            return b''.join(chunks).decode()
+
+        query_sequence = read_sequence(next(iter(fragments)))
+        query_non_gaps = [res != '-' for res in query_sequence]
+        for index, seqname in enumerate(fragments):
+            out_sequence = read_sequence(seqname).replace('.', '')
+            out_sequence = ''.join(
+                _convert_sto_seq_to_a3m(query_non_gaps, out_sequence))
+            if index:
+                output.write('\n')
+            output.write(f'>{seqname} {descriptions.get(seqname, "")}\n')
+            output.write(out_sequence)
+        output.write('\n')
+
+
+def preprocess_stockholm_for_templates(
+    stockholm_path: str,
+    output_format: str = 'sto',
+    max_sequences: Optional[int] = None
+) -> str:
+    """Prepares a Stockholm MSA file as template search input in bounded memory.
+
+    Produces the same output as reading the file and applying
+    parsers.deduplicate_stockholm_msa,
+    parsers.remove_empty_columns_from_stockholm_msa and, for the 'a3m'
+    output format, parsers.convert_stockholm_to_a3m. The file is streamed in
+    a few passes instead of being copied in memory by every step, so memory
+    is bounded by the output and per-sequence hashes.
+
+    If max_sequences is set, only the first max_sequences unique sequences
+    (including the query) are kept.
+    """
+    if output_format not in ('sto', 'a3m'):
+        raise ValueError(f'Unsupported output format: {output_format}')
+    lines = _iter_preprocessed_stockholm(stockholm_path, max_sequences)
+    output = io.StringIO()
+    if output_format == 'sto':
+        for index, line in enumerate(lines):
+            if index:
+                output.write('\n')
+            output.write(line)
+    else:
+        _write_a3m(lines, output)
+    return output.getvalue()
@@ -0,0 +1,110 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Memory-mapped model parameters shared by the processes on a host.
+
+AlphaFold reads every parameter archive into memory in each process that
+loads a model. A parameter store converts each archive once into the
+memory-mappable format of feature_io, with uncompressed 64-byte aligned
+arrays. Processes map the converted files read-only, so they share the
+parameter pages through the page cache.
+"""
+
+import contextlib
+import fcntl
+import io
+import json
+import logging
+import os
+import time
+from typing import Dict
+
+from alphafold.model import utils
+
+import haiku as hk
+import numpy as np
+
+import feature_io
+from msa_cache import fingerprint_database
+
+_LOCK_FILE = '.lock'
+
+
+def npz_params_path(model_params_path: str, model_name: str) -> str:
+    """Returns the path of a parameter archive in an AlphaFold data dir."""
+    return os.path.join(model_params_path, 'params', f'params_{model_name}.npz')
+
+
+def load_npz_params(path: str) -> Dict[str, np.ndarray]:
+    """Loads flat parameters from an archive like AlphaFold does."""
+    with open(path, 'rb') as f:
+        params = np.load(io.BytesIO(f.read()), allow_pickle=False)
+    return {name: params[name] for name in params.files}
+
+
+class ParamsStore:
+    """A directory of model parameters converted to the mapped format.
+
+    A converted file is described by a marker holding the fingerprint of
+    its source archive and is converted again when the archive changes.
+    Conversions hold an exclusive lock on the store directory, so processes
+    starting together on a host convert every archive only once.
+    """
+
+    def __init__(self, store_path: str):
+        self.store_path = store_path
+        os.makedirs(store_path, exist_ok=True)
+
+    @contextlib.contextmanager
+    def _lock(self):
+        with open(os.path.join(self.store_path, _LOCK_FILE), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def path(self, model_name: str) -> str:
+        return os.path.join(self.store_path, f'params_{model_name}.mapped')
+
+    def convert(self, model_name: str, model_params_path: str) -> str:
+        """Converts the parameters of a model if needed and returns the path."""
+        source_path = npz_params_path(model_params_path, model_name)
+        fingerprint = [[os.path.basename(path), size, mtime]
+                       for path, size, mtime in fingerprint_database(source_path)]
+        if not fingerprint:
+            raise FileNotFoundError(source_path)
+        path = self.path(model_name)
+        marker_path = path + '.json'
+
+        with self._lock():
+            if os.path.exists(marker_path):
+                with open(marker_path) as f:
+                    if json.load(f)['fingerprint'] == fingerprint:
+                        return path
+                os.remove(marker_path)
+
+            logging.info('Converting parameters %s to %s', source_path, path)
+            t_0 = time.time()
+            feature_io.write_mapped_features(
+                load_npz_params(source_path), path)
+            with open(marker_path, 'w') as f:
+                json.dump({'source': source_path, 'fingerprint': fingerprint}, f)
+            logging.info('Converted parameters in %.1fs', time.time() - t_0)
+        return path
+
+    def load(self, model_name: str, model_params_path: str) -> hk.Params:
+        """Returns the parameters of a model as read-only mapped arrays."""
+        path = self.convert(model_name, model_params_path)
+        return utils.flat_params_to_haiku(feature_io.read_mapped_features(path))
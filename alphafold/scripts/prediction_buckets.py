@@ -0,0 +1,331 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Shape bucketing and compilation caching of model inference.
+
+XLA compiles the model for every distinct input shape. Padding inputs to a
+small set of bucket shapes lets predictions of different targets share
+compiled executables, in one process and, with the persistent compilation
+cache, across tasks.
+"""
+
+import logging
+import os
+import time
+import weakref
+from typing import Any, Dict, Mapping, Optional, Sequence, Tuple
+
+from alphafold.model import features
+from alphafold.model import model
+from alphafold.model.tf import input_pipeline
+from alphafold.model.tf import proteins_dataset
+
+import jax
+import numpy as np
+import tensorflow.compat.v1 as tf
+
+from adaptive_recycling import AdaptiveRecycling
+
+# Leading axes of the raw multimer features that are padded. 'res' axes are
+# padded to the residue bucket and 'msa' axes to the MSA depth bucket.
+_MULTIMER_FEATURE_AXES = {
+    'aatype': ('res',),
+    'residue_index': ('res',),
+    'seq_mask': ('res',),
+    'asym_id': ('res',),
+    'sym_id': ('res',),
+    'entity_id': ('res',),
+    'entity_mask': ('res',),
+    'deletion_mean': ('res',),
+    'all_atom_mask': ('res',),
+    'all_atom_positions': ('res',),
+    'msa': ('msa', 'res'),
+    'msa_mask': ('msa', 'res'),
+    'deletion_matrix': ('msa', 'res'),
+    'bert_mask': ('msa', 'res'),
+    'cluster_bias_mask': ('msa',),
+    'template_aatype': (None, 'res'),
+    'template_all_atom_mask': (None, 'res'),
+    'template_all_atom_positions': (None, 'res'),
+}
+# Model outputs whose first axis is not a residue axis.
+_LEADING_AXIS_OUTPUTS = (
+    'masked_msa',
+    'representations/msa',
+    'structure_module/sidechains',
+    'structure_module/traj',
+)
+# Buckets must be larger than the number of distogram and PAE bins, so
+# that bin axes are not mistaken for residue axes when un-padding.
+_MIN_NUM_RES_BUCKET = 65
+
+# Compiled executables of every model runner by input shapes.
+_EXECUTABLES = weakref.WeakKeyDictionary()
+
+
+def enable_compilation_cache(cache_path: str):
+    """Enables the persistent compilation cache of JAX in a directory.
+
+    The directory can be shared by tasks that run the same models on the
+    same accelerator type.
+    """
+    if '://' not in cache_path:
+        os.makedirs(cache_path, exist_ok=True)
+    try:
+        jax.config.update('jax_compilation_cache_dir', cache_path)
+    except AttributeError:
+        # Older JAX versions configure the cache through the experimental API.
+        from jax.experimental.compilation_cache import compilation_cache
+        compilation_cache.initialize_cache(cache_path)
+    logging.info('Using the JAX compilation cache in %s', cache_path)
+
+
+def _bucket(size: int, buckets: Sequence[int]) -> int:
+    """Returns the smallest bucket that fits a size or the size itself."""
+    for bucket in buckets:
+        if bucket >= size:
+            return bucket
+    logging.warning('Size %d exceeds the largest bucket, not padding', size)
+    return size
+
+
+class ShapeBuckets:
+    """Sizes to which the number of residues and the MSA depth are padded.
+
+    Monomer models process MSAs to a depth fixed by the model config, so
+    only the residues of monomer features are padded.
+    """
+
+    def __init__(self,
+                 num_res_buckets: Sequence[int],
+                 msa_depth_buckets: Optional[Sequence[int]] = None):
+        self.num_res_buckets = sorted(num_res_buckets)
+        self.msa_depth_buckets = sorted(msa_depth_buckets or [])
+        if self.num_res_buckets and self.num_res_buckets[0] < _MIN_NUM_RES_BUCKET:
+            raise ValueError(f'Residue buckets must be at least '
+                             f'{_MIN_NUM_RES_BUCKET}')
+
+    def params(self) -> Dict[str, Any]:
+        return {
+            'num_res_buckets': self.num_res_buckets,
+            'msa_depth_buckets': self.msa_depth_buckets,
+        }
+
+    def padded_num_res(self, num_res: int) -> int:
+        return _bucket(num_res, self.num_res_buckets)
+
+    def padded_msa_depth(self, msa_depth: int) -> int:
+        return _bucket(msa_depth, self.msa_depth_buckets)
+
+
+def _process_monomer_features(
+    model_runner: model.RunModel,
+    raw_features: Mapping[str, Any],
+    random_seed: int,
+    padded_num_res: int
+) -> Dict[str, np.ndarray]:
+    """Processes monomer features and pads them to a number of residues.
+
+    Follows features.np_example_to_features with the crop size of the input
+    pipeline raised to the padded size. The pipeline pads all residue axes
+    and sets the sequence, MSA, template and atom masks of padding to zero.
+    """
+    np_example = dict(raw_features)
+    num_res = int(np_example['seq_length'][0])
+    cfg, feature_names = features.make_data_config(
+        model_runner.config, num_res=num_res)
+    with cfg.unlocked():
+        cfg.eval.crop_size = padded_num_res
+
+    if 'deletion_matrix_int' in np_example:
+        np_example['deletion_matrix'] = (
+            np_example.pop('deletion_matrix_int').astype(np.float32))
+
+    tf_graph = tf.Graph()
+    with tf_graph.as_default(), tf.device('/device:CPU:0'):
+        tf.compat.v1.set_random_seed(random_seed)
+        tensor_dict = proteins_dataset.np_to_tensor_dict(
+            np_example=np_example, features=feature_names)
+        processed_batch = input_pipeline.process_tensors_from_config(
+            tensor_dict, cfg)
+    tf_graph.finalize()
+
+    with tf.Session(graph=tf_graph) as sess:
+        processed_features = sess.run(processed_batch)
+
+    return {k: v for k, v in processed_features.items() if v.dtype != 'O'}
+
+
+def _pad_multimer_features(
+    raw_features: Mapping[str, Any],
+    padded_num_res: int,
+    padded_msa_depth: int
+) -> Dict[str, Any]:
+    """Pads raw multimer features with zeros, which mask the padding."""
+    sizes = {'res': padded_num_res, 'msa': padded_msa_depth}
+    padded_features = {}
+    for name, value in raw_features.items():
+        axes = _MULTIMER_FEATURE_AXES.get(name)
+        if axes is None:
+            padded_features[name] = value
+            continue
+        pad_width = [(0, 0)] * np.ndim(value)
+        for axis, kind in enumerate(axes):
+            if kind:
+                pad_width[axis] = (0, sizes[kind] - np.shape(value)[axis])
+        padded_features[name] = np.pad(value, pad_width)
+    return padded_features
+
+
+def process_features(
+    model_runner: model.RunModel,
+    raw_features: Mapping[str, Any],
+    random_seed: int,
+    shape_buckets: Optional[ShapeBuckets] = None
+) -> Tuple[Dict[str, Any], Dict[str, int]]:
+    """Processes raw features and pads them to the bucket shapes.
+
+    Returns the processed features and the actual and padded sizes.
+    """
+    if model_runner.multimer_mode:
+        num_res = int(np.shape(raw_features['aatype'])[0])
+        msa_depth = int(np.shape(raw_features['msa'])[0])
+    else:
+        num_res = int(raw_features['seq_length'][0])
+        msa_depth = None
+    shape = {
+        'num_res': num_res,
+        'padded_num_res': num_res,
+        'msa_depth': msa_depth,
+        'padded_msa_depth': msa_depth,
+    }
+    if not shape_buckets:
+        return model_runner.process_features(
+            raw_features, random_seed=random_seed), shape
+
+    shape['padded_num_res'] = shape_buckets.padded_num_res(num_res)
+    if model_runner.multimer_mode:
+        shape['padded_msa_depth'] = shape_buckets.padded_msa_depth(msa_depth)
+        processed_features = _pad_multimer_features(
+            raw_features, shape['padded_num_res'], shape['padded_msa_depth'])
+    else:
+        processed_features = _process_monomer_features(
+            model_runner, raw_features, random_seed, shape['padded_num_res'])
+    logging.info('Padded features from %d to %d residues', num_res,
+                 shape['padded_num_res'])
+    return processed_features, shape
+
+
+def _unpad_result(value: Any, num_res: int, padded_num_res: int,
+                  path: str = '') -> Any:
+    """Removes padded residues from the leading residue axes of outputs."""
+    if isinstance(value, Mapping):
+        return {key: _unpad_result(item, num_res, padded_num_res,
+                                   f'{path}/{key}' if path else key)
+                for key, item in value.items()}
+    value = np.asarray(value)
+    start = 1 if any(path == name or path.startswith(name + '/')
+                     for name in _LEADING_AXIS_OUTPUTS) else 0
+    index = [slice(None)] * value.ndim
+    for axis in range(start, value.ndim):
+        if value.shape[axis] != padded_num_res:
+            break
+        index[axis] = slice(0, num_res)
+    return value[tuple(index)]
+
+
+def structure_features(
+    processed_features: Mapping[str, Any],
+    shape: Mapping[str, int],
+    multimer_mode: bool
+) -> Dict[str, np.ndarray]:
+    """Returns the features protein.from_prediction reads, without padding."""
+    # Monomer features have a leading ensemble axis.
+    axis = 0 if multimer_mode else 1
+    names = ['aatype', 'residue_index']
+    if 'asym_id' in processed_features:
+        names.append('asym_id')
+    return {name: np.take(processed_features[name],
+                          np.arange(shape['num_res']), axis=axis)
+            for name in names}
+
+
+def _run_compiled(
+    model_runner: model.RunModel,
+    processed_features: Mapping[str, Any],
+    random_seed: int,
+    timings: Optional[Dict[str, float]]
+) -> Dict[str, Any]:
+    """Compiles a model for its inputs if needed and runs it."""
+    model_runner.init_params(processed_features)
+    shape_key = tuple(sorted(
+        (name, np.shape(value), str(np.asarray(value).dtype))
+        for name, value in processed_features.items()))
+    executables = _EXECUTABLES.setdefault(model_runner, {})
+    rng = jax.random.PRNGKey(random_seed)
+
+    t_0 = time.time()
+    executable = executables.get(shape_key)
+    if executable is None:
+        executable = model_runner.apply.lower(
+            model_runner.params, rng, processed_features).compile()
+        executables[shape_key] = executable
+    compile_time = time.time() - t_0
+
+    t_0 = time.time()
+    result = executable(model_runner.params, rng, processed_features)
+    jax.tree_map(lambda x: x.block_until_ready(), result)
+    execute_time = time.time() - t_0
+    logging.info('Compile time %.1fs, execution time %.1fs',
+                 compile_time, execute_time)
+    if timings is not None:
+        timings['compile'] = compile_time
+        timings['execute'] = execute_time
+    return result
+
+
+def run_model(
+    model_runner: model.RunModel,
+    processed_features: Mapping[str, Any],
+    random_seed: int,
+    shape: Mapping[str, int],
+    timings: Optional[Dict[str, float]] = None,
+    recycling: Optional[AdaptiveRecycling] = None,
+    recycling_stats: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """Runs a model on processed features and un-pads its outputs.
+
+    Equivalent to model_runner.predict, except that the model is compiled
+    ahead of the run, so compile time and execution time are measured
+    separately. Compiled executables are kept for every model runner and
+    input shapes. Confidence metrics are computed from the un-padded
+    outputs. If adaptive recycling is given, recycling stops once the
+    structure converges and its stats are added to recycling_stats.
+    """
+    if recycling:
+        result = recycling.run(
+            model_runner=model_runner,
+            processed_features=processed_features,
+            random_seed=random_seed,
+            num_res=shape['num_res'],
+            timings=timings,
+            stats=recycling_stats)
+    else:
+        result = _run_compiled(
+            model_runner, processed_features, random_seed, timings)
+
+    result = _unpad_result(result, shape['num_res'], shape['padded_num_res'])
+    result.update(model.get_confidence_metrics(
+        result, multimer_mode=model_runner.multimer_mode))
+    return result
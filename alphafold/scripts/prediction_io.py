@@ -0,0 +1,154 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistence of raw prediction results under a configurable output policy."""
+
+import gzip
+import logging
+import os
+import pickle
+from typing import Any, Dict, Mapping, Optional, Sequence
+
+import numpy as np
+
+# Result fields used by downstream tools. They are always saved and never
+# downcast.
+LOSSLESS_KEYS = (
+    'plddt',
+    'ranking_confidence',
+    'predicted_aligned_error',
+    'max_predicted_aligned_error',
+    'ptm',
+    'iptm',
+)
+COMPRESSIONS = ('none', 'gzip')
+
+_GZIP_MAGIC = b'\x1f\x8b'
+# Size of the uncompressed chunks handed to the compressor.
+_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class PredictionOutputPolicy:
+    """Selects, downcasts and compresses the saved prediction result.
+
+    Keys are paths into the nested result dict joined with '/', for example
+    'distogram' or 'structure_module/final_atom_positions'. If keep_keys is
+    set, only fields under the listed paths and the LOSSLESS_KEYS are saved.
+    With downcast_float16, other floating point arrays are saved as float16.
+    """
+
+    def __init__(self,
+                 keep_keys: Optional[Sequence[str]] = None,
+                 downcast_float16: bool = False,
+                 compression: str = 'none',
+                 compression_level: int = 6):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f'Unsupported compression: {compression}')
+        self.keep_keys = list(keep_keys) if keep_keys is not None else None
+        self.downcast_float16 = downcast_float16
+        self.compression = compression
+        self.compression_level = compression_level
+
+    def _matches(self, path: str, keys: Sequence[str]) -> bool:
+        return any(path == key or path.startswith(key + '/') for key in keys)
+
+    def keeps(self, path: str) -> bool:
+        if self.keep_keys is None or self._matches(path, LOSSLESS_KEYS):
+            return True
+        return self._matches(path, self.keep_keys)
+
+    def apply(self, value: Any, path: str = '') -> Any:
+        """Returns the part of a result that is saved under this policy."""
+        if isinstance(value, Mapping):
+            selected = {}
+            for key, item in value.items():
+                item_path = f'{path}/{key}' if path else key
+                if isinstance(item, Mapping) or self.keeps(item_path):
+                    item = self.apply(item, item_path)
+                    if not isinstance(item, dict) or item:
+                        selected[key] = item
+            return selected
+        if (self.downcast_float16
+                and isinstance(value, np.ndarray)
+                and np.issubdtype(value.dtype, np.floating)
+                and value.dtype.itemsize > 2
+                and not self._matches(path, LOSSLESS_KEYS)):
+            return value.astype(np.float16)
+        return value
+
+
+def result_nbytes(value: Any) -> int:
+    """Returns the approximate in-memory size of a nested result."""
+    if isinstance(value, Mapping):
+        return sum(result_nbytes(item) for item in value.values())
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    return np.asarray(value).nbytes
+
+
+class _ChunkedWriter:
+    """Splits large writes into chunks before passing them to a file."""
+
+    def __init__(self, f):
+        self._f = f
+
+    def write(self, data) -> int:
+        view = memoryview(data).cast('B')
+        for start in range(0, len(view), _CHUNK_SIZE):
+            self._f.write(view[start:start + _CHUNK_SIZE])
+        return len(view)
+
+
+def save_prediction_result(
+    prediction_result: Mapping[str, Any],
+    path: str,
+    policy: Optional[PredictionOutputPolicy] = None
+) -> Dict[str, Any]:
+    """Saves a prediction result as a pickle, possibly gzip compressed.
+
+    Returns the in-memory size of the arrays of the full result, the number
+    of bytes written and the difference. The full size is not measured by
+    pickling the result, which would serialize it a second time.
+    """
+    policy = policy or PredictionOutputPolicy()
+    full_bytes = result_nbytes(prediction_result)
+
+    saved_result = policy.apply(prediction_result)
+    if policy.compression == 'gzip':
+        with gzip.open(path, 'wb',
+                       compresslevel=policy.compression_level) as f:
+            pickle.dump(saved_result, _ChunkedWriter(f), protocol=4)
+    else:
+        with open(path, 'wb') as f:
+            pickle.dump(saved_result, f, protocol=4)
+
+    written_bytes = os.path.getsize(path)
+    stats = {
+        'full_bytes': full_bytes,
+        'written_bytes': written_bytes,
+        'bytes_saved': full_bytes - written_bytes,
+    }
+    logging.info('Saved prediction result to %s: %s', path, stats)
+    return stats
+
+
+def load_prediction_result(path: str) -> Dict[str, Any]:
+    """Loads a prediction result saved with or without compression."""
+    with open(path, 'rb') as f:
+        magic = f.read(len(_GZIP_MAGIC))
+    if magic == _GZIP_MAGIC:
+        with gzip.open(path, 'rb') as f:
+            return pickle.load(f)
+    with open(path, 'rb') as f:
+        return pickle.load(f)
@@ -0,0 +1,232 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A pool of pinned worker processes that steal work from each other.
+
+Tasks are grouped, e.g. by model, and whole groups are assigned to workers
+up front, so each worker loads the models of its groups once. A worker that
+runs out of tasks takes the last task of the worker with the most remaining
+tasks, which evens out tasks with uneven run times. Every worker can be
+pinned to GPUs and to a subset of the CPU cores of the host.
+"""
+
+import collections
+import contextlib
+import logging
+import multiprocessing
+import os
+import queue
+import time
+import traceback
+from typing import Any, Callable, Dict, List, Mapping, Optional, Sequence, Tuple
+
+# How often the pool checks that its workers are alive while waiting.
+_POLL_INTERVAL = 1.0
+
+
+def split_cpus(num_workers: int) -> List[List[int]]:
+    """Splits the cores available to this process into contiguous subsets."""
+    cpus = sorted(os.sched_getaffinity(0))
+    if num_workers >= len(cpus):
+        return [[cpus[i % len(cpus)]] for i in range(num_workers)]
+    size, remainder = divmod(len(cpus), num_workers)
+    subsets = []
+    start = 0
+    for i in range(num_workers):
+        end = start + size + (1 if i < remainder else 0)
+        subsets.append(cpus[start:end])
+        start = end
+    return subsets
+
+
+@contextlib.contextmanager
+def _environment(env: Mapping[str, str]):
+    """Sets environment variables that spawned processes inherit."""
+    saved = {name: os.environ.get(name) for name in env}
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def _worker(
+    worker_index: int,
+    cpus: Optional[Sequence[int]],
+    task_fn: Callable[..., Any],
+    task_queue: multiprocessing.Queue,
+    result_queue: multiprocessing.Queue
+):
+    """Runs tasks until it gets None. State is kept between tasks."""
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    state = {}
+    result_queue.put(('ready', worker_index, None, None))
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        task_id, args = task
+        try:
+            result = task_fn(state, *args)
+        except Exception:
+            result_queue.put(('error', worker_index, task_id,
+                              traceback.format_exc()))
+            break
+        result_queue.put(('done', worker_index, task_id, result))
+
+
+def _assign_groups(
+    tasks: Sequence[Tuple[Any, Sequence[Any]]],
+    num_workers: int
+) -> List[collections.deque]:
+    """Assigns groups of tasks to the workers with the fewest tasks.
+
+    Tasks keep their order within every worker.
+    """
+    groups = collections.OrderedDict()
+    for task_id, (group, _) in enumerate(tasks):
+        groups.setdefault(group, []).append(task_id)
+    assigned = [[] for _ in range(num_workers)]
+    # Larger groups first, so the loads end up balanced.
+    for task_ids in sorted(groups.values(), key=len, reverse=True):
+        worker_index = min(range(num_workers), key=lambda i: len(assigned[i]))
+        assigned[worker_index].extend(task_ids)
+    return [collections.deque(sorted(task_ids)) for task_ids in assigned]
+
+
+def run_tasks(
+    task_fn: Callable[..., Any],
+    tasks: Sequence[Tuple[Any, Sequence[Any]]],
+    num_workers: int,
+    gpu_devices: Optional[Sequence[str]] = None,
+    pin_cpus: bool = True,
+    stats: Optional[Dict[str, Any]] = None
+) -> List[Any]:
+    """Runs tasks in worker processes and returns the results in task order.
+
+    Every task is a (group, args) tuple. A worker calls task_fn(state,
+    *args), where state is a dict the worker keeps between its tasks.
+    task_fn must be a module-level function, as workers are spawned.
+
+    If gpu_devices is given, it must have an entry per worker with the
+    CUDA_VISIBLE_DEVICES of the worker, e.g. '0' or '2,3'. Otherwise every
+    worker sees all GPUs, so several workers allocate GPU memory on demand
+    instead of preallocating it. If pin_cpus is set, every worker is pinned
+    to its own subset of the cores. If a stats dict is given, the worker and
+    the run time of every task and the number of stolen tasks are added to
+    it.
+    """
+    if gpu_devices is not None and len(gpu_devices) != num_workers:
+        raise ValueError(f'Expected {num_workers} GPU devices, got '
+                         f'{len(gpu_devices)}')
+    num_workers = max(1, min(num_workers, len(tasks)))
+    if gpu_devices is not None:
+        gpu_devices = gpu_devices[:num_workers]
+    cpu_subsets = split_cpus(num_workers) if pin_cpus else [None] * num_workers
+    pending = _assign_groups(tasks, num_workers)
+
+    context = multiprocessing.get_context('spawn')
+    result_queue = context.Queue()
+    task_queues = []
+    processes = []
+    for worker_index in range(num_workers):
+        env = {}
+        if gpu_devices is not None:
+            env['CUDA_VISIBLE_DEVICES'] = gpu_devices[worker_index]
+        elif num_workers > 1:
+            # Each worker would preallocate most of the memory of the GPUs
+            # it shares with the other workers.
+            env['XLA_PYTHON_CLIENT_PREALLOCATE'] = 'false'
+        if cpu_subsets[worker_index]:
+            env['OMP_NUM_THREADS'] = str(len(cpu_subsets[worker_index]))
+        task_queue = context.Queue()
+        process = context.Process(
+            target=_worker,
+            args=(worker_index, cpu_subsets[worker_index], task_fn,
+                  task_queue, result_queue),
+            daemon=True)
+        with _environment(env):
+            process.start()
+        logging.info('Started worker %d with GPUs %s and CPUs %s, %d tasks',
+                     worker_index, env.get('CUDA_VISIBLE_DEVICES', 'all'),
+                     cpu_subsets[worker_index] or 'all',
+                     len(pending[worker_index]))
+        task_queues.append(task_queue)
+        processes.append(process)
+
+    results = {}
+    task_stats = {}
+    started = {}
+    num_stolen = 0
+    idle = set()
+
+    def next_task(worker_index: int) -> Optional[int]:
+        nonlocal num_stolen
+        if pending[worker_index]:
+            return pending[worker_index].popleft()
+        victim = max(range(num_workers), key=lambda i: len(pending[i]))
+        if not pending[victim]:
+            return None
+        task_id = pending[victim].pop()
+        logging.info('Worker %d took task %d from worker %d',
+                     worker_index, task_id, victim)
+        num_stolen += 1
+        return task_id
+
+    try:
+        while len(results) < len(tasks):
+            try:
+                status, worker_index, task_id, value = result_queue.get(
+                    timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                for worker_index, process in enumerate(processes):
+                    if worker_index not in idle and not process.is_alive():
+                        raise RuntimeError(
+                            f'Worker {worker_index} exited with '
+                            f'code {process.exitcode}')
+                continue
+            if status == 'error':
+                raise RuntimeError(
+                    f'Task {task_id} failed in worker {worker_index}:\n{value}')
+            if status == 'done':
+                results[task_id] = value
+                task_stats[task_id] = {
+                    'worker': worker_index,
+                    'time': time.time() - started.pop(task_id),
+                }
+            task_id = next_task(worker_index)
+            if task_id is None:
+                idle.add(worker_index)
+                task_queues[worker_index].put(None)
+                continue
+            started[task_id] = time.time()
+            task_queues[worker_index].put((task_id, tasks[task_id][1]))
+    finally:
+        for worker_index, task_queue in enumerate(task_queues):
+            if worker_index not in idle:
+                task_queue.put(None)
+        for process in processes:
+            process.join(timeout=60)
+            if process.is_alive():
+                process.terminate()
+
+    if stats is not None:
+        stats['tasks'] = [task_stats[task_id] for task_id in range(len(tasks))]
+        stats['num_stolen'] = num_stolen
+    return [results[task_id] for task_id in range(len(tasks))]
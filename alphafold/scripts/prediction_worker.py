@@ -0,0 +1,240 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A long-lived prediction worker that takes jobs from a spool directory.
+
+A job is a JSON file with the fields of run_predict.py: input_features_path,
+model_preset, model_index, prediction_index, random_seed,
+raw_prediction_path, unrelaxed_protein_path, metadata_output_path and,
+optionally, result_keys, result_float16 and result_compression. Jobs are
+submitted to the incoming directory of the spool and processed in the order
+of their names. A worker claims a job by renaming it to the running
+directory, so several workers can share a spool. After a job completes, its
+record with the status and latencies is written to the done or failed
+directory.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+from alphafold.model import config
+from alphafold.model import model
+
+from alphafold_utils import create_model_runner
+from alphafold_utils import predict
+from params_store import ParamsStore
+from prediction_buckets import ShapeBuckets
+from prediction_io import PredictionOutputPolicy
+
+INCOMING_DIR = 'incoming'
+RUNNING_DIR = 'running'
+DONE_DIR = 'done'
+FAILED_DIR = 'failed'
+
+
+def _write_json(path: str, value: Any):
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(value, f, indent=4)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def submit_job(spool_path: str, job: Mapping[str, Any]) -> str:
+    """Adds a job to a spool directory and returns its ID."""
+    job_id = f'{time.time():.6f}-{uuid.uuid4().hex[:8]}'
+    incoming_path = os.path.join(spool_path, INCOMING_DIR)
+    os.makedirs(incoming_path, exist_ok=True)
+    _write_json(os.path.join(incoming_path, f'{job_id}.json'), dict(job))
+    return job_id
+
+
+class PredictionWorker:
+    """Runs prediction jobs with model runners that are kept between jobs.
+
+    Model parameters are loaded once per model and the compiled model
+    functions are reused by all jobs with the same input shapes. With shape
+    buckets, jobs of targets with different sizes share compiled functions.
+    """
+
+    def __init__(self,
+                 spool_path: str,
+                 model_params_path: str,
+                 poll_interval: float = 1.0,
+                 max_idle_time: Optional[float] = None,
+                 shape_buckets: Optional[ShapeBuckets] = None,
+                 params_store: Optional[ParamsStore] = None):
+        self.spool_path = spool_path
+        self.model_params_path = model_params_path
+        self.shape_buckets = shape_buckets
+        self.params_store = params_store
+        self.poll_interval = poll_interval
+        self.max_idle_time = max_idle_time
+        self._runners = {}
+        self._stop = threading.Event()
+        for directory in [INCOMING_DIR, RUNNING_DIR, DONE_DIR, FAILED_DIR]:
+            os.makedirs(os.path.join(spool_path, directory), exist_ok=True)
+
+    def stop(self):
+        """Stops the worker after the current job."""
+        self._stop.set()
+
+    def _claim(self) -> Optional[Tuple[str, str]]:
+        """Moves the first incoming job to the running directory."""
+        incoming_path = os.path.join(self.spool_path, INCOMING_DIR)
+        for name in sorted(os.listdir(incoming_path)):
+            if name.startswith('.') or not name.endswith('.json'):
+                continue
+            running_path = os.path.join(self.spool_path, RUNNING_DIR, name)
+            try:
+                os.rename(os.path.join(incoming_path, name), running_path)
+            except FileNotFoundError:
+                # Claimed by another worker.
+                continue
+            return name, running_path
+        return None
+
+    def _model_runner(
+        self,
+        model_name: str,
+        num_ensemble: int,
+        run_multimer_system: bool
+    ) -> Tuple[model.RunModel, bool]:
+        """Returns a model runner and whether it was created earlier."""
+        key = (model_name, num_ensemble)
+        warm = key in self._runners
+        if not warm:
+            logging.info('Loading model %s', model_name)
+            self._runners[key] = create_model_runner(
+                model_params_path=self.model_params_path,
+                model_name=model_name,
+                num_ensemble=num_ensemble,
+                run_multimer_system=run_multimer_system,
+                params_store=self.params_store)
+        return self._runners[key], warm
+
+    def run_job(self, job: Mapping[str, Any]) -> Dict[str, Any]:
+        """Runs a prediction job and writes its outputs and metadata."""
+        model_preset = job.get('model_preset', 'monomer')
+        run_multimer_system = model_preset == 'multimer'
+        num_ensemble = 8 if model_preset == 'monomer_casp14' else 1
+        model_name = config.MODEL_PRESETS[model_preset][job['model_index']]
+
+        t_0 = time.time()
+        model_runner, warm = self._model_runner(
+            model_name, num_ensemble, run_multimer_system)
+        model_load_time = time.time() - t_0
+
+        for path in [job['raw_prediction_path'],
+                     job['unrelaxed_protein_path'],
+                     job['metadata_output_path']]:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        output_policy = PredictionOutputPolicy(
+            keep_keys=job.get('result_keys'),
+            downcast_float16=job.get('result_float16', False),
+            compression=job.get('result_compression', 'none'))
+
+        t_0 = time.time()
+        prediction_stats = {}
+        prediction_result = predict(
+            model_features_path=job['input_features_path'],
+            model_params_path=self.model_params_path,
+            model_name=model_name,
+            num_ensemble=num_ensemble,
+            run_multimer_system=run_multimer_system,
+            random_seed=job['random_seed'],
+            raw_prediction_path=job['raw_prediction_path'],
+            unrelaxed_protein_path=job['unrelaxed_protein_path'],
+            output_policy=output_policy,
+            metadata=prediction_stats,
+            model_runner=model_runner,
+            shape_buckets=self.shape_buckets)
+        predict_time = time.time() - t_0
+
+        prediction_metadata = {
+            'model_name': model_name,
+            'model_index': job['model_index'],
+            'prediction_index': job['prediction_index'],
+            'random_seed': job['random_seed'],
+            'ranking_confidence': float(prediction_result['ranking_confidence']),
+            **prediction_stats,
+            'worker_latency': {
+                'warm_model': warm,
+                'model_load_time': model_load_time,
+                'predict_time': predict_time,
+            },
+        }
+        with open(job['metadata_output_path'], 'w') as f:
+            json.dump(prediction_metadata, f, indent=4)
+        return prediction_metadata
+
+    def serve(self) -> int:
+        """Runs jobs until stopped or idle for max_idle_time.
+
+        Returns the number of processed jobs.
+        """
+        num_jobs = 0
+        idle_since = time.time()
+        while not self._stop.is_set():
+            claimed = self._claim()
+            if claimed is None:
+                if (self.max_idle_time is not None
+                        and time.time() - idle_since >= self.max_idle_time):
+                    logging.info('No jobs for %.0fs, stopping', self.max_idle_time)
+                    break
+                self._stop.wait(self.poll_interval)
+                continue
+
+            name, running_path = claimed
+            t_0 = time.time()
+            # Renaming keeps the modification time of the submitted file.
+            record = {
+                'job_id': os.path.splitext(name)[0],
+                'queue_time': max(0.0, t_0 - os.path.getmtime(running_path)),
+            }
+            try:
+                with open(running_path) as f:
+                    record['job'] = json.load(f)
+                logging.info('Running job %s', record['job_id'])
+                metadata = self.run_job(record['job'])
+                record['status'] = 'succeeded'
+                record['worker_latency'] = metadata['worker_latency']
+            except Exception as e:
+                logging.exception('Job %s failed', record['job_id'])
+                record['status'] = 'failed'
+                record['error'] = str(e)
+            record['latency'] = time.time() - t_0
+            logging.info('Job %s %s in %.1fs after %.1fs in the queue',
+                         record['job_id'], record['status'],
+                         record['latency'], record['queue_time'])
+
+            output_dir = DONE_DIR if record['status'] == 'succeeded' else FAILED_DIR
+            _write_json(os.path.join(self.spool_path, output_dir, name), record)
+            os.remove(running_path)
+            num_jobs += 1
+            idle_since = time.time()
+
+        logging.info('Worker processed %d jobs', num_jobs)
+        return num_jobs
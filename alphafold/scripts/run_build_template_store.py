@@ -0,0 +1,49 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Builds a pre-parsed template store from a directory of mmCIF files."""
+
+import multiprocessing
+import time
+
+from absl import flags
+from absl import app
+from absl import logging
+
+from template_store import build_template_store
+
+flags.DEFINE_string('mmcif_path', None, 'A path to a directory with mmCIF files')
+flags.DEFINE_string('template_store_path', None, 'A path to a directory that will store the template store')
+flags.DEFINE_integer('num_workers', multiprocessing.cpu_count(), 'The number of mmCIF parsing processes')
+flags.mark_flag_as_required('mmcif_path')
+flags.mark_flag_as_required('template_store_path')
+FLAGS = flags.FLAGS
+
+
+def _main(argv):
+
+    logging.info(f'Building template store from: {FLAGS.mmcif_path}')
+    t0 = time.time()
+
+    num_entries = build_template_store(
+        mmcif_dir=FLAGS.mmcif_path,
+        output_path=FLAGS.template_store_path,
+        num_workers=FLAGS.num_workers)
+
+    t1 = time.time()
+    logging.info(f'Template store with {num_entries} entries built. Elapsed time: {t1-t0}')
+
+
+if __name__ == "__main__":
+    app.run(_main)
@@ -21,7 +21,19 @@ from absl import flags
 from absl import app
 from absl import logging
 
+from alphafold_utils import KALIGN_BINARY_PATH
+from alphafold_utils import MAX_TEMPLATE_HITS
 from alphafold_utils import run_data_pipeline
+from alphafold_utils import run_data_pipeline_batch
+from alphafold_utils import split_fasta_targets
+from db_staging import DatabaseStager
+from feature_cache import FeatureCache
+from feature_cache import structure_source_fingerprint
+from msa_cache import LocalDirectoryBackend
+from msa_cache import MsaCache
+from msa_cache import fingerprint_database
+from msa_scheduler import available_cpus
+from msa_subsampling import MsaSubsampler
 
 flags.DEFINE_string('fasta_input_path', None, 'A path to sequence')
 flags.DEFINE_string('msas_output_path', None, 'A path to a directory that will store msas')
@@ -39,6 +51,8 @@ flags.DEFINE_string('obsolete_pdbs_path', 'pdb_mmcif/obsolete.dat', 'Uniref90 da
 flags.DEFINE_string('seqres_database_path', 'pdb_seqres/pdb_seqres.txt', 'Uniref90 database path')
 flags.DEFINE_string('mmcif_path', 'pdb_mmcif/mmcif_files', 'Uniref90 database path')
 flags.DEFINE_string('max_template_date', None, 'Max template date')
+flags.DEFINE_string('template_store_path', None, 'Template store path. If set, template '
+                    'structures are read from the pre-parsed store instead of mmCIF files')
 flags.DEFINE_enum('model_preset', 'monomer',
                   ['monomer', 'monomer_casp14', 'monomer_ptm', 'multimer'],
                   'Choose preset model configuration - the monomer model, '
@@ -49,22 +63,95 @@ flags.DEFINE_enum('db_preset', 'full_dbs',
                   'Choose preset MSA database configuration - '
                   'smaller genetic database config (reduced_dbs) or '
                   'full genetic database config  (full_dbs)')
-flags.mark_flag_as_required('fasta_input_path')
+flags.DEFINE_enum('features_format', 'pickle', ['pickle', 'mapped'],
+                  'Format of the features file - a pickle, or a memory-mappable array '
+                  'container that predict tasks load without copying. Mapped files '
+                  'should use the .npmap extension')
+flags.DEFINE_integer('max_msa_depth', None, 'If set, the MSA features of monomer targets are '
+                     'capped at this many sequences with diversity-aware subsampling')
+flags.DEFINE_integer('msa_num_clusters', 64, 'The maximum number of sequence identity clusters '
+                     'used by MSA subsampling')
+flags.DEFINE_float('msa_identity_threshold', 0.9, 'Sequence identity above which MSA subsampling '
+                   'stops adding clusters')
+flags.DEFINE_string('msa_cache_path', None, 'A path to a directory with cached MSA search results. '
+                    'If not set, MSA caching is disabled')
+flags.DEFINE_float('msa_cache_max_size_gb', None, 'Size budget of the MSA cache in GB. '
+                   'Least recently used entries above the budget are evicted')
+flags.DEFINE_string('feature_cache_path', None, 'A path to a directory with cached features and '
+                    'MSAs of whole targets. If not set, feature caching is disabled')
+flags.DEFINE_float('feature_cache_max_size_gb', None, 'Size budget of the feature cache in GB. '
+                   'Least recently used entries above the budget are evicted')
+flags.DEFINE_boolean('concurrent_msa_search', False, 'Whether to run the MSA searches '
+                     'concurrently under a shared CPU budget')
+flags.DEFINE_integer('n_cpu', None, 'The number of cores shared by concurrent MSA searches. '
+                     'If not set, the number of cores available to the container is used')
+flags.DEFINE_string('local_staging_path', None, 'A path to a local scratch directory. If set, '
+                    'the searched databases are copied there before the searches run')
+flags.DEFINE_float('local_staging_max_size_gb', None, 'Size budget of the local staging directory '
+                   'in GB. Least recently used databases above the budget are evicted')
+flags.DEFINE_string('uniref90_shards_path', None, 'A path to the uniref90 database split into '
+                    'shards. If set, the shards are searched in parallel instead of the database')
+flags.DEFINE_string('uniprot_shards_path', None, 'A path to the uniprot database split into '
+                    'shards. If set, the shards are searched in parallel instead of the database')
+flags.DEFINE_integer('num_shard_workers', None, 'The number of database shards searched '
+                     'concurrently. If not set, all shards are searched at once')
+flags.DEFINE_string('batch_fasta_path', None, 'A path to a multi-record FASTA file. '
+                    'Each record is processed as a separate monomer target')
+flags.DEFINE_string('batch_manifest_path', None, 'A path to a file listing one FASTA file '
+                    'per line. Each file is processed as a separate target')
+flags.DEFINE_string('batch_output_path', None, 'A path to a directory that will store '
+                    'per-target outputs and the batch manifest')
+flags.DEFINE_integer('num_batch_workers', 1, 'The number of targets processed concurrently '
+                     'in batch mode')
+flags.mark_flags_as_mutual_exclusive(['fasta_input_path', 'batch_fasta_path', 'batch_manifest_path'],
+                                     required=True)
 flags.mark_flag_as_required('max_template_date')
-flags.mark_flag_as_required('msas_output_path')
-flags.mark_flag_as_required('features_output_path')
-flags.mark_flag_as_required('metadata_output_path')
 flags.mark_flag_as_required('ref_dbs_root_path')
 FLAGS = flags.FLAGS
 
 
-def _main(argv):
-    
-    logging.info(f'Running data pipeline on: {FLAGS.fasta_input_path}') 
+def _run_batch(run_multimer_system, pipeline_args):
+    os.makedirs(FLAGS.batch_output_path, exist_ok=True)
+    if FLAGS.batch_fasta_path:
+        if run_multimer_system:
+            raise app.UsageError(
+                '--batch_fasta_path is not supported with the multimer preset. '
+                'Use --batch_manifest_path with one FASTA file per complex.')
+        targets = split_fasta_targets(
+            FLAGS.batch_fasta_path, FLAGS.batch_output_path)
+    else:
+        with open(FLAGS.batch_manifest_path) as f:
+            fasta_paths = [line.strip() for line in f if line.strip()]
+        targets = []
+        for index, fasta_path in enumerate(fasta_paths):
+            target_name = os.path.splitext(os.path.basename(fasta_path))[0]
+            targets.append((f'{index}_{target_name}', fasta_path))
 
-    os.makedirs(FLAGS.msas_output_path, exist_ok=True)
-    os.makedirs(os.path.dirname(FLAGS.features_output_path), exist_ok=True)
-    os.makedirs(os.path.dirname(FLAGS.metadata_output_path), exist_ok=True)
+    logging.info(f'Running data pipeline on {len(targets)} targets '
+                 f'with {FLAGS.num_batch_workers} workers')
+    if pipeline_args['concurrent_msa_search'] and pipeline_args['n_cpu'] is None:
+        pipeline_args['n_cpu'] = max(1, available_cpus() // FLAGS.num_batch_workers)
+
+    manifest = run_data_pipeline_batch(
+        targets=targets,
+        output_path=FLAGS.batch_output_path,
+        num_workers=FLAGS.num_batch_workers,
+        run_multimer_system=run_multimer_system,
+        features_format=FLAGS.features_format,
+        **pipeline_args)
+
+    with open(os.path.join(FLAGS.batch_output_path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+    num_failed = sum(entry['status'] == 'failed' for entry in manifest)
+    logging.info(f'Batch completed: {len(manifest) - num_failed} succeeded, '
+                 f'{num_failed} failed')
+    if pipeline_args['feature_cache']:
+        num_hits = sum(entry.get('feature_cache') == 'hit' for entry in manifest)
+        logging.info(f'Feature cache hits: {num_hits} of {len(manifest)} targets')
+
+
+def _main(argv):
 
     uniref90_database_path = os.path.join(
         FLAGS.ref_dbs_root_path, FLAGS.uniref90_database_path)
@@ -86,13 +173,102 @@ def _main(argv):
         FLAGS.ref_dbs_root_path, FLAGS.seqres_database_path)
     mmcif_path = os.path.join(
         FLAGS.ref_dbs_root_path, FLAGS.mmcif_path)
+    template_store_path = None
+    if FLAGS.template_store_path:
+        template_store_path = os.path.join(
+            FLAGS.ref_dbs_root_path, FLAGS.template_store_path)
+    uniref90_shards_path = None
+    if FLAGS.uniref90_shards_path:
+        uniref90_shards_path = os.path.join(
+            FLAGS.ref_dbs_root_path, FLAGS.uniref90_shards_path)
+    uniprot_shards_path = None
+    if FLAGS.uniprot_shards_path:
+        uniprot_shards_path = os.path.join(
+            FLAGS.ref_dbs_root_path, FLAGS.uniprot_shards_path)
     
     use_small_bfd = FLAGS.db_preset == 'reduced_dbs'
     run_multimer_system = FLAGS.model_preset == 'multimer'
 
-    features_dict, msas_metadata = run_data_pipeline(
-        fasta_path=FLAGS.fasta_input_path,
-        run_multimer_system=run_multimer_system,
+    msa_subsampler = None
+    if FLAGS.max_msa_depth is not None:
+        msa_subsampler = MsaSubsampler(
+            max_depth=FLAGS.max_msa_depth,
+            num_clusters=FLAGS.msa_num_clusters,
+            identity_threshold=FLAGS.msa_identity_threshold)
+
+    feature_cache = None
+    cache_hit = False
+    if FLAGS.feature_cache_path:
+        database_paths = {
+            'uniref90': uniref90_database_path,
+            'mgnify': mgnify_database_path,
+            'obsolete_pdbs': obsolete_pdbs_path,
+        }
+        if use_small_bfd:
+            database_paths['small_bfd'] = small_bfd_database_path
+        else:
+            database_paths['bfd'] = bfd_database_path
+            database_paths['uniclust30'] = uniclust30_database_path
+        if run_multimer_system:
+            database_paths['uniprot'] = uniprot_database_path
+            database_paths['seqres'] = seqres_database_path
+        else:
+            database_paths['pdb70'] = pdb70_database_path
+        max_size_bytes = None
+        if FLAGS.feature_cache_max_size_gb is not None:
+            max_size_bytes = int(FLAGS.feature_cache_max_size_gb * 1024**3)
+        feature_cache = FeatureCache(
+            cache_path=FLAGS.feature_cache_path,
+            database_paths=database_paths,
+            params={
+                'model_preset': FLAGS.model_preset,
+                'db_preset': FLAGS.db_preset,
+                'max_template_date': FLAGS.max_template_date,
+                # Template features are read from the structure source, which
+                # may be updated in place.
+                'structure_source': structure_source_fingerprint(
+                    mmcif_path, template_store_path),
+                'max_template_hits': MAX_TEMPLATE_HITS,
+                'kalign': fingerprint_database(KALIGN_BINARY_PATH) if KALIGN_BINARY_PATH else None,
+                'msa_subsampling': msa_subsampler.params() if msa_subsampler else None,
+            },
+            max_size_bytes=max_size_bytes)
+        if FLAGS.fasta_input_path:
+            cache_hit = feature_cache.contains(
+                feature_cache.make_key(FLAGS.fasta_input_path))
+
+    # Searches are skipped on a feature cache hit, so there is nothing to stage.
+    if FLAGS.local_staging_path and not cache_hit:
+        max_size_bytes = None
+        if FLAGS.local_staging_max_size_gb is not None:
+            max_size_bytes = int(FLAGS.local_staging_max_size_gb * 1024**3)
+        stager = DatabaseStager(
+            staging_path=FLAGS.local_staging_path,
+            source_root_path=FLAGS.ref_dbs_root_path,
+            max_size_bytes=max_size_bytes)
+        uniref90_database_path = stager.stage(uniref90_database_path)
+        mgnify_database_path = stager.stage(mgnify_database_path)
+        if use_small_bfd:
+            small_bfd_database_path = stager.stage(small_bfd_database_path)
+        else:
+            bfd_database_path = stager.stage(bfd_database_path)
+            uniclust30_database_path = stager.stage(uniclust30_database_path)
+        if run_multimer_system:
+            uniprot_database_path = stager.stage(uniprot_database_path)
+            seqres_database_path = stager.stage(seqres_database_path)
+        else:
+            pdb70_database_path = stager.stage(pdb70_database_path)
+
+    msa_cache = None
+    if FLAGS.msa_cache_path:
+        max_size_bytes = None
+        if FLAGS.msa_cache_max_size_gb is not None:
+            max_size_bytes = int(FLAGS.msa_cache_max_size_gb * 1024**3)
+        msa_cache = MsaCache(
+            backend=LocalDirectoryBackend(FLAGS.msa_cache_path),
+            max_size_bytes=max_size_bytes)
+
+    pipeline_args = dict(
         use_small_bfd=use_small_bfd,
         uniref90_database_path=uniref90_database_path,
         mgnify_database_path=mgnify_database_path,
@@ -105,8 +281,43 @@ def _main(argv):
         seqres_database_path=seqres_database_path,
         mmcif_path=mmcif_path,
         max_template_date=FLAGS.max_template_date,
+        msa_cache=msa_cache,
+        concurrent_msa_search=FLAGS.concurrent_msa_search,
+        n_cpu=FLAGS.n_cpu,
+        template_store_path=template_store_path,
+        uniref90_shards_path=uniref90_shards_path,
+        uniprot_shards_path=uniprot_shards_path,
+        num_shard_workers=FLAGS.num_shard_workers,
+        msa_subsampler=msa_subsampler,
+        feature_cache=feature_cache,
+    )
+
+    if FLAGS.batch_fasta_path or FLAGS.batch_manifest_path:
+        if not FLAGS.batch_output_path:
+            raise app.UsageError('--batch_output_path is required in batch mode')
+        _run_batch(run_multimer_system, pipeline_args)
+        return
+
+    for flag_name in ['msas_output_path', 'features_output_path', 'metadata_output_path']:
+        if not FLAGS[flag_name].value:
+            raise app.UsageError(f'--{flag_name} is required')
+    if FLAGS.features_format == 'mapped' and FLAGS.features_output_path.endswith('.pkl'):
+        raise app.UsageError('Mapped features are not pickles. Use a --features_output_path '
+                             'with the .npmap extension')
+
+    logging.info(f'Running data pipeline on: {FLAGS.fasta_input_path}') 
+
+    os.makedirs(FLAGS.msas_output_path, exist_ok=True)
+    os.makedirs(os.path.dirname(FLAGS.features_output_path), exist_ok=True)
+    os.makedirs(os.path.dirname(FLAGS.metadata_output_path), exist_ok=True)
+
+    features_dict, msas_metadata = run_data_pipeline(
+        fasta_path=FLAGS.fasta_input_path,
+        run_multimer_system=run_multimer_system,
         msa_output_path=FLAGS.msas_output_path,
         features_output_path=FLAGS.features_output_path,
+        features_format=FLAGS.features_format,
+        **pipeline_args,
     ) 
 
     with open(FLAGS.metadata_output_path, 'w') as f:
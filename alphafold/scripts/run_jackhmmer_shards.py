@@ -0,0 +1,110 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Splits a database, searches one of its shards or merges shard results.
+
+The search mode can run as a Cloud Batch task group with one task per shard.
+The shard of a task is taken from the BATCH_TASK_INDEX environment variable
+if --shard_index is not set.
+"""
+
+import os
+import shutil
+import time
+
+from absl import flags
+from absl import app
+from absl import logging
+
+from jackhmmer_shards import load_shard_index
+from jackhmmer_shards import merge_shard_alignments
+from jackhmmer_shards import search_shard
+from jackhmmer_shards import split_fasta_database
+
+flags.DEFINE_enum('mode', None, ['split', 'search', 'merge'],
+                  'Split a database into shards, search a shard or merge shard results')
+flags.DEFINE_string('database_path', None, 'A path to a FASTA database to split')
+flags.DEFINE_integer('num_shards', None, 'The number of shards to split the database into')
+flags.DEFINE_string('shards_path', None, 'A path to a directory with database shards')
+flags.DEFINE_string('fasta_input_path', None, 'A path to sequence')
+flags.DEFINE_integer('shard_index', None, 'The index of the shard to search. '
+                     'Defaults to the BATCH_TASK_INDEX environment variable')
+flags.DEFINE_string('shard_outputs_path', None, 'A path to a directory with per-shard search results')
+flags.DEFINE_string('msa_output_path', None, 'A path to the merged MSA file')
+flags.DEFINE_integer('maxseq', 10_000, 'The maximum number of sequences in the MSA')
+flags.DEFINE_integer('n_cpu', 8, 'The number of CPUs to give Jackhmmer')
+flags.mark_flag_as_required('mode')
+flags.mark_flag_as_required('shards_path')
+FLAGS = flags.FLAGS
+
+JACKHMMER_BINARY_PATH = shutil.which('jackhmmer')
+
+
+def _require(*flag_names):
+    for flag_name in flag_names:
+        if FLAGS[flag_name].value is None:
+            raise app.UsageError(f'--{flag_name} is required in {FLAGS.mode} mode')
+
+
+def _main(argv):
+
+    t0 = time.time()
+    if FLAGS.mode == 'split':
+        _require('database_path', 'num_shards')
+        logging.info(f'Splitting {FLAGS.database_path} into {FLAGS.num_shards} shards')
+        split_fasta_database(
+            database_path=FLAGS.database_path,
+            output_path=FLAGS.shards_path,
+            num_shards=FLAGS.num_shards)
+
+    elif FLAGS.mode == 'search':
+        _require('fasta_input_path', 'shard_outputs_path')
+        shard_index = FLAGS.shard_index
+        if shard_index is None:
+            if 'BATCH_TASK_INDEX' not in os.environ:
+                raise app.UsageError('--shard_index or BATCH_TASK_INDEX is required in search mode')
+            shard_index = int(os.environ['BATCH_TASK_INDEX'])
+        logging.info(f'Searching shard {shard_index} of {FLAGS.shards_path}')
+        search_shard(
+            binary_path=JACKHMMER_BINARY_PATH,
+            input_fasta_path=FLAGS.fasta_input_path,
+            shards_path=FLAGS.shards_path,
+            shard_index=shard_index,
+            output_path=FLAGS.shard_outputs_path,
+            n_cpu=FLAGS.n_cpu,
+            max_sequences=FLAGS.maxseq)
+
+    else:
+        _require('shard_outputs_path', 'msa_output_path')
+        num_shards = len(load_shard_index(FLAGS.shards_path)['shards'])
+        shard_results = []
+        for shard_index in range(num_shards):
+            prefix = os.path.join(FLAGS.shard_outputs_path, f'shard_{shard_index:04d}')
+            with open(f'{prefix}.sto') as f:
+                sto = f.read()
+            with open(f'{prefix}.tbl') as f:
+                tbl = f.read()
+            shard_results.append((sto, tbl))
+        logging.info(f'Merging results of {num_shards} shards')
+        merged_sto = merge_shard_alignments(shard_results, FLAGS.maxseq)
+        os.makedirs(os.path.dirname(FLAGS.msa_output_path), exist_ok=True)
+        with open(FLAGS.msa_output_path, 'w') as f:
+            f.write(merged_sto)
+
+    t1 = time.time()
+    logging.info(f'Completed {FLAGS.mode}. Elapsed time: {t1-t0}')
+
+
+if __name__ == "__main__":
+    app.run(_main)
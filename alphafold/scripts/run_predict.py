@@ -25,7 +25,15 @@ from absl import app
 from absl import logging
 
 from alphafold.model import config
+from adaptive_recycling import AdaptiveRecycling
 from alphafold_utils import predict
+from alphafold_utils import predict_batch
+from artifact_writer import AsyncArtifactWriter
+from params_store import ParamsStore
+from prediction_buckets import ShapeBuckets
+from prediction_buckets import enable_compilation_cache
+from prediction_io import COMPRESSIONS
+from prediction_io import PredictionOutputPolicy
 
 flags.DEFINE_string('input_features_path', None, 'A path to input features')
 flags.DEFINE_string('model_params_path', None, 'A path to model parameters')
@@ -41,22 +49,128 @@ flags.DEFINE_enum('model_preset', 'monomer',
 flags.DEFINE_integer('model_index', None, 'Model index')
 flags.DEFINE_integer('prediction_index', None, 'Prediction index')
 flags.DEFINE_integer('random_seed', None, 'The random seed')
+flags.DEFINE_list('result_keys', None, 'Keys of the raw prediction result to save, e.g. '
+                  'structure_module,predicted_lddt. pLDDT, PAE, pTM and ranking fields are always '
+                  'saved. If not set, all keys are saved')
+flags.DEFINE_boolean('result_float16', False, 'Whether to save floating point arrays of the '
+                     'raw prediction result other than pLDDT, PAE, pTM and ranking fields as float16')
+flags.DEFINE_enum('result_compression', 'none', COMPRESSIONS,
+                  'Compression of the raw prediction result file')
+flags.DEFINE_boolean('async_artifact_writes', False, 'Whether to write raw prediction results and '
+                     'unrelaxed proteins in background threads. In batch mode the next '
+                     'predictions run while the outputs are written')
+flags.DEFINE_list('num_res_buckets', None, 'Sizes to which the number of residues is padded, '
+                  'e.g. 256,512,1024. If not set, features are not padded')
+flags.DEFINE_list('msa_depth_buckets', None, 'Sizes to which the MSA depth of multimer '
+                  'features is padded')
+flags.DEFINE_string('compilation_cache_path', None, 'A path to a persistent JAX compilation '
+                    'cache directory that can be shared by tasks')
+flags.DEFINE_string('params_store_path', None, 'A path to a local directory with model parameters '
+                    'converted to a memory-mapped format. Parameters are converted on first use '
+                    'and shared by all processes on the host')
+flags.DEFINE_float('recycle_tolerance', None, 'If set, recycling stops once the C-alpha distances '
+                   'change by less than this many Angstroms between recycles')
+flags.DEFINE_float('recycle_plddt_tolerance', None, 'If set with --recycle_tolerance, recycling '
+                   'also stops once the mean pLDDT change between recycles is below this value')
+flags.DEFINE_integer('max_recycles', None, 'The maximum number of recycles with adaptive '
+                     'recycling. If not set, the number of recycles of the model is used')
+flags.DEFINE_string('batch_manifest_path', None, 'A path to a file listing one features file per '
+                    'line or to the manifest.json written by a data pipeline batch. If set, all '
+                    'targets are predicted with every selected model')
+flags.DEFINE_string('batch_output_path', None, 'A path to a directory that will store '
+                    'per-target outputs and the batch manifest')
 
 
 flags.mark_flag_as_required('model_params_path')
-flags.mark_flag_as_required('input_features_path')
-flags.mark_flag_as_required('metadata_output_path')
-flags.mark_flag_as_required('raw_prediction_path')
-flags.mark_flag_as_required('unrelaxed_protein_path')
-flags.mark_flag_as_required('model_index')
-flags.mark_flag_as_required('prediction_index')
 flags.mark_flag_as_required('random_seed')                     
 
 FLAGS = flags.FLAGS
 
 
+def _read_targets(manifest_path):
+    if manifest_path.endswith('.json'):
+        with open(manifest_path) as f:
+            entries = json.load(f)
+        return [(entry['target'], entry['features_path']) for entry in entries
+                if entry.get('status', 'succeeded') == 'succeeded']
+    with open(manifest_path) as f:
+        features_paths = [line.strip() for line in f if line.strip()]
+    targets = []
+    for index, features_path in enumerate(features_paths):
+        target_name = os.path.splitext(os.path.basename(features_path))[0]
+        targets.append((f'{index}_{target_name}', features_path))
+    return targets
+
+
+def _run_batch(output_policy, shape_buckets, params_store, recycling, artifact_writer):
+    os.makedirs(FLAGS.batch_output_path, exist_ok=True)
+    targets = _read_targets(FLAGS.batch_manifest_path)
+    model_names = config.MODEL_PRESETS[FLAGS.model_preset]
+    if FLAGS.model_index is not None:
+        model_names = [model_names[FLAGS.model_index]]
+    logging.info(f'Running {len(model_names)} models on {len(targets)} targets')
+
+    manifest = predict_batch(
+        targets=targets,
+        output_path=FLAGS.batch_output_path,
+        model_params_path=FLAGS.model_params_path,
+        model_names=model_names,
+        num_ensemble=8 if FLAGS.model_preset == 'monomer_casp14' else 1,
+        run_multimer_system='multimer' == FLAGS.model_preset,
+        random_seed=FLAGS.random_seed,
+        prediction_index=FLAGS.prediction_index or 0,
+        output_policy=output_policy,
+        shape_buckets=shape_buckets,
+        params_store=params_store,
+        recycling=recycling,
+        artifact_writer=artifact_writer)
+
+    with open(os.path.join(FLAGS.batch_output_path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+    num_failed = sum(entry['status'] == 'failed' for entry in manifest)
+    logging.info(f'Batch completed: {len(manifest) - num_failed} predictions succeeded, '
+                 f'{num_failed} failed')
+
+
 def _main(argv):
-                            
+
+    if FLAGS.compilation_cache_path:
+        enable_compilation_cache(FLAGS.compilation_cache_path)
+    shape_buckets = None
+    if FLAGS.num_res_buckets:
+        shape_buckets = ShapeBuckets(
+            num_res_buckets=[int(size) for size in FLAGS.num_res_buckets],
+            msa_depth_buckets=[int(size) for size in FLAGS.msa_depth_buckets or []])
+    params_store = None
+    if FLAGS.params_store_path:
+        params_store = ParamsStore(FLAGS.params_store_path)
+    recycling = None
+    if FLAGS.recycle_tolerance is not None:
+        recycling = AdaptiveRecycling(
+            tolerance=FLAGS.recycle_tolerance,
+            plddt_tolerance=FLAGS.recycle_plddt_tolerance,
+            max_recycles=FLAGS.max_recycles)
+    output_policy = PredictionOutputPolicy(
+        keep_keys=FLAGS.result_keys,
+        downcast_float16=FLAGS.result_float16,
+        compression=FLAGS.result_compression)
+    artifact_writer = None
+    if FLAGS.async_artifact_writes:
+        artifact_writer = AsyncArtifactWriter()
+
+    if FLAGS.batch_manifest_path:
+        if not FLAGS.batch_output_path:
+            raise app.UsageError('--batch_output_path is required in batch mode')
+        _run_batch(output_policy, shape_buckets, params_store, recycling, artifact_writer)
+        if artifact_writer:
+            artifact_writer.close()
+        return
+
+    for flag_name in ['input_features_path', 'metadata_output_path', 'raw_prediction_path',
+                      'unrelaxed_protein_path', 'model_index', 'prediction_index']:
+        if FLAGS[flag_name].value is None:
+            raise app.UsageError(f'--{flag_name} is required')
     
     os.makedirs(os.path.dirname(FLAGS.raw_prediction_path), exist_ok=True)
     os.makedirs(os.path.dirname(FLAGS.unrelaxed_protein_path), exist_ok=True)
@@ -69,6 +183,7 @@ def _main(argv):
     logging.info(f'Starting model prediction {FLAGS.prediction_index} using model {model_name}...')
     t0 = time.time()
 
+    prediction_stats = {}
     prediction_result = predict(
         model_features_path=FLAGS.input_features_path,
         model_params_path=FLAGS.model_params_path,
@@ -77,8 +192,18 @@ def _main(argv):
         run_multimer_system=run_multimer_system,
         random_seed=FLAGS.random_seed,
         raw_prediction_path=FLAGS.raw_prediction_path,
-        unrelaxed_protein_path=FLAGS.unrelaxed_protein_path
+        unrelaxed_protein_path=FLAGS.unrelaxed_protein_path,
+        output_policy=output_policy,
+        metadata=prediction_stats,
+        shape_buckets=shape_buckets,
+        params_store=params_store,
+        recycling=recycling,
+        artifact_writer=artifact_writer
     )
+    if artifact_writer:
+        # The output stats are added to the metadata once the result is written.
+        artifact_writer.flush()
+        artifact_writer.close()
 
     prediction_metadata = {
         'model_name': model_name,
@@ -86,6 +211,7 @@ def _main(argv):
         'prediction_index': FLAGS.prediction_index,
         'random_seed': FLAGS.random_seed,
         'ranking_confidence': prediction_result['ranking_confidence'],
+        **prediction_stats,
     }
     
     with open(FLAGS.metadata_output_path, 'w') as f:
@@ -0,0 +1,89 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs a warm prediction worker or submits a job to its spool directory."""
+
+import json
+import signal
+
+from absl import flags
+from absl import app
+from absl import logging
+
+from params_store import ParamsStore
+from prediction_buckets import ShapeBuckets
+from prediction_buckets import enable_compilation_cache
+from prediction_worker import PredictionWorker
+from prediction_worker import submit_job
+
+flags.DEFINE_string('spool_path', None, 'A path to the spool directory of the worker')
+flags.DEFINE_string('model_params_path', None, 'A path to model parameters')
+flags.DEFINE_float('poll_interval', 1.0, 'Seconds between checks for new jobs')
+flags.DEFINE_float('max_idle_time', None, 'If set, the worker stops after this many seconds '
+                   'without jobs')
+flags.DEFINE_list('num_res_buckets', None, 'Sizes to which the number of residues is padded, '
+                  'e.g. 256,512,1024. If not set, features are not padded')
+flags.DEFINE_list('msa_depth_buckets', None, 'Sizes to which the MSA depth of multimer '
+                  'features is padded')
+flags.DEFINE_string('compilation_cache_path', None, 'A path to a persistent JAX compilation '
+                    'cache directory that can be shared by tasks')
+flags.DEFINE_string('params_store_path', None, 'A path to a local directory with model parameters '
+                    'converted to a memory-mapped format shared by all workers on the host')
+flags.DEFINE_string('submit_job_path', None, 'A path to a JSON job file. If set, the job is '
+                    'submitted to the spool directory instead of running a worker')
+flags.mark_flag_as_required('spool_path')
+FLAGS = flags.FLAGS
+
+
+def _main(argv):
+
+    if FLAGS.submit_job_path:
+        with open(FLAGS.submit_job_path) as f:
+            job = json.load(f)
+        job_id = submit_job(FLAGS.spool_path, job)
+        logging.info(f'Submitted job {job_id}')
+        return
+
+    if not FLAGS.model_params_path:
+        raise app.UsageError('--model_params_path is required to run a worker')
+
+    if FLAGS.compilation_cache_path:
+        enable_compilation_cache(FLAGS.compilation_cache_path)
+    shape_buckets = None
+    if FLAGS.num_res_buckets:
+        shape_buckets = ShapeBuckets(
+            num_res_buckets=[int(size) for size in FLAGS.num_res_buckets],
+            msa_depth_buckets=[int(size) for size in FLAGS.msa_depth_buckets or []])
+
+    worker = PredictionWorker(
+        spool_path=FLAGS.spool_path,
+        model_params_path=FLAGS.model_params_path,
+        poll_interval=FLAGS.poll_interval,
+        max_idle_time=FLAGS.max_idle_time,
+        shape_buckets=shape_buckets,
+        params_store=ParamsStore(FLAGS.params_store_path) if FLAGS.params_store_path else None)
+
+    def stop(signum, frame):
+        logging.info(f'Received signal {signum}, stopping after the current job')
+        worker.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    logging.info(f'Serving prediction jobs from {FLAGS.spool_path}')
+    worker.serve()
+
+
+if __name__ == "__main__":
+    app.run(_main)
@@ -0,0 +1,155 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Resource usage profiling of pipeline stages."""
+
+import collections
+import contextlib
+import logging
+import resource
+import threading
+import time
+from typing import Any, Dict, Mapping
+
+# Fields of /proc/self/io reported for every stage. The counters include
+# reaped child processes, so I/O of the search tools is accounted for.
+_IO_FIELDS = {
+    'rchar': 'bytes_read',
+    'wchar': 'bytes_written',
+    'read_bytes': 'storage_bytes_read',
+    'write_bytes': 'storage_bytes_written',
+}
+
+
+def _read_io_counters() -> Dict[str, int]:
+    counters = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in _IO_FIELDS:
+                    counters[_IO_FIELDS[name]] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters
+
+
+def _cpu_time(usage: resource.struct_rusage) -> float:
+    return usage.ru_utime + usage.ru_stime
+
+
+class _Sample:
+    """A snapshot of the resource usage counters of this process."""
+
+    def __init__(self):
+        self.time = time.time()
+        self.usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.io = _read_io_counters()
+
+
+class StageProfiler:
+    """Records wall time, CPU time, peak RSS and I/O of named stages.
+
+    CPU time and I/O are deltas of process-wide counters, so stages that run
+    concurrently in threads of the same process are accounted to each other.
+    Peak RSS values are the high-water marks of this process and of its
+    largest child process at the end of a stage. Stages with the same name
+    are aggregated.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """Profiles the code run in the context as the named stage."""
+        start = _Sample()
+        try:
+            yield
+        finally:
+            self._record(name, start, _Sample())
+
+    def _record(self, name: str, start: _Sample, end: _Sample):
+        stats = {
+            'wall_time': end.time - start.time,
+            'cpu_time': _cpu_time(end.usage) - _cpu_time(start.usage),
+            'child_cpu_time': (_cpu_time(end.children_usage)
+                               - _cpu_time(start.children_usage)),
+        }
+        for field in end.io:
+            if field in start.io:
+                stats[field] = end.io[field] - start.io[field]
+        # ru_maxrss is in kilobytes on Linux.
+        peak_rss = {
+            'peak_rss_bytes': end.usage.ru_maxrss * 1024,
+            'child_peak_rss_bytes': end.children_usage.ru_maxrss * 1024,
+        }
+        logging.info('Stage %s: %s', name, dict(stats, **peak_rss))
+
+        with self._lock:
+            if name not in self._stages:
+                self._stages[name] = dict(calls=0, **{key: 0 for key in stats})
+            totals = self._stages[name]
+            totals['calls'] += 1
+            for key, value in stats.items():
+                totals[key] = totals.get(key, 0) + value
+            for key, value in peak_rss.items():
+                totals[key] = max(totals.get(key, 0), value)
+
+    def report(self) -> Dict[str, Dict[str, Any]]:
+        """Returns the stats of all recorded stages."""
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stages.items()}
+
+    def pop_report(self) -> Dict[str, Dict[str, Any]]:
+        """Returns the stats of all recorded stages and clears them."""
+        with self._lock:
+            stages = self._stages
+            self._stages = collections.OrderedDict()
+        return {name: dict(stats) for name, stats in stages.items()}
+
+
+class ProfiledObject:
+    """Forwards attribute access to an object and profiles some of its methods.
+
+    Used to profile the MSA runners, template searcher and template
+    featurizer of a data pipeline without changing the pipeline code.
+    """
+
+    def __init__(self,
+                 target: Any,
+                 profiler: StageProfiler,
+                 stage_names: Mapping[str, str]):
+        self._target = target
+        self._profiler = profiler
+        self._stage_names = dict(stage_names)
+
+    def __getattr__(self, name: str) -> Any:
+        # Only called for attributes not found on the proxy. Attributes are
+        # looked up in __dict__ so that a partially initialized proxy does not
+        # recurse.
+        if name.startswith('__') or '_target' not in self.__dict__:
+            raise AttributeError(name)
+        attr = getattr(self.__dict__['_target'], name)
+        stage_name = self.__dict__['_stage_names'].get(name)
+        if stage_name is None:
+            return attr
+        profiler = self.__dict__['_profiler']
+
+        def profiled(*args, **kwargs):
+            with profiler.stage(stage_name):
+                return attr(*args, **kwargs)
+        return profiled
@@ -0,0 +1,331 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A pre-parsed, memory-mapped store of template structures.
+
+The store holds the data the template featurizers extract from mmCIF files:
+release dates, chain SEQRES sequences and atom37 positions and masks. It is
+laid out as flat arrays indexed by PDB ID and chain ID:
+
+  entries.npy         sorted (pdb_id, release_date) records
+  chains.npy          sorted (key, order, offset, num_res, error) records,
+                      where key is '<pdb_id>_<chain_id>'
+  seqres.bin          concatenated SEQRES sequences (uint8)
+  atom_positions.bin  float32 [num_residues, atom_type_num, 3]
+  atom_masks.bin      uint8 [num_residues, atom_type_num]
+
+All files are opened memory-mapped and read-only, so lookups only touch the
+pages of the requested chains.
+"""
+
+import collections
+import glob
+import logging
+import multiprocessing
+import os
+import threading
+from typing import Any, List, Optional, Tuple
+
+from alphafold.common import residue_constants
+from alphafold.data import mmcif_parsing
+from alphafold.data import templates
+
+import numpy as np
+
+ENTRIES_DTYPE = np.dtype([('pdb_id', 'S8'), ('release_date', 'S10')])
+CHAINS_DTYPE = np.dtype([
+    ('key', 'S16'),
+    ('order', np.int32),
+    ('offset', np.int64),
+    ('num_res', np.int32),
+    ('error', 'S32'),
+])
+
+# Chain atom positions are stored without the CA-CA distance check, which is
+# applied at read time with the threshold requested by the featurizer.
+_NO_DISTANCE_CHECK = float('inf')
+
+
+def _parse_mmcif_file(cif_path: str) -> Tuple[str, str, List[Tuple[Any, ...]]]:
+    """Extracts the release date and per-chain data from an mmCIF file."""
+    pdb_id = os.path.splitext(os.path.basename(cif_path))[0].lower()
+    with open(cif_path) as f:
+        cif_string = f.read()
+    parsing_result = mmcif_parsing.parse(
+        file_id=pdb_id, mmcif_string=cif_string)
+    mmcif_object = parsing_result.mmcif_object
+    if mmcif_object is None:
+        return pdb_id, '', []
+
+    chains = []
+    for chain_id, seqres in mmcif_object.chain_to_seqres.items():
+        try:
+            positions, mask = templates._get_atom_positions(
+                mmcif_object, chain_id, max_ca_ca_distance=_NO_DISTANCE_CHECK)
+            chains.append((chain_id, seqres, positions.astype(np.float32),
+                           mask.astype(np.uint8), ''))
+        except (templates.Error, KeyError) as e:
+            chains.append((chain_id, seqres, None, None, type(e).__name__))
+    return pdb_id, mmcif_object.header['release_date'], chains
+
+
+def build_template_store(
+    mmcif_dir: str,
+    output_path: str,
+    num_workers: int = 1
+) -> int:
+    """Parses all mmCIF files in a directory and writes a template store.
+
+    Returns the number of stored PDB entries.
+    """
+    os.makedirs(output_path, exist_ok=True)
+    cif_paths = sorted(glob.glob(os.path.join(mmcif_dir, '*.cif')))
+    logging.info('Building template store from %d mmCIF files',
+                 len(cif_paths))
+
+    entries = []
+    chains = []
+    offset = 0
+    with open(os.path.join(output_path, 'seqres.bin'), 'wb') as seqres_file, \
+            open(os.path.join(output_path, 'atom_positions.bin'), 'wb') as positions_file, \
+            open(os.path.join(output_path, 'atom_masks.bin'), 'wb') as masks_file, \
+            multiprocessing.Pool(num_workers) as pool:
+        parsed_files = pool.imap(_parse_mmcif_file, cif_paths, chunksize=16)
+        for index, (pdb_id, release_date, pdb_chains) in enumerate(parsed_files):
+            entries.append((pdb_id, release_date))
+            for order, (chain_id, seqres, positions, mask, error) in enumerate(
+                    pdb_chains):
+                num_res = len(seqres)
+                seqres_file.write(seqres.encode())
+                if positions is None:
+                    positions = np.zeros(
+                        [num_res, residue_constants.atom_type_num, 3],
+                        dtype=np.float32)
+                    mask = np.zeros(
+                        [num_res, residue_constants.atom_type_num],
+                        dtype=np.uint8)
+                positions_file.write(positions.tobytes())
+                masks_file.write(mask.tobytes())
+                chains.append(
+                    (f'{pdb_id}_{chain_id}', order, offset, num_res, error))
+                offset += num_res
+            if (index + 1) % 10000 == 0:
+                logging.info('Processed %d mmCIF files', index + 1)
+
+    entries = np.array(entries, dtype=ENTRIES_DTYPE)
+    entries.sort(order='pdb_id')
+    np.save(os.path.join(output_path, 'entries.npy'), entries)
+    chains = np.array(chains, dtype=CHAINS_DTYPE)
+    chains.sort(order='key')
+    np.save(os.path.join(output_path, 'chains.npy'), chains)
+    logging.info('Template store with %d entries, %d chains and %d residues '
+                 'written to %s', len(entries), len(chains), offset,
+                 output_path)
+    return len(entries)
+
+
+class StoredMmcifObject:
+    """The subset of mmcif_parsing.MmcifObject used by template featurizers."""
+
+    def __init__(self, store: 'TemplateStore', file_id: str,
+                 release_date: str, chain_to_seqres: Any):
+        self.store = store
+        self.file_id = file_id
+        self.header = {'release_date': release_date}
+        self.chain_to_seqres = chain_to_seqres
+
+
+class TemplateStore:
+    """Read-only access to a template store built by build_template_store."""
+
+    def __init__(self, store_path: str):
+        self.store_path = store_path
+        self._entries = np.load(
+            os.path.join(store_path, 'entries.npy'), mmap_mode='r')
+        self._chains = np.load(
+            os.path.join(store_path, 'chains.npy'), mmap_mode='r')
+        self._seqres = self._memmap('seqres.bin', np.uint8, ())
+        self._positions = self._memmap(
+            'atom_positions.bin', np.float32,
+            (residue_constants.atom_type_num, 3))
+        self._masks = self._memmap(
+            'atom_masks.bin', np.uint8, (residue_constants.atom_type_num,))
+
+    def _memmap(self, file_name: str, dtype: Any,
+                row_shape: Tuple[int, ...]) -> np.ndarray:
+        path = os.path.join(self.store_path, file_name)
+        if os.path.getsize(path) == 0:
+            return np.zeros((0,) + row_shape, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r').reshape(
+            (-1,) + row_shape)
+
+    def __contains__(self, pdb_id: str) -> bool:
+        return self._find_entry(pdb_id) is not None
+
+    def _find_entry(self, pdb_id: str) -> Optional[int]:
+        key = pdb_id.lower().encode()
+        index = np.searchsorted(self._entries['pdb_id'], key)
+        if index < len(self._entries) and self._entries['pdb_id'][index] == key:
+            return int(index)
+        return None
+
+    def _find_chain(self, pdb_id: str, chain_id: str) -> Optional[np.void]:
+        key = f'{pdb_id.lower()}_{chain_id}'.encode()
+        index = np.searchsorted(self._chains['key'], key)
+        if index < len(self._chains) and self._chains['key'][index] == key:
+            return self._chains[index]
+        return None
+
+    def get_mmcif_object(self, pdb_id: str) -> Optional[StoredMmcifObject]:
+        """Returns the stored entry of a PDB ID or None if parsing failed.
+
+        Raises:
+          KeyError: if the PDB ID is not in the store.
+        """
+        entry_index = self._find_entry(pdb_id)
+        if entry_index is None:
+            raise KeyError(pdb_id)
+        release_date = self._entries['release_date'][entry_index].decode()
+        if not release_date:
+            return None
+
+        prefix = f'{pdb_id.lower()}_'.encode()
+        start = np.searchsorted(self._chains['key'], prefix)
+        end = np.searchsorted(self._chains['key'], prefix + b'\xff')
+        chains = sorted(self._chains[start:end], key=lambda c: c['order'])
+        chain_to_seqres = collections.OrderedDict()
+        for chain in chains:
+            chain_id = chain['key'][len(prefix):].decode()
+            seqres = self._seqres[
+                chain['offset']:chain['offset'] + chain['num_res']]
+            chain_to_seqres[chain_id] = seqres.tobytes().decode()
+        return StoredMmcifObject(
+            store=self,
+            file_id=pdb_id,
+            release_date=release_date,
+            chain_to_seqres=chain_to_seqres)
+
+    def get_atom_positions(
+        self,
+        pdb_id: str,
+        chain_id: str,
+        max_ca_ca_distance: float
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns atom37 positions and mask of a chain.
+
+        Raises the same errors as templates._get_atom_positions.
+        """
+        chain = self._find_chain(pdb_id, chain_id)
+        if chain is None:
+            raise KeyError(chain_id)
+        error = chain['error'].decode()
+        if error:
+            error_class = getattr(templates, error, KeyError)
+            raise error_class(
+                f'Could not get atom positions of {pdb_id}_{chain_id}')
+        start = chain['offset']
+        end = start + chain['num_res']
+        positions = np.array(self._positions[start:end], dtype=np.float64)
+        mask = np.array(self._masks[start:end], dtype=np.int64)
+        templates._check_residue_distances(
+            positions, mask, max_ca_ca_distance)
+        return positions, mask
+
+
+# The template featurizers call module level functions of
+# alphafold.data.templates to read mmCIF files. These are replaced once with
+# versions that serve PDB entries from the template store of the featurizer
+# running on the current thread and fall back to the originals otherwise.
+_local = threading.local()
+_patch_lock = threading.Lock()
+_original_read_file = templates._read_file
+_original_get_atom_positions = templates._get_atom_positions
+
+
+def _current_store() -> Optional[TemplateStore]:
+    return getattr(_local, 'store', None)
+
+
+def _read_file(path: str) -> str:
+    store = _current_store()
+    pdb_id = os.path.splitext(os.path.basename(path))[0]
+    if store is not None and pdb_id in store:
+        # The parser below reads the entry from the store.
+        return ''
+    return _original_read_file(path)
+
+
+def _get_atom_positions(mmcif_object, auth_chain_id, max_ca_ca_distance):
+    if isinstance(mmcif_object, StoredMmcifObject):
+        return mmcif_object.store.get_atom_positions(
+            mmcif_object.file_id, auth_chain_id, max_ca_ca_distance)
+    return _original_get_atom_positions(
+        mmcif_object, auth_chain_id, max_ca_ca_distance)
+
+
+class _MmcifParsingModule:
+    """Delegates to mmcif_parsing, parsing PDB entries from the store."""
+
+    def __getattr__(self, name):
+        return getattr(mmcif_parsing, name)
+
+    def parse(self, *, file_id: str, mmcif_string: str,
+              catch_all_errors: bool = True) -> mmcif_parsing.ParsingResult:
+        store = _current_store()
+        if store is not None and file_id in store:
+            mmcif_object = store.get_mmcif_object(file_id)
+            errors = {}
+            if mmcif_object is None:
+                errors[(file_id, '')] = 'mmCIF parsing failed in template store'
+            return mmcif_parsing.ParsingResult(
+                mmcif_object=mmcif_object, errors=errors)
+        return mmcif_parsing.parse(
+            file_id=file_id,
+            mmcif_string=mmcif_string,
+            catch_all_errors=catch_all_errors)
+
+
+def _install_patches():
+    with _patch_lock:
+        if templates._read_file is not _read_file:
+            templates._read_file = _read_file
+            templates._get_atom_positions = _get_atom_positions
+            templates.mmcif_parsing = _MmcifParsingModule()
+
+
+class _TemplateStoreFeaturizerMixin:
+    """Makes a template hit featurizer read structures from a TemplateStore."""
+
+    def __init__(self, *args, template_store: TemplateStore, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.template_store = template_store
+        _install_patches()
+
+    def get_templates(self, *args, **kwargs):
+        previous_store = _current_store()
+        _local.store = self.template_store
+        try:
+            return super().get_templates(*args, **kwargs)
+        finally:
+            _local.store = previous_store
+
+
+class StoreHhsearchHitFeaturizer(_TemplateStoreFeaturizerMixin,
+                                 templates.HhsearchHitFeaturizer):
+    """HhsearchHitFeaturizer that reads structures from a TemplateStore."""
+
+
+class StoreHmmsearchHitFeaturizer(_TemplateStoreFeaturizerMixin,
+                                  templates.HmmsearchHitFeaturizer):
+    """HmmsearchHitFeaturizer that reads structures from a TemplateStore."""